@@ -141,15 +141,142 @@ ALIBABA_API_KEY = os.environ.get('ALIBABA_API_KEY')
 ALIBABA_BASE_URL = "https://dashscope-intl.aliyuncs.com/compatible-mode/v1"
 ALIBABA_RAG_MODEL = "qwen-plus"
 
+# PROVIDER CLIENTS
+RAG_PROVIDERS_PRELOAD = [] # providers built when the worker starts, the rest on first use
+RAG_PROVIDER_MAX_CONNECTIONS = 200 # per provider and worker
+RAG_PROVIDER_KEEPALIVE_CONNECTIONS = 50 # idle connections kept open for reuse
+RAG_PROVIDER_KEEPALIVE_EXPIRY = 120 # seconds
+RAG_PROVIDER_TIMEOUT = 120 # seconds, answers stream for a while
+RAG_PROVIDER_CONNECT_TIMEOUT = 10
+RAG_GEMINI_DEADLINE = 300 # seconds a Gemini call may take in total, gRPC has no per-read timeout
+RAG_PROVIDER_LIMITS = { # concurrent streams and tokens per minute, per worker unless RAG_SCHEDULER_REDIS
+    "together": {"concurrency": 32, "tpm": 600_000},
+    "openai": {"concurrency": 32, "tpm": 600_000},
+    "alibaba": {"concurrency": 16, "tpm": 300_000},
+    "anthropic": {"concurrency": 16, "tpm": 200_000},
+    "gemini": {"concurrency": 16, "tpm": 1_000_000},
+}
+RAG_SCHEDULER_REDIS = False # also enforce the limits across all workers through Redis
+RAG_SCHEDULER_LEASE = 600 # seconds before a crashed worker's Redis slot is reclaimed
+RAG_QUEUE_FRAME_INTERVAL = 1.0 # seconds between queue-position checks for waiting clients
+
+# MODEL CONTEXT WINDOWS
+# provider: rag.providers client, window: context size in tokens, output: tokens reserved for the answer (max_tokens),
+# encoding: closest tiktoken encoding, token_ratio: safety factor for tokenizers tiktoken does not ship
+RAG_MODELS = {
+    "gemini-2.5-pro": {"provider": "gemini", "window": 1_048_576, "output": 2040, "encoding": "cl100k_base", "token_ratio": 1.15},
+    "lama-405": {"provider": "together", "window": 128_000, "output": 2040, "encoding": "cl100k_base", "token_ratio": 1.1},
+    "deepseek-R1": {"provider": "together", "window": 128_000, "output": 2040, "encoding": "cl100k_base", "token_ratio": 1.1},
+    "o3-mini": {"provider": "openai", "window": 200_000, "output": 25_000, "encoding": "o200k_base", "token_ratio": 1.0}, # reasoning tokens count as output
+    "claude-sonnet3": {"provider": "anthropic", "window": 200_000, "output": 2040, "encoding": "cl100k_base", "token_ratio": 1.2},
+    "qwen-plus": {"provider": "alibaba", "window": 131_072, "output": 2040, "encoding": "cl100k_base", "token_ratio": 1.1},
+}
+RAG_DEFAULT_MODEL = "gemini-2.5-pro"
+# model -> backup tried when the model fails with a rate-limit/5xx error before answering. Off by
+# default: the answer then silently comes from another model. Opt in per model, e.g.
+# {"deepseek-R1": "lama-405", "o3-mini": "gemini-2.5-pro"}
+RAG_BACKUP_MODELS = {}
+RAG_HEDGE_AFTER = None # seconds without a first token before the backup is raced as well, None = no hedging; needs a backup
+
+# STREAMING
+RAG_STREAM_FLUSH_MS = 40 # streamed text is sent at least this often, 0 = one frame per provider chunk
+RAG_STREAM_FLUSH_BYTES = 1024 # or as soon as this much text is buffered
+RAG_RESUMABLE_STREAMS = False # record each generation's frames in a Redis Stream clients can resume from; costs a Redis round trip per sent frame
+RAG_RESUME_MAXLEN = 10_000 # frames kept per generation (approximate trim)
+RAG_RESUME_TTL = 600 # seconds a generation's frames are kept after its last frame
+RAG_RESUME_GRACE = 15 # seconds a generation outlives its client's disconnect without anyone resuming it
+RAG_RESUME_BLOCK_MS = 1000 # XREAD block while a resumed client waits for the next frame
+
 REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD')
-REDIS_CLOUD = redis.Redis(
-    host=REDIS_HOST,
-    port=15617,
+REDIS_PORT = 15617
+REDIS_MAX_CONNECTIONS = 50 # sync pool per worker process, used by views and background jobs
+REDIS_ASYNC_MAX_CONNECTIONS = 200 # async pool per event loop, used by the websocket consumers
+REDIS_POOL_TIMEOUT = 5 # seconds to wait for a free pooled connection
+REDIS_SOCKET_TIMEOUT = 5 # seconds per command
+REDIS_CONNECT_TIMEOUT = 2
+REDIS_HEALTH_CHECK_INTERVAL = 30 # idle connections are PINGed before reuse after this many seconds
+REDIS_OPTIONS = {
+    "host": REDIS_HOST,
+    "port": REDIS_PORT,
+    "username": "default",
+    "password": REDIS_PASSWORD,
+    "socket_timeout": REDIS_SOCKET_TIMEOUT,
+    "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+    "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    "retry_on_timeout": True,
+}
+REDIS_CLOUD = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
     decode_responses=True,
-    username="default",
-    password=REDIS_PASSWORD,
-)
+    **REDIS_OPTIONS,
+))
+# same server, raw bytes: corpus and chunk values are stored compressed (rag.corpus)
+REDIS_BINARY = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    **REDIS_OPTIONS,
+))
+RAG_COMPRESS_MIN_BYTES = 2048 # smaller values are stored uncompressed
+RAG_ZLIB_LEVEL = 6
+
+# progress of background ingestion jobs is published to the project's channel group
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [f"redis://default:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}"]},
+    }
+}
+
+# INGESTION
+RAG_INGEST_WORKERS = 4 # background threads reading, chunking and indexing uploaded files
+RAG_READ_WORKERS = 8 # files fetched from storage at once during a rebuild
+RAG_JOB_STALE_AFTER = 3600 # seconds without progress before a queued/running job left by a restart is failed
+
+# RETRIEVAL
+RAG_CHUNK_SIZE = 1500 # characters per chunk
+RAG_CHUNK_OVERLAP = 200 # characters shared by neighbouring chunks
+RAG_RETRIEVAL_DEPTH = 40 # ranked candidates handed to the context packer
+RAG_CONTEXT_MAX_TOKENS = 24_000 # upper bound on retrieved context, whatever the window
+RAG_INDEX_ROOT = BASE_DIR / "indexes" if DEBUG else STATDIR / "indexes" # per-project index files
+RAG_INDEX_CACHE_SIZE = 32 # loaded indexes kept per worker
+RAG_BM25_K1 = 1.2
+RAG_BM25_B = 0.75
+RAG_BM25_MERGE_FACTOR = 4 # segments of one size tier merged together
+RAG_INDEX_COMPACT_RATIO = 0.25 # deleted share that triggers compaction
+RAG_TOKEN_ENCODING = "cl100k_base"
+RAG_EMBEDDING_FUNCTION = "rag.embeddings.hashing_embed" # callable(list[str]) -> float32 (n, dim)
+RAG_EMBEDDING_DIM = 256
+RAG_HNSW_M = 16 # graph degree, layer 0 keeps 2 * M links
+RAG_HNSW_EF_CONSTRUCTION = 100
+RAG_HNSW_BUILD_PROBES = 8 # k-means cells compared per cell when a large layer is linked in bulk
+RAG_HNSW_EF_SEARCH = 64 # higher = better recall, slower search
+RAG_IVF_NLIST = 0 # k-means lists, 0 = 4 * sqrt(chunks)
+RAG_IVF_NPROBE = 32 # lists scanned per query, at least; large projects scan nlist / 16
+RAG_IVF_RETRAIN_GROWTH = 2 # retrain the lists once the project wants this many times the trained count
+RAG_PQ_SUBSPACES = 32 # product quantization bytes per vector
+RAG_QUANTIZE_MIN_ROWS = 4096 # smaller indexes stay float32, codebooks fitted on a few chunks lose most of the recall
+RAG_QUANTIZE_RETRAIN_GROWTH = 2 # refit the quantizer once the index holds this many times the rows it was fitted on
+RAG_RERANK_CANDIDATES = 100 # quantized hits re-scored against float32 vectors
+RAG_RETRIEVAL_THREADS = 8
+RAG_RRF_K = 60 # reciprocal-rank fusion damping
+RAG_RERANKER = "rag.rerank.overlap_rerank" # callable(query, list[chunk]) -> list[float]
+RAG_RERANK_DEPTH = 30 # fused candidates passed through the reranker
+RAG_RESPONSE_CACHE = True # replay answers to repeated questions on an unchanged corpus
+RAG_RESPONSE_CACHE_TTL = 24 * 3600 # seconds
+RAG_RESPONSE_CACHE_SIZE = 500 # answers kept per project, least recently used evicted
+RAG_SEMANTIC_CACHE = False # also serve answers to paraphrased questions
+RAG_SEMANTIC_CACHE_THRESHOLD = 0.92 # cosine similarity of the questions' embeddings
+RAG_SEMANTIC_CACHE_SIZE = 200 # questions kept per project, least recently used evicted
+RAG_PROMPT_CACHE = True # mark the instruction + context prefix cacheable where the provider needs it (Anthropic)
+RAG_PREFIX_CACHE_SIZE = 16 # rendered corpus-blob prefixes kept per worker, keyed by corpus version
+RAG_HISTORY_TURNS = 6 # most recent messages always kept verbatim
+RAG_HISTORY_MAX_TOKENS = 3000 # summary + verbatim messages; over it, older messages are folded into the summary
+RAG_HISTORY_SUMMARY_TOKENS = 600 # upper bound on the rolling summary
+RAG_HISTORY_SUMMARIZER = "rag.history.extractive_summary" # callable(summary, list[message], max_tokens) -> str
+RAG_HISTORY_TTL = 7 * 24 * 3600 # seconds a conversation's summary is kept after its last use
+RAG_CONVERSATION_TTL = 30 * 24 * 3600 # seconds a stored conversation is kept after its last turn
 
 
 TEMPLATES = [
@@ -0,0 +1,514 @@
+from django.conf import settings
+import heapq
+import math
+import time
+import numpy as np
+from .indexes import atomic_save
+from .vector_index import FlatIndex, top_k, save_npy, append_npy
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), batch_size):
+        assign[i:i + batch_size] = np.argmax(np.asarray(vectors[i:i + batch_size]) @ centroids.T, axis=1)
+    return assign
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_clusters * 64)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=n_clusters)
+
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+
+    return centroids.astype(np.float32)
+
+
+def nearest_neighbours(vectors: np.ndarray, members: np.ndarray, k: int, block_size: int = 1024,
+                       exact_max: int = 10_000) -> tuple:
+    """
+    The k nearest other members of every member, as (ids, distances) sorted
+    closest first and padded with -1 / inf. Exact up to `exact_max` members;
+    above that each k-means cell is only compared with the cells around it,
+    which is approximate but keeps every step a matrix product.
+    """
+    k = min(k, len(members) - 1)
+    ids = np.full((len(members), k), -1, dtype=np.int32)
+    dists = np.full((len(members), k), np.inf, dtype=np.float32)
+    if k <= 0:
+        return ids, dists
+    points = np.asarray(vectors[members], dtype=np.float32)
+
+    def search(queries: np.ndarray, pool: np.ndarray):
+        for i in range(0, len(queries), block_size):
+            rows = queries[i:i + block_size]
+            sims = points[rows] @ points[pool].T
+            sims[pool[None, :] == rows[:, None]] = -np.inf
+            best = np.argpartition(-sims, k - 1, axis=1)[:, :k] if len(pool) > k else np.argsort(-sims, axis=1)[:, :k]
+            best_sims = np.take_along_axis(sims, best, axis=1)
+            order = np.argsort(-best_sims, axis=1, kind="stable")
+            count = order.shape[1]
+            ids[rows, :count] = members[pool[np.take_along_axis(best, order, axis=1)]]
+            dists[rows, :count] = 1.0 - np.take_along_axis(best_sims, order, axis=1)
+
+    if len(members) <= exact_max:
+        search(np.arange(len(members)), np.arange(len(members)))
+    else:
+        n_cells = max(2, int(math.sqrt(len(members))))
+        centroids = spherical_kmeans(points, n_cells)
+        assign = nearest_centroids(points, centroids)
+        cells = [np.flatnonzero(assign == c) for c in range(n_cells)]
+        around = np.argsort(-(centroids @ centroids.T), axis=1)[:, :settings.RAG_HNSW_BUILD_PROBES]
+        for c, rows in enumerate(cells):
+            if len(rows):
+                search(rows, np.concatenate([cells[other] for other in around[c]]))
+
+    # cells smaller than k leave the query itself, or nothing, in the last slots
+    ids[~np.isfinite(dists)] = -1
+    return ids, dists
+
+
+def prune_links(vectors: np.ndarray, ids: np.ndarray, dists: np.ndarray, m: int, batch_size: int = 256) -> np.ndarray:
+    """
+    HNSW's diversity heuristic for many nodes at once: scanning each row's
+    candidates closest first, keep one only if it is closer to the base node
+    than to every candidate already kept, then top up with the rest. `ids` is
+    sorted by `dists` and padded with -1; returns (rows, m) padded with -1.
+    """
+    width = ids.shape[1]
+    links = np.full((len(ids), m), -1, dtype=np.int32)
+    if not width:
+        return links
+    for i in range(0, len(ids), batch_size):
+        cand = ids[i:i + batch_size]
+        valid = cand >= 0
+        rows = np.asarray(vectors[np.where(valid, cand, 0).ravel()], dtype=np.float32).reshape(cand.shape + (-1,))
+        sims = rows @ rows.transpose(0, 2, 1)
+        bound = np.where(valid, 1.0 - dists[i:i + batch_size], -np.inf)
+
+        closest = np.full(cand.shape, -np.inf, dtype=np.float32)
+        kept = np.zeros(cand.shape, dtype=bool)
+        count = np.zeros(len(cand), dtype=np.int32)
+        for j in range(width):
+            take = (closest[:, j] < bound[:, j]) & (count < m)
+            kept[:, j] = take
+            count += take
+            closest = np.where(take[:, None], np.maximum(closest, sims[:, j]), closest)
+
+        rank = np.where(kept, 0, np.where(valid, 1, 2)) * width + np.arange(width)
+        order = np.argsort(rank, axis=1)[:, :m]
+        chosen = np.take_along_axis(cand, order, axis=1)
+        chosen[np.take_along_axis(~valid, order, axis=1)] = -1
+        links[i:i + batch_size, :chosen.shape[1]] = chosen
+    return links
+
+
+class IVFFlatIndex(FlatIndex):
+    """
+    Inverted-file index: vectors are bucketed by their nearest k-means centroid
+    and a query scans only the `nprobe` buckets closest to it.
+    """
+    kind = "ivf"
+
+    def __init__(self, vectors, file_ids, positions, quantizer=None, codes=None, deleted=None,
+                 centroids=None, assign=None):
+        super().__init__(vectors, file_ids, positions, quantizer, codes, deleted)
+        self.centroids = centroids
+        self.assign = np.zeros(0, dtype=np.int32) if assign is None else assign
+        self._lists = None
+
+    def structure(self) -> dict:
+        return {"centroids": self.centroids, "assign": self.assign}
+
+    def n_lists(self) -> int:
+        n_lists = settings.RAG_IVF_NLIST or int(4 * math.sqrt(len(self)))
+        return max(1, min(n_lists, len(self)))
+
+    def train(self):
+        self.centroids = spherical_kmeans(self.vectors, self.n_lists())
+        self.assign = np.zeros(0, dtype=np.int32)
+
+    def link(self, ids: np.ndarray):
+        # lists trained on the first upload are retrained once the project has
+        # grown enough to want RAG_IVF_RETRAIN_GROWTH times as many of them
+        if self.centroids is None or self.n_lists() >= settings.RAG_IVF_RETRAIN_GROWTH * len(self.centroids):
+            if not len(self):
+                return
+            self.train()
+            ids = np.arange(len(self))
+
+        grown = np.full(len(self), -1, dtype=np.int32)
+        grown[:len(self.assign)] = self.assign
+        grown[ids] = nearest_centroids(self.vectors[ids], self.centroids)
+        self.assign = grown
+        self._lists = None
+
+    def lists(self):
+        if self._lists is None:
+            members = np.argsort(self.assign, kind="stable").astype(np.int32)
+            ptr = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.assign, minlength=len(self.centroids)), out=ptr[1:])
+            self._lists = (ptr, members)
+        return self._lists
+
+    def search_vector(self, query: np.ndarray, k: int, nprobe: int = None, rerank: int = None, **params) -> list:
+        if not len(self) or self.centroids is None:
+            return []
+
+        nprobe = min(nprobe or max(settings.RAG_IVF_NPROBE, len(self.centroids) // 16), len(self.centroids))
+        ptr, members = self.lists()
+        probes = top_k(self.centroids @ query, nprobe)
+
+        candidates = np.concatenate([members[ptr[p]:ptr[p + 1]] for p in probes])
+        candidates.sort()
+        return self.rescore(candidates, query, k, rerank)
+
+    def save_structure(self, path, start: int = 0):
+        if self.centroids is None:
+            return
+        # a retrain always changes the list count, and then every row moves
+        centroids = path / "centroids.npy"
+        if start and centroids.exists() and np.load(centroids, mmap_mode="r").shape == self.centroids.shape:
+            append_npy(path / "assign.npy", self.assign[start:])
+            return
+        save_npy(path / "centroids.npy", self.centroids)
+        save_npy(path / "assign.npy", self.assign)
+
+    @classmethod
+    def load_structure(cls, path, count: int) -> dict:
+        if not (path / "centroids.npy").exists():
+            return {}
+        return {"centroids": np.load(path / "centroids.npy"), "assign": np.load(path / "assign.npy")[:count]}
+
+
+class HNSWIndex(FlatIndex):
+    """
+    Hierarchical navigable small-world graph (Malkov & Yashunin).
+
+    Layer 0 links are a dense (n, 2M) int32 matrix padded with -1; the sparse
+    upper layers are dicts of node -> neighbour list. Distances are
+    1 - cosine, computed in batches per expanded node. The graph walk always
+    reads float32 rows, so quantized storage does not apply to this kind.
+
+    Builds and compactions link every node at once with matrix products
+    (`build_graph`); only small appends are inserted node by node.
+    """
+    kind = "hnsw"
+    quantizable = False
+
+    def __init__(self, vectors, file_ids, positions, quantizer=None, codes=None, deleted=None, levels=None,
+                 links0=None, upper=None, entry=-1, m=None, ef_construction=None):
+        super().__init__(vectors, file_ids, positions, deleted=deleted)
+        self.m = m or settings.RAG_HNSW_M
+        self.ef_construction = ef_construction or settings.RAG_HNSW_EF_CONSTRUCTION
+        self.levels = np.zeros(0, dtype=np.int8) if levels is None else levels
+        self.links0 = np.full((0, 2 * self.m), -1, dtype=np.int32) if links0 is None else links0
+        self.upper = upper or []
+        self.entry = int(entry)
+
+    def structure(self) -> dict:
+        # copies, so linking new nodes never touches an instance other threads may be searching
+        return {
+            "levels": self.levels.copy(),
+            "links0": self.links0.copy(),
+            "upper": [dict(links) for links in self.upper],
+            "entry": self.entry,
+            "m": self.m,
+            "ef_construction": self.ef_construction,
+        }
+
+    @property
+    def max_level(self) -> int:
+        return int(self.levels[self.entry]) if self.entry >= 0 else -1
+
+    def neighbours(self, node: int, level: int) -> list:
+        if level == 0:
+            row = self.links0[node]
+            return row[row >= 0].tolist()
+        return self.upper[level - 1].get(node, [])
+
+    def set_neighbours(self, node: int, level: int, nodes: list):
+        if level == 0:
+            self.links0[node] = -1
+            self.links0[node, :len(nodes)] = nodes
+        else:
+            self.upper[level - 1][node] = list(nodes)
+
+    def search_layer(self, query: np.ndarray, entry_points: list, ef: int, level: int) -> list:
+        visited = set(entry_points)
+        dists = (1.0 - self.vectors[entry_points] @ query).tolist()
+        candidates = list(zip(dists, entry_points))
+        heapq.heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+
+            fresh = [n for n in self.neighbours(node, level) if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+
+            worst = -results[0][0]
+            for d, n in zip((1.0 - self.vectors[fresh] @ query).tolist(), fresh):
+                if len(results) < ef or d < worst:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+                    worst = -results[0][0]
+
+        return sorted((-d, n) for d, n in results)
+
+    def select_neighbours(self, found: list, m: int) -> list:
+        """Diversity heuristic: keep a candidate only if it is closer to the base
+        node than to every neighbour already kept, then top up with the rest."""
+        if len(found) <= m:
+            return [n for _, n in found]
+
+        nodes = [n for _, n in found]
+        vectors = np.asarray(self.vectors[nodes])
+        bound = 1.0 - np.asarray([d for d, _ in found], dtype=np.float32)
+        # each candidate's highest similarity to a kept neighbour, updated per
+        # kept node, so the scan jumps straight to the next candidate that passes
+        closest = np.full(len(nodes), -np.inf, dtype=np.float32)
+        kept, j = [], 0
+        while len(kept) < m:
+            passing = np.flatnonzero(closest[j:] < bound[j:])
+            if not len(passing):
+                break
+            j += int(passing[0])
+            kept.append(j)
+            np.maximum(closest, vectors @ vectors[j], out=closest)
+            j += 1
+
+        if len(kept) < m:
+            chosen = set(kept)
+            kept += [i for i in range(len(nodes)) if i not in chosen][:m - len(kept)]
+        return [nodes[j] for j in kept]
+
+    def link(self, ids: np.ndarray):
+        n = len(self)
+        if len(self.levels) < n:
+            rng = np.random.default_rng(len(self.levels))
+            new_levels = np.floor(-np.log(1.0 - rng.random(n - len(self.levels))) / math.log(self.m))
+            self.levels = np.concatenate([self.levels, np.minimum(new_levels, 32).astype(np.int8)])
+        if len(self.links0) < n:
+            grown = np.full((n, 2 * self.m), -1, dtype=np.int32)
+            grown[:len(self.links0)] = self.links0
+            self.links0 = grown
+
+        # inserting costs about eight times what linking in bulk does per node,
+        # so a fresh graph, or a batch over an eighth of it, is relinked in bulk
+        if self.entry < 0 or 8 * len(ids) > n:
+            self.build_graph()
+            return
+        for node in ids.tolist():
+            self.insert(node)
+
+    def build_graph(self):
+        """
+        Link every node at once. Each layer's nodes get their nearest
+        neighbours among that layer from matrix products, the diversity
+        heuristic picks M of them, and the reverse links are merged in and
+        pruned again to the layer's capacity, as insertion would leave them.
+        """
+        n = len(self)
+        top = int(self.levels[:n].max()) if n else -1
+        self.links0 = np.full((n, 2 * self.m), -1, dtype=np.int32)
+        self.upper = [{} for _ in range(max(top, 0))]
+        self.entry = int(np.argmax(self.levels[:n])) if n else -1
+
+        for layer in range(top, -1, -1):
+            members = np.flatnonzero(self.levels[:n] >= layer).astype(np.int32)
+            capacity = 2 * self.m if layer == 0 else self.m
+            ids, dists = nearest_neighbours(self.vectors, members, self.ef_construction)
+            forward = prune_links(self.vectors, ids, dists, capacity)
+
+            # every forward link is also offered to its target, and the layer
+            # above's links, which span farther, are offered again here: a
+            # nearest-neighbour graph alone falls apart into its clusters
+            src = np.repeat(members, forward.shape[1])
+            dst = forward.ravel()
+            if layer < top:
+                above = self.upper[layer]
+                src = np.concatenate([src, np.asarray([a for a, links in above.items() for _ in links], dtype=np.int32)])
+                dst = np.concatenate([dst, np.asarray([b for links in above.values() for b in links], dtype=np.int32)])
+            src, dst = src[dst >= 0], dst[dst >= 0]
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+            pairs = np.unique(src.astype(np.int64) * n + dst)
+            src, dst = (pairs // n).astype(np.int32), (pairs % n).astype(np.int32)
+            dist = np.empty(len(src), dtype=np.float32)
+            for i in range(0, len(src), 65536):
+                a, b = src[i:i + 65536], dst[i:i + 65536]
+                dist[i:i + 65536] = 1.0 - np.einsum("ij,ij->i", self.vectors[a], self.vectors[b])
+
+            # one row of candidates per member, closest first, capped at twice the capacity
+            order = np.lexsort((dist, src))
+            src, dst, dist = src[order], dst[order], dist[order]
+            row = np.searchsorted(members, src)
+            starts = np.searchsorted(row, np.arange(len(members)))
+            slot = np.arange(len(row)) - starts[row]
+            width = 2 * capacity
+            keep = slot < width
+            cand = np.full((len(members), width), -1, dtype=np.int32)
+            cand_dists = np.full((len(members), width), np.inf, dtype=np.float32)
+            cand[row[keep], slot[keep]] = dst[keep]
+            cand_dists[row[keep], slot[keep]] = dist[keep]
+
+            links = prune_links(self.vectors, cand, cand_dists, capacity)
+            if layer == 0:
+                self.links0[members] = links
+            else:
+                self.upper[layer - 1] = {node: r[r >= 0].tolist() for node, r in zip(members.tolist(), links)}
+
+    def insert(self, node: int):
+        level = int(self.levels[node])
+        while len(self.upper) < level:
+            self.upper.append({})
+
+        if self.entry < 0:
+            self.entry = node
+            return
+
+        query = np.asarray(self.vectors[node])
+        entry_points = [self.entry]
+        for layer in range(self.max_level, level, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self.search_layer(query, entry_points, self.ef_construction, layer)
+            capacity = 2 * self.m if layer == 0 else self.m
+            selected = self.select_neighbours(found, self.m)
+            self.set_neighbours(node, layer, selected)
+
+            full = []
+            for other in selected:
+                links = self.neighbours(other, layer) + [node]
+                if len(links) > capacity:
+                    full.append((other, links))
+                else:
+                    self.set_neighbours(other, layer, links)
+
+            # neighbours pushed over capacity are pruned together
+            if full:
+                others = np.asarray([other for other, _ in full])
+                cand = np.asarray([links for _, links in full], dtype=np.int32)
+                dists = 1.0 - np.einsum("ijk,ik->ij", np.asarray(self.vectors[cand.ravel()]).reshape(cand.shape + (-1,)),
+                                        np.asarray(self.vectors[others]))
+                order = np.argsort(dists, axis=1, kind="stable")
+                pruned = prune_links(self.vectors, np.take_along_axis(cand, order, axis=1),
+                                     np.take_along_axis(dists, order, axis=1), capacity)
+                for other, links in zip(others.tolist(), pruned):
+                    self.set_neighbours(other, layer, links[links >= 0].tolist())
+
+            entry_points = [n for _, n in found]
+
+        if level > self.max_level:
+            self.entry = node
+
+    def search_vector(self, query: np.ndarray, k: int, ef_search: int = None, **params) -> list:
+        if self.entry < 0:
+            return []
+
+        ef = max(ef_search or settings.RAG_HNSW_EF_SEARCH, k)
+        entry_points = [self.entry]
+        for layer in range(self.max_level, 0, -1):
+            entry_points = [n for _, n in self.search_layer(query, entry_points, self.m, layer)]
+
+        found = self.search_layer(query, entry_points, ef, 0)
+        if self.alive is not None:
+            # deleted nodes still route the walk, they are only dropped from the results
+            found = [(d, n) for d, n in found if self.alive[n]]
+        found = found[:k]
+        return self.refs([n for _, n in found], [1.0 - d for d, _ in found])
+
+    def save_structure(self, path, start: int = 0):
+        arrays = {"levels": self.levels, "links0": self.links0, "entry": self.entry,
+                  "m": self.m, "ef_construction": self.ef_construction}
+        for layer, links in enumerate(self.upper, start=1):
+            nodes = np.asarray(sorted(links), dtype=np.int32)
+            padded = np.full((len(nodes), self.m), -1, dtype=np.int32)
+            for row, node in enumerate(nodes.tolist()):
+                padded[row, :len(links[node])] = links[node]
+            arrays[f"upper_nodes_{layer}"] = nodes
+            arrays[f"upper_links_{layer}"] = padded
+
+        atomic_save(path / "hnsw.npz", lambda f: np.savez(f, **arrays))
+
+    @classmethod
+    def load_structure(cls, path, count: int) -> dict:
+        with np.load(path / "hnsw.npz") as data:
+            upper = []
+            layer = 1
+            while f"upper_nodes_{layer}" in data:
+                upper.append({
+                    node: row[row >= 0].tolist()
+                    for node, row in zip(data[f"upper_nodes_{layer}"].tolist(), data[f"upper_links_{layer}"])
+                })
+                layer += 1
+
+            return {
+                "levels": data["levels"],
+                "links0": data["links0"],
+                "upper": upper,
+                "entry": int(data["entry"]),
+                "m": int(data["m"]),
+                "ef_construction": int(data["ef_construction"]),
+            }
+
+
+def synthetic_vectors(size: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Unit vectors scattered around size // 500 random centres, closer to
+    real embeddings than uniform noise; used when benchmarking without a project."""
+    centres = rng.normal(size=(max(1, size // 500), dim))
+    vectors = centres[rng.integers(len(centres), size=size)] + rng.normal(scale=0.6, size=(size, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def recall_report(index: FlatIndex, queries: np.ndarray, k: int = 10, sweep: list = None) -> list:
+    """
+    Recall@k and latency of an ANN index against exact search on the same
+    vectors, for each knob setting in `sweep` (ef_search for HNSW, nprobe for IVF).
+    """
+    exact = FlatIndex(index.vectors, index.file_ids, index.positions)
+    knob = "ef_search" if index.kind == "hnsw" else "nprobe"
+
+    truth = []
+    started = time.perf_counter()
+    for query in queries:
+        truth.append({(file_id, pos) for file_id, pos, _ in exact.search_vector(query, k)})
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    rows = []
+    for value in sweep or ([16, 32, 64, 128, 256] if knob == "ef_search" else [1, 2, 4, 8, 16, 32]):
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = index.search_vector(query, k, **{knob: value})
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(expected & {(file_id, pos) for file_id, pos, _ in found})
+
+        rows.append({
+            knob: value,
+            "recall": hits / (len(queries) * k),
+            "mean_ms": float(np.mean(latencies)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "exact_ms": exact_ms,
+        })
+    return rows
@@ -0,0 +1,107 @@
+from django.conf import settings
+import time
+import uuid
+from .redis_client import get_async_redis
+
+# every generation's frames go to a Redis Stream, so a client that lost its
+# socket, or another tab of the project, can read the answer from any offset
+# instead of asking again. A closing entry without a frame marks the end.
+
+
+def stream_key(project_id, stream_id) -> str:
+    return f"{project_id}:answer_stream:{stream_id}"
+
+
+def readers_key(project_id, stream_id) -> str:
+    return f"{project_id}:answer_stream:{stream_id}:readers"
+
+
+def index_key(project_id) -> str:
+    return f"{project_id}:answer_streams"
+
+
+def new_stream_id() -> str:
+    return uuid.uuid4().hex
+
+
+async def start(project_id, stream_id):
+    redis = get_async_redis()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(index_key(project_id), "-inf", time.time() - settings.RAG_RESUME_TTL)
+        pipe.zadd(index_key(project_id), {stream_id: time.time()})
+        pipe.expire(index_key(project_id), settings.RAG_RESUME_TTL)
+        await pipe.execute()
+
+
+async def append(project_id, stream_id, frame: str) -> str:
+    """Record a frame and return its offset."""
+    key = stream_key(project_id, stream_id)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.xadd(key, {"frame": frame}, maxlen=settings.RAG_RESUME_MAXLEN, approximate=True)
+        pipe.expire(key, settings.RAG_RESUME_TTL)
+        offset, _ = await pipe.execute()
+    return offset
+
+
+async def finish(project_id, stream_id):
+    key = stream_key(project_id, stream_id)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.xadd(key, {"end": "1"}, maxlen=settings.RAG_RESUME_MAXLEN, approximate=True)
+        pipe.expire(key, settings.RAG_RESUME_TTL)
+        pipe.zrem(index_key(project_id), stream_id)
+        await pipe.execute()
+
+
+async def exists(project_id, stream_id) -> bool:
+    return bool(await get_async_redis().exists(stream_key(project_id, stream_id)))
+
+
+async def read(project_id, stream_id, offset: str = "0", reader: str = None):
+    """
+    Yield (offset, frame) from after `offset` until the generation ends. Gives
+    up when the stream expired, or when no frame came for
+    RAG_PROVIDER_TIMEOUT seconds (the generating worker is gone). `reader`
+    is registered while reading, which keeps a detached generation going.
+    """
+    redis = get_async_redis()
+    key = stream_key(project_id, stream_id)
+    idle_since = time.monotonic()
+    while time.monotonic() - idle_since < settings.RAG_PROVIDER_TIMEOUT:
+        if reader:
+            await touch_reader(project_id, stream_id, reader)
+        result = await redis.xread({key: offset}, count=100, block=settings.RAG_RESUME_BLOCK_MS)
+        if not result:
+            if not await redis.exists(key):
+                return
+            continue
+
+        idle_since = time.monotonic()
+        for offset, fields in result[0][1]:
+            if "end" in fields:
+                return
+            yield offset, fields["frame"]
+
+
+async def touch_reader(project_id, stream_id, reader: str):
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zadd(readers_key(project_id, stream_id), {reader: time.time()})
+        pipe.expire(readers_key(project_id, stream_id), settings.RAG_RESUME_TTL)
+        await pipe.execute()
+
+
+async def drop_reader(project_id, stream_id, reader: str):
+    await get_async_redis().zrem(readers_key(project_id, stream_id), reader)
+
+
+async def has_readers(project_id, stream_id) -> bool:
+    """Whether a client read the generation within the last RAG_RESUME_GRACE seconds."""
+    recent = await get_async_redis().zcount(readers_key(project_id, stream_id), time.time() - settings.RAG_RESUME_GRACE, "+inf")
+    return recent > 0
+
+
+def active_streams(project_id) -> list:
+    """Generations of the project still streaming, oldest first."""
+    entries = settings.REDIS_CLOUD.zrangebyscore(
+        index_key(project_id), time.time() - settings.RAG_RESUME_TTL, "+inf", withscores=True
+    )
+    return [{"stream": stream_id, "started": started} for stream_id, started in entries]
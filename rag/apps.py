@@ -6,4 +6,6 @@ class RagConfig(AppConfig):
     name = 'rag'
 
     def ready(self):
-        import rag.signals
\ No newline at end of file
+        import rag.signals
+        from rag import providers
+        providers.warm()
\ No newline at end of file
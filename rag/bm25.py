@@ -0,0 +1,289 @@
+from django.conf import settings
+from collections import Counter
+import json
+import math
+import re
+import uuid
+import numpy as np
+from .indexes import index_dir, atomic_save, IndexCache
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+
+_cache = IndexCache()
+_segments = IndexCache(settings.RAG_INDEX_CACHE_SIZE * 8)
+
+
+def tokenize(text: str) -> list:
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Segment:
+    """
+    Immutable slice of a project's BM25 postings.
+
+    Postings are kept in CSR form: the postings of term `t` are
+    `doc_ids[term_ptr[t]:term_ptr[t + 1]]` with matching `tfs`. A document is a
+    chunk, identified by (file_ids[doc], positions[doc]) in the chunk store.
+    """
+
+    def __init__(self, terms, term_ptr, doc_ids, tfs, doc_len, file_ids, positions, name=None):
+        self.terms = terms
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.file_ids = file_ids
+        self.positions = positions
+        self.name = name
+        self.vocab = {term: i for i, term in enumerate(terms.tolist())}
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @classmethod
+    def from_triples(cls, terms: list, term_col, doc_col, tf_col, doc_len, file_ids, positions):
+        term_col = np.asarray(term_col, dtype=np.int32)
+        order = np.argsort(term_col, kind="stable")
+        term_ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_col, minlength=len(terms)), out=term_ptr[1:])
+
+        return cls(
+            terms=np.asarray(terms, dtype=str),
+            term_ptr=term_ptr,
+            doc_ids=np.asarray(doc_col, dtype=np.int32)[order],
+            tfs=np.asarray(tf_col, dtype=np.float32)[order],
+            doc_len=np.asarray(doc_len, dtype=np.float32),
+            file_ids=np.asarray(file_ids, dtype="U36"),
+            positions=np.asarray(positions, dtype=np.int32),
+        )
+
+    @classmethod
+    def build(cls, chunks: list):
+        vocab = {}
+        terms, docs, counts = [], [], []
+        doc_len = []
+
+        for doc, chunk in enumerate(chunks):
+            tokens = tokenize(chunk["text"])
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                terms.append(vocab.setdefault(term, len(vocab)))
+                docs.append(doc)
+                counts.append(tf)
+
+        return cls.from_triples(
+            list(vocab), terms, docs, counts, doc_len,
+            [chunk["file_id"] for chunk in chunks],
+            [chunk["position"] for chunk in chunks],
+        )
+
+    @classmethod
+    def merge(cls, segments: list, deleted: set):
+        """Merge segments into one, dropping documents of deleted files."""
+        vocab = {}
+        term_cols, doc_cols, tf_cols = [], [], []
+        doc_len, file_ids, positions = [], [], []
+        offset = 0
+
+        for segment in segments:
+            remap = np.asarray([vocab.setdefault(term, len(vocab)) for term in segment.terms.tolist()], dtype=np.int32)
+            alive = ~np.isin(segment.file_ids, list(deleted)) if deleted else np.ones(len(segment), dtype=bool)
+            new_doc = np.cumsum(alive) - 1 + offset
+
+            posting_terms = np.repeat(np.arange(len(segment.terms)), np.diff(segment.term_ptr))
+            keep = alive[segment.doc_ids]
+            term_cols.append(remap[posting_terms[keep]])
+            doc_cols.append(new_doc[segment.doc_ids[keep]])
+            tf_cols.append(segment.tfs[keep])
+
+            doc_len.append(segment.doc_len[alive])
+            file_ids.append(segment.file_ids[alive])
+            positions.append(segment.positions[alive])
+            offset += int(alive.sum())
+
+        return cls.from_triples(
+            list(vocab),
+            np.concatenate(term_cols) if term_cols else [],
+            np.concatenate(doc_cols) if doc_cols else [],
+            np.concatenate(tf_cols) if tf_cols else [],
+            np.concatenate(doc_len) if doc_len else [],
+            np.concatenate(file_ids) if file_ids else [],
+            np.concatenate(positions) if positions else [],
+        )
+
+    def postings(self, term: str):
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return None
+        lo, hi = self.term_ptr[term_id], self.term_ptr[term_id + 1]
+        return self.doc_ids[lo:hi], self.tfs[lo:hi]
+
+    def save(self, path):
+        atomic_save(path, lambda f: np.savez(
+            f,
+            terms=self.terms,
+            term_ptr=self.term_ptr,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_len=self.doc_len,
+            file_ids=self.file_ids,
+            positions=self.positions,
+        ))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(name=path.name, **{key: data[key] for key in data.files})
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a project's chunks, stored as a list of immutable segments
+    plus a set of deleted file ids (tombstones).
+
+    Adding a file writes one small segment; removing one only records a
+    tombstone. Segments of similar size are merged log-structured style, so
+    each chunk is rewritten O(log n) times over the life of the project.
+    """
+
+    def __init__(self, segments: list, deleted: set = None):
+        self.segments = segments
+        self.deleted = set(deleted or ())
+
+        self.k1 = settings.RAG_BM25_K1
+        self.b = settings.RAG_BM25_B
+        self.n_docs = sum(len(segment) for segment in segments)
+        total_len = sum(float(segment.doc_len.sum()) for segment in segments)
+        self.avg_len = total_len / self.n_docs if self.n_docs else 0.0
+        self.alive = [
+            ~np.isin(segment.file_ids, list(self.deleted)) if self.deleted else None
+            for segment in segments
+        ]
+
+    def __len__(self):
+        return self.n_docs
+
+    @classmethod
+    def build(cls, chunks: list):
+        return cls([BM25Segment.build(chunks)])
+
+    def search(self, query: str, k: int) -> list:
+        """Return up to k (file_id, position, score) tuples, best first."""
+        terms = set(tokenize(query))
+        postings = [{term: segment.postings(term) for term in terms} for segment in self.segments]
+
+        # idf is computed over the whole index so segment scores are comparable
+        df = {term: sum(len(p[term][0]) for p in postings if p[term] is not None) for term in terms}
+        avg_len = max(self.avg_len, 1.0)
+
+        hits = []
+        for segment, segment_postings, alive in zip(self.segments, postings, self.alive):
+            scores = np.zeros(len(segment), dtype=np.float32)
+
+            for term, found in segment_postings.items():
+                if found is None:
+                    continue
+                docs, tfs = found
+                idf = np.log(1.0 + (self.n_docs - df[term] + 0.5) / (df[term] + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * segment.doc_len[docs] / avg_len)
+                # a term occurs at most once per doc in its postings, so plain fancy-index add is safe
+                scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+            if alive is not None:
+                scores[~alive] = 0.0
+
+            best = np.flatnonzero(scores)
+            if len(best) > k:
+                best = best[np.argpartition(-scores[best], k - 1)[:k]]
+            hits.extend((str(segment.file_ids[d]), int(segment.positions[d]), float(scores[d])) for d in best)
+
+        hits.sort(key=lambda hit: -hit[2])
+        return hits[:k]
+
+    def add(self, project_id, chunks: list):
+        """Return the index with chunks added as a new segment, saved. The loaded
+        (and possibly shared) instance is left untouched."""
+        segments = self.segments + ([BM25Segment.build(chunks)] if chunks else [])
+        updated = merge_segments(segments, self.deleted)
+        updated.save(project_id)
+        return updated
+
+    def remove(self, project_id, file_id):
+        updated = merge_segments(self.segments, self.deleted | {str(file_id)})
+        updated.save(project_id)
+        return updated
+
+    def save(self, project_id):
+        path = index_dir(project_id)
+        for segment in self.segments:
+            if segment.name is None:
+                segment.name = f"bm25-{uuid.uuid4().hex[:12]}.npz"
+                segment.save(path / segment.name)
+
+        try:
+            replaced = (path / "bm25.json").stat().st_mtime_ns
+        except FileNotFoundError:
+            replaced = None
+
+        manifest = {"segments": [segment.name for segment in self.segments], "deleted": sorted(self.deleted)}
+        atomic_save(path / "bm25.json", lambda f: f.write(json.dumps(manifest).encode()))
+
+        # segments merged away are no longer referenced by the manifest; ones
+        # newer than the manifest this save replaces belong to another writer
+        current = set(manifest["segments"])
+        for stale in path.glob("bm25-*.npz"):
+            if stale.name in current:
+                continue
+            try:
+                if replaced is None or stale.stat().st_mtime_ns > replaced:
+                    continue
+            except FileNotFoundError:
+                continue
+            stale.unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path):
+        manifest = json.loads(path.read_text())
+        segments = [_segments.get(path.with_name(name), BM25Segment.load) for name in manifest["segments"]]
+        if any(segment is None for segment in segments):
+            return None
+        return cls(segments, set(manifest["deleted"]))
+
+
+def merge_segments(segments: list, deleted: set) -> BM25Index:
+    """Merge any `RAG_BM25_MERGE_FACTOR` segments of the same size tier and
+    compact segments that are mostly tombstones."""
+    factor = settings.RAG_BM25_MERGE_FACTOR
+    segments = list(segments)
+
+    merged = True
+    while merged:
+        merged = False
+        tiers = {}
+        for segment in segments:
+            tiers.setdefault(int(math.log(len(segment) + 1, factor)), []).append(segment)
+
+        for tier in tiers.values():
+            if len(tier) >= factor:
+                segments = [s for s in segments if all(s is not t for t in tier)]
+                segments.append(BM25Segment.merge(tier, deleted))
+                merged = True
+                break
+
+    if deleted:
+        for i, segment in enumerate(segments):
+            dead = int(np.isin(segment.file_ids, list(deleted)).sum())
+            if dead and dead >= settings.RAG_INDEX_COMPACT_RATIO * len(segment):
+                segments[i] = BM25Segment.merge([segment], deleted)
+
+    # tombstones are only kept while some segment still holds the file
+    live = set()
+    for segment in segments:
+        live.update(np.unique(segment.file_ids).tolist())
+    return BM25Index([s for s in segments if len(s)], deleted & live)
+
+
+def load_index(project_id):
+    return _cache.get(index_dir(project_id) / "bm25.json", BM25Index.load)
@@ -0,0 +1,197 @@
+from django.conf import settings
+import base64
+import hashlib
+import json
+import re
+import time
+import uuid
+import numpy as np
+from .embeddings import embed
+from .redis_client import get_async_redis
+from .retrieval import corpus_version
+
+SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return SPACE_RE.sub(" ", text or "").strip()
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode()).hexdigest()
+
+
+def response_key(project_id, version: int, instruction: str, chat_history: list, prompt: str, model: str,
+                 options: dict) -> str:
+    """Cache key of a chat turn. The corpus version makes every answer stale as
+    soon as a file is added or removed, the project's retrieval options
+    (retrieval.project_options) as soon as its context is retrieved another way."""
+    history = [[chat["role"], normalize(chat["content"])] for chat in chat_history]
+    return digest([
+        str(project_id),
+        version,
+        digest(normalize(instruction)),
+        history,
+        normalize(prompt),
+        model,
+        options,
+    ])
+
+
+def stats_key(project_id) -> str:
+    return f"{project_id}:cache_stats"
+
+
+def stat_field(layer: str, hit: bool) -> str:
+    return f"{layer}_{'hit' if hit else 'miss'}"
+
+
+def record(project_id, layer: str, hit: bool):
+    settings.REDIS_CLOUD.hincrby(stats_key(project_id), stat_field(layer, hit), 1)
+
+
+def cache_stats(project_id) -> dict:
+    """Hits, misses and hit rate of each cache layer."""
+    counts = {field: int(value) for field, value in settings.REDIS_CLOUD.hgetall(stats_key(project_id)).items()}
+
+    stats = {}
+    for layer in ("exact", "semantic"):
+        hits, misses = counts.get(f"{layer}_hit", 0), counts.get(f"{layer}_miss", 0)
+        stats[layer] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0}
+
+    prompt, cached = counts.get("prompt_tokens", 0), counts.get("cached_tokens", 0)
+    stats["prompt"] = {"tokens": prompt, "cached_tokens": cached, "cached_rate": round(cached / prompt, 4) if prompt else 0.0}
+    return stats
+
+
+async def record_usage(project_id, usage: dict):
+    """Add a model call's prompt tokens, and how many of them the provider
+    served from its prompt cache, to the project's totals."""
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.hincrby(stats_key(project_id), "prompt_tokens", usage.get("prompt_tokens") or 0)
+        pipe.hincrby(stats_key(project_id), "cached_tokens", usage.get("cached_tokens") or 0)
+        await pipe.execute()
+
+
+def lru_key(project_id) -> str:
+    return f"{project_id}:answers"
+
+
+def answer_key(project_id, key: str) -> str:
+    return f"{project_id}:answer:{key}"
+
+
+async def get_response(project_id, key: str):
+    """The cached answer, or None. A hit refreshes the entry's LRU position."""
+    redis = get_async_redis()
+    answer = await redis.get(answer_key(project_id, key))
+
+    async with redis.pipeline(transaction=False) as pipe:
+        if answer is not None:
+            pipe.zadd(lru_key(project_id), {key: time.time()})
+        pipe.hincrby(stats_key(project_id), stat_field("exact", answer is not None), 1)
+        await pipe.execute()
+    return answer
+
+
+async def set_response(project_id, key: str, answer: str):
+    """Store an answer for RAG_RESPONSE_CACHE_TTL seconds and evict the least
+    recently used ones past RAG_RESPONSE_CACHE_SIZE per project."""
+    redis = get_async_redis()
+    async with redis.pipeline() as pipe:
+        pipe.set(answer_key(project_id, key), answer, ex=settings.RAG_RESPONSE_CACHE_TTL)
+        pipe.zadd(lru_key(project_id), {key: time.time()})
+        # entries that expired by TTL only linger in the index until here
+        pipe.zremrangebyscore(lru_key(project_id), "-inf", time.time() - settings.RAG_RESPONSE_CACHE_TTL)
+        pipe.expire(lru_key(project_id), settings.RAG_RESPONSE_CACHE_TTL)
+        pipe.zcard(lru_key(project_id))
+        size = (await pipe.execute())[-1]
+
+    overflow = size - settings.RAG_RESPONSE_CACHE_SIZE
+    if overflow > 0:
+        evicted = await redis.zpopmin(lru_key(project_id), overflow)
+        await redis.delete(*[answer_key(project_id, member) for member, _ in evicted])
+
+
+def semantic_key(project_id) -> str:
+    return f"{project_id}:semantic"
+
+
+def semantic_answers_key(project_id) -> str:
+    return f"{project_id}:semantic:answers"
+
+
+def semantic_lru_key(project_id) -> str:
+    return f"{project_id}:semantic:lru"
+
+
+def drop_similar(redis, project_id, entry_ids: list):
+    redis.hdel(semantic_key(project_id), *entry_ids)
+    redis.hdel(semantic_answers_key(project_id), *entry_ids)
+    redis.zrem(semantic_lru_key(project_id), *entry_ids)
+
+
+def semantic_scope(instruction: str, chat_history: list, query: str, model: str, options: dict) -> str:
+    """Everything but the question itself must match for a semantic hit."""
+    prior = chat_history
+    if chat_history and chat_history[-1]["role"] == "user" and normalize(chat_history[-1]["content"]) == normalize(query):
+        prior = chat_history[:-1]
+    history = [[chat["role"], normalize(chat["content"])] for chat in prior]
+    return digest([digest(normalize(instruction)), history, model, options])
+
+
+def get_similar_response(project_id, scope: str, query: str):
+    """
+    Answer of a previous question close enough to `query`, or None.
+
+    Only the questions' vectors are scanned; answers are kept in their own
+    hash and just the winning one is fetched. Entries from an older corpus
+    version are dropped on the way. How well paraphrases match depends on
+    RAG_EMBEDDING_FUNCTION; the default hashing embedder only catches
+    near-verbatim rewordings.
+    """
+    redis = settings.REDIS_CLOUD
+    version = corpus_version(project_id)
+    entries = {entry_id: json.loads(value) for entry_id, value in redis.hgetall(semantic_key(project_id)).items()}
+
+    stale = [entry_id for entry_id, entry in entries.items() if entry["version"] != version]
+    if stale:
+        drop_similar(redis, project_id, stale)
+        entries = {entry_id: entry for entry_id, entry in entries.items() if entry_id not in stale}
+
+    candidates = [(entry_id, entry) for entry_id, entry in entries.items() if entry["scope"] == scope]
+    answer = None
+    if candidates:
+        vectors = np.stack([np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float16) for _, entry in candidates])
+        similarity = vectors.astype(np.float32) @ embed([normalize(query)])[0]
+        best = int(np.argmax(similarity))
+        if similarity[best] >= settings.RAG_SEMANTIC_CACHE_THRESHOLD:
+            entry_id, _ = candidates[best]
+            answer = redis.hget(semantic_answers_key(project_id), entry_id)
+            if answer is not None:
+                redis.zadd(semantic_lru_key(project_id), {entry_id: time.time()})
+
+    record(project_id, "semantic", answer is not None)
+    return answer
+
+
+def set_similar_response(project_id, scope: str, query: str, answer: str):
+    redis = settings.REDIS_CLOUD
+    entry_id = uuid.uuid4().hex
+    entry = {
+        "version": corpus_version(project_id),
+        "scope": scope,
+        "vector": base64.b64encode(embed([normalize(query)])[0].astype(np.float16).tobytes()).decode(),
+    }
+
+    with redis.pipeline() as pipe:
+        pipe.hset(semantic_answers_key(project_id), entry_id, answer)
+        pipe.hset(semantic_key(project_id), entry_id, json.dumps(entry))
+        pipe.zadd(semantic_lru_key(project_id), {entry_id: time.time()})
+        pipe.zcard(semantic_lru_key(project_id))
+        size = pipe.execute()[-1]
+
+    overflow = size - settings.RAG_SEMANTIC_CACHE_SIZE
+    if overflow > 0:
+        evicted = [member for member, _ in redis.zpopmin(semantic_lru_key(project_id), overflow)]
+        drop_similar(redis, project_id, evicted)
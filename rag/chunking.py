@@ -0,0 +1,56 @@
+from django.conf import settings
+from .tokens import count_tokens_batch
+
+
+def chunk_text(text: str, chunk_size: int = None, overlap: int = None) -> list:
+    """Split text into overlapping windows, preferring to cut on whitespace."""
+    chunk_size = chunk_size or settings.RAG_CHUNK_SIZE
+    overlap = settings.RAG_CHUNK_OVERLAP if overlap is None else overlap
+    overlap = min(overlap, chunk_size // 2)
+
+    chunks = []
+    if not text:
+        return chunks
+
+    start = 0
+    length = len(text)
+
+    while start < length:
+        end = min(start + chunk_size, length)
+
+        if end < length:
+            # back off to the last whitespace so words/claim numbers are not split
+            cut = text.rfind(" ", start + chunk_size // 2, end)
+            if cut != -1:
+                end = cut
+
+        chunks.append({"start": start, "end": end, "text": text[start:end]})
+
+        if end >= length:
+            break
+
+        start = max(end - overlap, start + 1)
+
+    return chunks
+
+
+def join_chunks(chunks: list) -> str:
+    """The text chunk_text split, put back together without the overlaps."""
+    parts, end = [], 0
+    for chunk in chunks:
+        parts.append(chunk["text"][max(end - chunk["start"], 0):])
+        end = max(end, chunk["end"])
+    return "".join(parts)
+
+
+def chunk_file(file, text: str) -> list:
+    """Chunk the content of an UploadedFile, tagging every chunk with its source
+    and its token count."""
+    filename = file.file.name.split('/')[-1]
+    chunks = chunk_text(text)
+    counts = count_tokens_batch([chunk["text"] for chunk in chunks])
+
+    return [
+        {"file_id": str(file.unique_id), "filename": filename, "position": position, "tokens": tokens, **chunk}
+        for position, (chunk, tokens) in enumerate(zip(chunks, counts))
+    ]
@@ -2,46 +2,159 @@ from django.conf import settings
 import asyncio
 import json
 import logging
+import uuid
+from contextlib import aclosing
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-import google.generativeai as genai
-import openai
-import anthropic
-from together import Together
+from asgiref.sync import sync_to_async
+import redis
 # from .redis_client import redis_cloud
 from . import serializer
+from . import retrieval
+from . import providers
+from . import cache
+from . import jobs
+from . import conversations
+from . import answer_streams
+from . import history
+from . import prompts
+from .context import model_spec
+from .scheduler import get_scheduler
 from .models import UploadedFile, Project
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-genai.configure(api_key=settings.GEMINI_API_KEY)
 
-gemini_client_flash = genai.GenerativeModel(settings.GEMINI_RAG_MODEL_FLASH)
-gemini_client_pro = genai.GenerativeModel(settings.GEMINI_RAG_MODEL_PRO)
-
-together_client = openai.OpenAI(
-  api_key=settings.TOGETHER_API_KEY,
-  base_url=settings.TOGETHER_API_BASE_URL,
-)
-
-openai.api_key = settings.OPENAI_API_KEY
+def openai_usage(usage) -> dict:
+    details = getattr(usage, "prompt_tokens_details", None)
+    # DeepSeek-style servers report cache hits in a field of their own
+    cached = getattr(details, "cached_tokens", None) or getattr(usage, "prompt_cache_hit_tokens", None)
+    return {"prompt_tokens": usage.prompt_tokens or 0, "cached_tokens": cached or 0, "output_tokens": usage.completion_tokens or 0}
+
+
+async def delta_text(response, usage: dict = None):
+    """Text deltas of an OpenAI-compatible chat completion stream. Token usage,
+    when the server sends it, is copied into `usage`."""
+    async with response:
+        async for chunk in response:
+            if usage is not None and getattr(chunk, "usage", None):
+                usage.update(openai_usage(chunk.usage))
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+
+async def gemini_text(response, usage: dict = None):
+    """Text of a Gemini stream. Its chunk iterator is closed with this
+    generator, so a stopped turn lets go of the SDK stream right away."""
+    async with aclosing(aiter(response)) as chunks:
+        async for chunk in chunks:
+            metadata = getattr(chunk, "usage_metadata", None)
+            if usage is not None and metadata:
+                usage.update({
+                    "prompt_tokens": metadata.prompt_token_count or 0,
+                    "cached_tokens": getattr(metadata, "cached_content_token_count", 0) or 0,
+                    "output_tokens": metadata.candidates_token_count or 0,
+                })
+            if chunk.text:
+                yield chunk.text
+
+
+def anthropic_content(prompt) -> list:
+    """The prompt as two text blocks with a cache breakpoint after the prefix."""
+    prefix = {"type": "text", "text": prompt.prefix}
+    if settings.RAG_PROMPT_CACHE:
+        prefix["cache_control"] = {"type": "ephemeral"}
+    return [prefix, {"type": "text", "text": prompt.suffix}]
+
+
+async def first_text(stream):
+    """The first text of a stream, or None if it ends without any. The stream
+    is left open for the rest."""
+    async for text in stream:
+        return text
+    return None
+
+
+async def prepend(first, stream):
+    if first is not None:
+        yield first
+        async for text in stream:
+            yield text
+
+
+class FrameBatcher:
+    """
+    Coalesces streamed text into fewer `streaming` frames. Buffered text is
+    sent once it reaches `max_bytes` or has waited `interval_ms`, whichever
+    comes first; a zero interval sends every chunk as its own frame. The
+    first chunk is never held back. Frames go out in order, the timer only
+    covers a provider that pauses mid-answer.
+    """
+
+    def __init__(self, send, interval_ms: float, max_bytes: int):
+        self.send = send
+        self.interval = interval_ms / 1000
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.size = 0
+        self.frames = 0
+        self.timer = None
+        self.timed_flush = None
+        self.lock = asyncio.Lock()
+
+    async def add(self, text: str):
+        self.buffer.append(text)
+        self.size += len(text.encode())
+        # the first text goes out at once, batching must not delay the first token
+        if not self.interval or self.size >= self.max_bytes or not self.frames:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.timed_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.buffer:
+                return
+            text = "".join(self.buffer)
+            self.buffer, self.size = [], 0
+            self.frames += 1
+            await self.send(json.dumps({"status": "streaming", "message": text}))
 
-alibaba_client = openai.OpenAI(
-    api_key=settings.ALIBABA_API_KEY,
-    base_url=settings.ALIBABA_BASE_URL,
-)
+    async def close(self):
+        await self.flush()
+        if self.timed_flush is not None:
+            await self.timed_flush
 
-claude_client = anthropic.Anthropic(
-    api_key=settings.CLAUDE_API_KEY,
-)
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    model_functions = {
+        "gemini-2.5-pro": "gemini_service_pro",
+        # "gemini-2.0-flash-001": "gemini_service_flash",
+        "lama-405": "together_lama_service",
+        "deepseek-R1": "together_deepseek_service",
+        "o3-mini": "openai_service",
+        "claude-sonnet3": "claude_service",
+        "qwen-plus": "alibaba_service",
+    }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.default_prompt = """"""
+        self.stop_streaming = False
+        self.closed = False
+        self.turns = set()
+        # (project_id, stream_id) of the generation being recorded, see answer_streams
+        self.recording = None
+        self.reader = uuid.uuid4().hex
 
     def get_file_url(self, unique_id):
         try:
@@ -63,56 +176,93 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(str(e))
             return None
 
-    def system_prompt(self, query: str, context: str = "", chat_history: str = "", default_prompt: str = "") -> str:
-        return f"""
-        {default_prompt}
-
-        You can use the following context to answer the question if relevant:
-        {context}
-        
-        {chat_history}
-        USER: {query}
+    async def stream_response(self, chunks):
         """
+        Forward provider text as `streaming` frames.
 
-    async def together_lama_service(self, prompt: str):
+        The provider stream is pulled one chunk at a time and frames are
+        awaited before the next read, so a slow socket paces the upstream read
+        instead of the answer piling up in memory, and a blocked provider only
+        suspends this connection's task. Chunks are coalesced by a
+        FrameBatcher (RAG_STREAM_FLUSH_MS / RAG_STREAM_FLUSH_BYTES).
+
+        A fully streamed answer is left in `self.answer` for the response cache.
+        The call's `usage` frame, when the provider reported it, follows the
+        last text.
+        """
+        parts = []
+        batcher = FrameBatcher(self.send, settings.RAG_STREAM_FLUSH_MS, settings.RAG_STREAM_FLUSH_BYTES)
         try:
-            response = together_client.chat.completions.create(
-                max_tokens=2040,
-                model=settings.TOGETHER_LAMA_RAG_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
+            async for text in chunks:
+                if self.stop_streaming is True:
+                    break
+                parts.append(text)
+                await batcher.add(text)
+            else:
+                self.answer = "".join(parts)
+        finally:
+            # text already received is sent before `usage`, `completed` or the error frame
+            await batcher.close()
 
-            for chunk in response:
-                await asyncio.sleep(0.05)
-                await self.send(json.dumps({"status": "streaming", "message": chunk.choices[0].delta.content}))
+        if self.usage:
+            await self.report_usage(*self.usage)
+        await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
 
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
-        except Exception as e:
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
+    async def store_answer(self, project_id, cache_key, semantic_scope, query: str):
+        try:
+            if cache_key:
+                await cache.set_response(project_id, cache_key, self.answer)
+            if semantic_scope:
+                await sync_to_async(cache.set_similar_response, thread_sensitive=False)(
+                    project_id, semantic_scope, query, self.answer
+                )
+        except redis.RedisError as e:
+            logger.error(f"Caching the answer failed: {e}")
+
+    async def save_turn(self, project_id, conversation_id, prompt: str, answer: str):
+        """Append the turn to the server-side conversation, if the client keeps one."""
+        if not conversation_id:
             return
-
-    async def together_deepseek_service(self, prompt: str):
         try:
-            response = together_client.chat.completions.create(
-                max_tokens=2040,
-                temperature=0.3,
-                model=settings.TOGETHER_DEEPSEEK_RAG_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-
-            for chunk in response:
-                await asyncio.sleep(0.05)
-                if len(chunk.choices) > 0:
-                    await self.send(json.dumps({"status": "streaming", "message": chunk.choices[0].delta.content}))
-
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
-        except Exception as e:
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
+            tokens = await conversations.append(project_id, conversation_id, [
+                {"role": "user", "content": prompt},
+                {"role": "bot", "content": answer},
+            ])
+        except redis.RedisError as e:
+            logger.error(f"Saving the conversation failed: {e}")
             return
+        await self.send(json.dumps({"status": "conversation", "conversation_id": str(conversation_id), "tokens": tokens}))
+
+    async def replay(self, answer: str):
+        """Send a cached answer with the same frames as a live stream."""
+        await self.send(json.dumps({"status": "ready", "message": "<SOS> "}))
+        await self.send(json.dumps({"status": "streaming", "message": answer}))
+        await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
+
+    # provider services are async generators of answer text; errors propagate to run_model.
+    # `prompt` is a prompts.Prompt, `usage` receives the call's token counts when the provider reports them.
+    # OpenAI-compatible providers and Gemini cache by prefix on their own, Anthropic needs a cache breakpoint
+
+    async def together_lama_service(self, prompt, usage: dict):
+        response = await providers.get_client("together").chat.completions.create(
+            max_tokens=2040,
+            model=settings.TOGETHER_LAMA_RAG_MODEL,
+            messages=[{"role": "user", "content": str(prompt)}],
+            stream=True
+        )
+        async for text in delta_text(response, usage):
+            yield text
+
+    async def together_deepseek_service(self, prompt, usage: dict):
+        response = await providers.get_client("together").chat.completions.create(
+            max_tokens=2040,
+            temperature=0.3,
+            model=settings.TOGETHER_DEEPSEEK_RAG_MODEL,
+            messages=[{"role": "user", "content": str(prompt)}],
+            stream=True
+        )
+        async for text in delta_text(response, usage):
+            yield text
 
     # async def gemini_service_flash(self, prompt: str):
     #     try:
@@ -148,144 +298,197 @@ class ChatConsumer(AsyncWebsocketConsumer):
     #         return
 
 
-    async def gemini_service_pro(self, prompt: str):
-        
+    async def gemini_service_pro(self, prompt, usage: dict):
+        # the SDK keeps its gRPC call to itself: the deadline bounds what an
+        # abandoned call can still generate, closing the text stream drops it
+        response_stream = await providers.get_client("gemini").generate_content_async(
+            str(prompt), stream=True, generation_config={"temperature": 0.3},
+            request_options={"timeout": settings.RAG_GEMINI_DEADLINE},
+        )
+        async with aclosing(gemini_text(response_stream, usage)) as texts:
+            async for text in texts:
+                yield text
+
+    async def openai_service(self, prompt, usage: dict):
+        response = await providers.get_client("openai").chat.completions.create(
+            model=settings.OPENAI_RAG_MODEL,
+            # temperature=0.2,
+            messages=[{"role": "user", "content": str(prompt)}],
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for text in delta_text(response, usage):
+            yield text
+
+    async def alibaba_service(self, prompt, usage: dict):
+        response = await providers.get_client("alibaba").chat.completions.create(
+            max_tokens=2040,
+            temperature=0.2,
+            model=settings.ALIBABA_RAG_MODEL,
+            messages=[{"role": "user", "content": str(prompt)}],
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for text in delta_text(response, usage):
+            yield text
+
+    async def claude_service(self, prompt, usage: dict):
+        async with providers.get_client("anthropic").messages.stream(
+                max_tokens=2040,
+                temperature=0.3,
+                messages=[{"role": "user", "content": anthropic_content(prompt)}],
+                model=settings.CLAUDE_RAG_MODEL,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+            counts = (await stream.get_final_message()).usage
+            read, written = counts.cache_read_input_tokens or 0, counts.cache_creation_input_tokens or 0
+            usage.update({
+                "prompt_tokens": counts.input_tokens + read + written,
+                "cached_tokens": read,
+                "output_tokens": counts.output_tokens,
+            })
+
+    def error_message(self, key, error) -> str:
+        if key == "claude-sonnet3":
+            import anthropic
+
+            for error_type, message in (
+                (anthropic.AuthenticationError, "Anthropic Authentication Error!"),
+                (anthropic.PermissionDeniedError, "Anthropic Permisson Denied!"),
+                (anthropic.RateLimitError, "Anthropic Rate Limit Exceeded!"),
+                (anthropic.InternalServerError, "Anthropic Internal Server Error!"),
+                (anthropic.APIError, "Anthropic API Error!"),
+            ):
+                if isinstance(error, error_type):
+                    return message
+            return "Something went wrong with Claude!"
+
+        if key == "gemini-2.5-pro":
+            from google.api_core import exceptions
+
+            if isinstance(error, exceptions.ResourceExhausted):
+                return "Gemini Rate Limit Exceeded!"
+            if isinstance(error, exceptions.GoogleAPIError):
+                return "Gemini API Error!"
+            return "Something went wrong with Gemini!"
+
+        return "Something went wrong!"
+
+    async def report_usage(self, key, usage: dict):
+        """Send and record the prompt-cache usage of a finished call."""
+        logger.info(
+            f"{key} for {self.project_id}: {usage['prompt_tokens']} prompt tokens, "
+            f"{usage['cached_tokens']} from the provider cache, {usage['output_tokens']} output"
+        )
+        await self.send(json.dumps({"status": "usage", "model": key, **usage}))
         try:
-            response_stream = gemini_client_pro.generate_content(prompt, stream=True, generation_config={"temperature": 0.3})
+            await cache.record_usage(self.project_id, usage)
+        except redis.RedisError as e:
+            logger.error(f"Recording token usage failed: {e}")
+
+    async def open_stream(self, key, prompt):
+        """The model's stream, started once its provider has capacity. Waiting
+        clients get `queued` frames with their position."""
+        spec = model_spec(key)
+        prompt_tokens = await sync_to_async(prompt.count_tokens, thread_sensitive=False)(key)
+        usage = {}
+
+        async def queued(position):
+            await self.send(json.dumps({"status": "queued", "position": position, "model": key}))
+
+        async with get_scheduler(spec["provider"]).slot(self.project_id, prompt_tokens + spec["output"], queued) as slot:
+            characters = 0
+            async for text in getattr(self, self.model_functions[key])(prompt=prompt, usage=usage):
+                characters += len(text)
+                yield text
+
+            if usage:
+                slot.used = usage["prompt_tokens"] + usage["output_tokens"]
+                # sent by stream_response once the last text is out
+                self.usage = key, usage
+            else:
+                # roughly 4 characters per token, only used to refund the output reservation
+                slot.used = prompt_tokens + characters // 4
+
+    async def first_chunk(self, key, prompt):
+        """
+        Start the model's stream and wait for its first text.
 
-            for chunk in response_stream:
-                if chunk.text:
-                    await asyncio.sleep(0.03)
-                    await self.send(json.dumps({"status": "streaming", "message": chunk.text}))
+        With a backup in RAG_BACKUP_MODELS, the backup is started as well when
+        the model fails with a rate-limit/5xx error before answering, or, if
+        RAG_HEDGE_AFTER is set, when it has not answered within that many
+        seconds. Whichever produces text first wins and the other request is
+        cancelled. Returns (model, first text or None, stream).
+        """
+        backup = settings.RAG_BACKUP_MODELS.get(key)
+        if backup not in self.model_functions:
+            backup = None
 
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
-        
-        except genai.types.GenerationError as e:  
-            
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Gemini Generation Error!"}))
-            return
-        
-        except genai.types.RateLimitError as e:  
-            
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Gemini Rate Limit Exceeded!"}))
-            return
+        pending = {}
+        errors = []
 
-        except genai.types.APIError as e:
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Gemini API Error!"}))
-            return  
-            
-        except Exception as e:  
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong with Gemini!"}))
-            return
+        def start(model):
+            stream = self.open_stream(model, prompt)
+            pending[asyncio.ensure_future(first_text(stream))] = (model, stream)
 
-    async def openai_service(self, prompt: str):
+        start(key)
         try:
-            response = openai.chat.completions.create(
-                model=settings.OPENAI_RAG_MODEL,
-                # temperature=0.2,
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-
-            for chunk in response:
-                if chunk.choices[0].delta.content is not None:
-                    await asyncio.sleep(0.05)
-                    await self.send(json.dumps({"status": "streaming", "message": chunk.choices[0].delta.content}))
-
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
-        except Exception as e:
-            logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
+            while pending:
+                hedge = settings.RAG_HEDGE_AFTER if backup else None
+                done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    logger.info(f"{key} has not answered in {hedge}s, hedging with {backup}")
+                    start(backup)
+                    backup = None
+                    continue
+
+                for task in done:
+                    model, stream = pending.pop(task)
+                    try:
+                        return model, task.result(), stream
+                    except Exception as e:
+                        logger.error(f"{model} failed before answering: {e}")
+                        errors.append(e)
+                        await stream.aclose()
+                        if backup and providers.is_retryable(e):
+                            logger.info(f"Failing over from {model} to {backup}")
+                            start(backup)
+                            backup = None
+
+            raise errors[0]
+        finally:
+            for task, (model, stream) in pending.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+    async def run_model(self, key, prompt):
+        self.answer = None
+        self.usage = None
+        if key not in self.model_functions:
+            logger.error(f"Unknown model: {key}")
             return
 
-    async def alibaba_service(self, prompt: str):
         try:
-            response = alibaba_client.chat.completions.create(
-                max_tokens=2040,
-                temperature=0.2,
-                model=settings.ALIBABA_RAG_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-
-            for chunk in response:
-                if chunk.choices[0].delta.content is not None:
-                    await asyncio.sleep(0.05)
-                    await self.send(json.dumps({"status": "streaming", "message": chunk.choices[0].delta.content}))
-
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
+            model, first, stream = await self.first_chunk(key, prompt)
         except Exception as e:
             logger.error(str(e))
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
-            return
-
-    async def claude_service(self, prompt: str):
-        try:
-            with claude_client.messages.stream(
-                    max_tokens=2040,
-                    temperature=0.3,
-                    messages=[{"role": "user", "content": prompt}],
-                    model=settings.CLAUDE_RAG_MODEL,
-            ) as stream:
-                for text in stream.text_stream:
-                    if self.stop_streaming is True:
-                        await self.send(json.dumps({"status": "completed", "message": ""}))
-                        break
-                    else:
-                        await asyncio.sleep(0.05)
-                        await self.send(json.dumps({"status": "streaming", "message": text}))
-
-            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
-        except anthropic.APIError as e:
-            logger.error(f"API Error: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Anthropic API Error!"}))
-            return
-
-        except anthropic.AuthenticationError as e:
-            logger.error(f"Authentication Error: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Anthropic Authentication Error!"}))
+            await self.send(json.dumps({"status": 500, "error": self.error_message(key, e)}))
             return
 
-        except anthropic.PermissionError as e:
-            logger.error(f"Permission Error: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Anthropic Permisson Denied!"}))
-            return
+        if model != key:
+            await self.send(json.dumps({"status": "fallback", "model": model}))
 
-        except anthropic.RateLimitError as e:
-            logger.error(f"Rate Limit Exceeded: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Anthropic Rate Limit Exceeded!"}))
-            return
-        
-        except anthropic.InternalServerError as e:
-            logger.error(f"Server Error: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Anthropic Internal Server Error!"}))
-            return
-        
+        try:
+            await self.stream_response(prepend(first, stream))
         except Exception as e:
-            logger.error(f"Unexpected Error: {e}")
-            await self.send(json.dumps({"status": 500, "error": "Something went wrong with Claude!"}))
-            return
-
-    async def run_model(self, key, prompt: str):
-        model_functions = {
-            "gemini-2.5-pro": self.gemini_service_pro,
-            # "gemini-2.0-flash-001": self.gemini_service_flash,
-            "lama-405": self.together_lama_service,
-            "deepseek-R1": self.together_deepseek_service,
-            "o3-mini": self.openai_service,
-            "claude-sonnet3": self.claude_service,
-            "qwen-plus": self.alibaba_service
-        }
-
-        func = model_functions.get(key)
-        if func:
-            await func(prompt=prompt)  # Call the function with the parameter
-        else:
-            print("Invalid key:", key)
+            logger.error(str(e))
+            await self.send(json.dumps({"status": 500, "error": self.error_message(model, e)}))
+        finally:
+            await stream.aclose()
 
     async def connect(self):
         await self.accept()
@@ -298,34 +501,224 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         logger.info("WS: Disconnected to chat...")
-        self.stop_streaming = True
+        self.closed = True
+        if settings.RAG_RESUMABLE_STREAMS and self.turns:
+            # the answer keeps streaming into Redis for a client that comes back
+            asyncio.ensure_future(self.stop_unless_resumed())
+        else:
+            await self.stop()
         # self.room_group_name = 'chat_%s' % self.room_name
         # print(self.scope)
         # print(close_code)
 
+    async def stop(self):
+        """
+        Abort the running turn. Cancelling its task is the cancellation token
+        every provider adapter honours: the CancelledError surfaces at the
+        adapter's pending read, its `async with` closes the upstream HTTP
+        stream (Gemini's gRPC call is dropped, and ends at its deadline at the
+        latest) and the scheduler slot is released on the way out, so no more
+        of the answer is read or paid for.
+        """
+        self.stop_streaming = True
+        turns = list(self.turns)
+        for turn in turns:
+            turn.cancel()
+        if turns:
+            await asyncio.wait(turns)
+
+    async def stop_unless_resumed(self):
+        """Let a disconnected client's generation run on while someone reads
+        it back, checking every RAG_RESUME_GRACE seconds."""
+        while self.turns:
+            await asyncio.wait(list(self.turns), timeout=settings.RAG_RESUME_GRACE)
+            if not self.turns:
+                return
+            try:
+                resumed = self.recording is not None and await answer_streams.has_readers(*self.recording)
+            except redis.RedisError as e:
+                logger.error(f"Checking answer stream readers failed: {e}")
+                resumed = False
+            if not resumed:
+                await self.stop()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Frames of a recorded generation go to its answer stream first and
+        carry their stream offset; once the client is gone they are only
+        recorded."""
+        if self.recording is not None and text_data is not None:
+            try:
+                offset = await answer_streams.append(*self.recording, text_data)
+                text_data = json.dumps({**json.loads(text_data), "offset": offset})
+            except redis.RedisError as e:
+                logger.error(f"Recording the answer stream failed: {e}")
+                self.recording = None
+        if not self.closed:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
     async def receive(self, text_data=None, bytes_data=None):
+        """
+        Chat turns run as tasks so that a {"type": "stop"} message, or a
+        disconnect, is handled while an answer is still streaming. Turns sent
+        back to back still run one after the other.
+
+        {"type": "resume", "unique_id", "stream", "offset"} replays a recorded
+        generation from after `offset` and follows it until it ends.
+        """
         try:
-            data = serializer.ChatConsumerSerializer(data=json.loads(text_data))
+            message = json.loads(text_data)
+        except ValueError:
+            message = None
+        if isinstance(message, dict) and message.get("type") == "stop":
+            await self.stop()
+            return
 
-            if data.is_valid():
-                instruction = await database_sync_to_async(self.get_project_instruction)(data.data['unique_id'])
+        if isinstance(message, dict) and message.get("type") == "resume":
+            coroutine = self.resume(message.get("unique_id"), message.get("stream"), message.get("offset") or "0")
+        else:
+            coroutine = self.run_turn(text_data)
+
+        previous = list(self.turns)
+        turn = asyncio.ensure_future(self.after(previous, coroutine))
+        self.turns.add(turn)
+        turn.add_done_callback(self.turns.discard)
+
+    async def after(self, previous: list, coroutine):
+        try:
+            if previous:
+                await asyncio.wait(previous)
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        await coroutine
+
+    async def run_turn(self, text_data):
+        self.stop_streaming = False
 
-                chat_format = ""
-                for chat in data.data['chat_history']:
-                    if chat['role'] == "user":
-                        chat_format += f"USER: {chat['content']}\n"
+        try:
+            await self.chat(text_data)
+        except asyncio.CancelledError:
+            logger.info(f"Turn for {getattr(self, 'project_id', None)} stopped")
+            await self.send(json.dumps({"status": "completed", "message": " <EOS>"}))
+        finally:
+            await self.end_recording()
 
-                    if chat['role'] == "bot":
-                        chat_format += f"AI: {chat['content']}\n"
+    async def start_recording(self, project_id):
+        if not settings.RAG_RESUMABLE_STREAMS:
+            return None
+        stream_id = answer_streams.new_stream_id()
+        try:
+            await answer_streams.start(project_id, stream_id)
+        except redis.RedisError as e:
+            logger.error(f"Answer stream unavailable: {e}")
+            return None
+        self.recording = (project_id, stream_id)
+        return stream_id
 
-                context = settings.REDIS_CLOUD.get(data.data['unique_id'])
-                # print(context)
+    async def end_recording(self):
+        if self.recording is None:
+            return
+        recording, self.recording = self.recording, None
+        try:
+            await answer_streams.finish(*recording)
+        except redis.RedisError as e:
+            logger.error(f"Closing the answer stream failed: {e}")
+
+    async def resume(self, project_id, stream_id, offset: str):
+        if not project_id or not stream_id:
+            await self.send(json.dumps({"status": 400, "error": "unique_id and stream are required to resume!"}))
+            return
 
-                prompt = self.system_prompt(data.data['user_prompt'], context, chat_format, instruction)
+        try:
+            if not await answer_streams.exists(project_id, stream_id):
+                await self.send(json.dumps({"status": 400, "error": "No such stream!"}))
+                return
+            async for offset, frame in answer_streams.read(project_id, stream_id, offset, self.reader):
+                await self.send(json.dumps({**json.loads(frame), "offset": offset}))
+        except redis.RedisError as e:
+            logger.error(f"Resuming answer stream {stream_id} failed: {e}")
+            await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
+            return
+        finally:
+            try:
+                await answer_streams.drop_reader(project_id, stream_id, self.reader)
+            except redis.RedisError:
+                pass  # the reader entry ages out after RAG_RESUME_GRACE
 
-                await self.send(json.dumps({"status": "ready", "message": "<SOS> "}))
+    async def chat(self, text_data):
+        try:
+            data = serializer.ChatConsumerSerializer(data=json.loads(text_data))
+
+            if data.is_valid():
+                project_id = self.project_id = data.data['unique_id']
+                instruction = await database_sync_to_async(self.get_project_instruction)(project_id)
+
+                conversation_id = data.data.get('conversation_id')
+                chat_history = data.data.get('chat_history', [])
+                if conversation_id:
+                    stored = await conversations.load(project_id, conversation_id)
+                    if stored:
+                        chat_history = stored
+                    elif chat_history:
+                        # an existing chat moving to the server-side store
+                        await conversations.append(project_id, conversation_id, chat_history)
+
+                query = data.data.get('user_prompt') or next(
+                    (chat['content'] for chat in reversed(chat_history) if chat['role'] == "user"), ""
+                )
+
+                version = await retrieval.acorpus_version(project_id)
+
+                cache_key = semantic_scope = None
+                try:
+                    if settings.RAG_RESPONSE_CACHE or settings.RAG_SEMANTIC_CACHE:
+                        options = await sync_to_async(retrieval.project_options, thread_sensitive=False)(project_id)
+
+                    if settings.RAG_RESPONSE_CACHE:
+                        cache_key = cache.response_key(
+                            project_id, version, instruction,
+                            chat_history, data.data.get('user_prompt', ""), data.data['model'], options,
+                        )
+                        answer = await cache.get_response(project_id, cache_key)
+                        if answer is not None:
+                            await self.replay(answer)
+                            await self.save_turn(project_id, conversation_id, query, answer)
+                            return
+
+                    if settings.RAG_SEMANTIC_CACHE:
+                        semantic_scope = cache.semantic_scope(
+                            instruction, chat_history, query, data.data['model'], options,
+                        )
+                        answer = await sync_to_async(cache.get_similar_response, thread_sensitive=False)(
+                            project_id, semantic_scope, query
+                        )
+                        if answer is not None:
+                            await self.replay(answer)
+                            await self.save_turn(project_id, conversation_id, query, answer)
+                            return
+                except redis.RedisError as e:
+                    # a slow or unreachable cache is a miss, not a failed turn
+                    logger.error(f"Response cache unavailable: {e}")
+                    cache_key = semantic_scope = None
+
+                try:
+                    chat_format = await history.chat_history(project_id, chat_history, data.data['model'], conversation_id)
+                except redis.RedisError as e:
+                    logger.error(f"History summary unavailable: {e}")
+                    chat_format = history.format_messages(chat_history)
+
+                prompt = await prompts.build_prompt(
+                    project_id, version, query, data.data['model'], instruction, chat_format
+                )
+
+                stream_id = await self.start_recording(project_id)
+                await self.send(json.dumps({"status": "ready", "message": "<SOS> ", "stream": stream_id}))
                 await self.run_model(data.data['model'], prompt)
 
+                if self.answer:
+                    await self.store_answer(project_id, cache_key, semantic_scope, query)
+                    await self.save_turn(project_id, conversation_id, query, self.answer)
+
             else:
                 logger.error(data.errors)
 
@@ -351,4 +744,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(str(e))
             await self.send(json.dumps({"status": 500, "error": "Something went wrong!"}))
-            return
\ No newline at end of file
+            return
+
+
+class IngestConsumer(AsyncWebsocketConsumer):
+    """Pushes the progress of a project's ingestion jobs as they run."""
+
+    async def connect(self):
+        self.group_name = jobs.group_name(self.scope['url_route']['kwargs']['project_id'])
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def ingest_progress(self, event):
+        await self.send(json.dumps({"status": "progress", "job": event["job"]}))
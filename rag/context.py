@@ -0,0 +1,60 @@
+from django.conf import settings
+from .tokens import count_tokens, truncate_tokens
+
+# tokens taken by the fixed text of prompts.render_prefix and render_suffix
+PROMPT_OVERHEAD = 64
+# tokens taken by the <FILE>FILENAME..., OFFSET...</FILE> wrapper around a chunk
+CHUNK_OVERHEAD = 24
+
+
+def model_spec(model: str = None) -> dict:
+    return settings.RAG_MODELS.get(model) or settings.RAG_MODELS[settings.RAG_DEFAULT_MODEL]
+
+
+def count_model_tokens(text: str, model: str = None) -> int:
+    """Token estimate for `model`: its tiktoken encoding, scaled by the model's
+    safety ratio where tiktoken does not ship the real tokenizer."""
+    spec = model_spec(model)
+    return int(count_tokens(text, spec["encoding"]) * spec["token_ratio"])
+
+
+def context_budget(model: str, instruction: str = "", chat_history: str = "", query: str = "") -> int:
+    """Tokens left for retrieved context once the window has room for the
+    instruction, chat history, query and the answer itself."""
+    spec = model_spec(model)
+    reserved = (
+        spec["output"]
+        + PROMPT_OVERHEAD
+        + count_model_tokens(instruction, model)
+        + count_model_tokens(chat_history, model)
+        + count_model_tokens(query, model)
+    )
+    return max(0, min(spec["window"] - reserved, settings.RAG_CONTEXT_MAX_TOKENS))
+
+
+def pack(ranked: list, budget: int, model: str = None) -> list:
+    """Greedily take chunks in rank order while they fit in the budget, skipping
+    any that would overflow in favour of smaller lower-ranked ones."""
+    ratio = model_spec(model)["token_ratio"]
+    packed = []
+    remaining = budget
+
+    for chunk in ranked:
+        if remaining <= CHUNK_OVERHEAD:
+            break
+        # per-chunk counts are cached at ingest; older chunk stores lack them
+        tokens = chunk.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(chunk["text"])
+        cost = int(tokens * ratio) + CHUNK_OVERHEAD
+        if cost <= remaining:
+            packed.append(chunk)
+            remaining -= cost
+
+    return packed
+
+
+def truncate(text: str, budget: int, model: str = None) -> str:
+    """The longest leading part of `text` that fits in `budget` tokens of `model`."""
+    spec = model_spec(model)
+    return truncate_tokens(text, int(budget / spec["token_ratio"]), spec["encoding"])
@@ -0,0 +1,61 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+import json
+from .history import history_key
+from .redis_client import get_async_redis
+from .tokens import count_tokens_batch
+
+# a conversation is a Redis list of {"role", "content", "tokens"} messages plus
+# a counter with the sum of their tokens
+
+
+def messages_key(project_id, conversation_id) -> str:
+    return f"{project_id}:conversation:{conversation_id}"
+
+
+def tokens_key(project_id, conversation_id) -> str:
+    return f"{project_id}:conversation:{conversation_id}:tokens"
+
+
+def message_text(chat: dict) -> str:
+    # the same text get_total_tokens counts for a client-sent history
+    return f"{chat['role']}: {chat['content']}\n"
+
+
+async def load(project_id, conversation_id) -> list:
+    raw = await get_async_redis().lrange(messages_key(project_id, conversation_id), 0, -1)
+    return [json.loads(message) for message in raw]
+
+
+async def append(project_id, conversation_id, messages: list) -> int:
+    """Store messages at the end of the conversation, each with its token
+    count, and return the conversation's new token total."""
+    counts = await sync_to_async(count_tokens_batch, thread_sensitive=False)([message_text(chat) for chat in messages])
+    entries = [
+        json.dumps({"role": chat['role'], "content": chat['content'], "tokens": tokens})
+        for chat, tokens in zip(messages, counts)
+    ]
+
+    async with get_async_redis().pipeline(transaction=True) as pipe:
+        pipe.rpush(messages_key(project_id, conversation_id), *entries)
+        pipe.incrby(tokens_key(project_id, conversation_id), sum(counts))
+        pipe.expire(messages_key(project_id, conversation_id), settings.RAG_CONVERSATION_TTL)
+        pipe.expire(tokens_key(project_id, conversation_id), settings.RAG_CONVERSATION_TTL)
+        results = await pipe.execute()
+    return results[1]
+
+
+def get_messages(project_id, conversation_id) -> list:
+    return [json.loads(message) for message in settings.REDIS_CLOUD.lrange(messages_key(project_id, conversation_id), 0, -1)]
+
+
+def token_total(project_id, conversation_id) -> int:
+    return int(settings.REDIS_CLOUD.get(tokens_key(project_id, conversation_id)) or 0)
+
+
+def delete(project_id, conversation_id):
+    settings.REDIS_CLOUD.delete(
+        messages_key(project_id, conversation_id),
+        tokens_key(project_id, conversation_id),
+        history_key(project_id, conversation_id),
+    )
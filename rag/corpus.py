@@ -0,0 +1,77 @@
+from django.conf import settings
+import zlib
+from .redis_client import get_async_redis
+
+# stored values are MAGIC + format version + codec + payload; anything else is a
+# plain UTF-8 value written before compression was introduced
+MAGIC = b"\x00RC"
+FORMAT_VERSION = 1
+RAW, ZLIB = 0, 1
+
+
+def compress(data: bytes, codec: int) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data, settings.RAG_ZLIB_LEVEL)
+    return data
+
+
+def decompress(payload: bytes, codec: int) -> bytes:
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == RAW:
+        return payload
+    raise ValueError(f"Unknown stored value codec {codec}")
+
+
+def encode(text: str, codec: int = None) -> bytes:
+    """Serialise text for Redis. Values under RAG_COMPRESS_MIN_BYTES, or that
+    would not shrink, are stored uncompressed."""
+    data = text.encode()
+    if not data:
+        return b""
+
+    codec = ZLIB if codec is None else codec
+    if len(data) < settings.RAG_COMPRESS_MIN_BYTES:
+        codec = RAW
+
+    payload = compress(data, codec)
+    if codec != RAW and len(payload) >= len(data):
+        codec, payload = RAW, data
+    return MAGIC + bytes([FORMAT_VERSION, codec]) + payload
+
+
+def decode(value) -> str:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    if not value.startswith(MAGIC):
+        return value.decode()
+
+    version, codec = value[len(MAGIC)], value[len(MAGIC) + 1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown stored value format {version}")
+    return decompress(value[len(MAGIC) + 2:], codec).decode()
+
+
+def file_block(filename: str, content: str) -> str:
+    """A file's entry in the corpus blob."""
+    return f"""<FILE>FILENAME: {filename},\nCONTENT: {content}</FILE>"""
+
+
+def get_corpus(project_id) -> str:
+    """The corpus blob of a project that predates chunking, or None. Chunked
+    projects keep their text in their chunks only."""
+    return decode(settings.REDIS_BINARY.get(str(project_id)))
+
+
+async def aget_corpus(project_id) -> str:
+    return decode(await get_async_redis(binary=True).get(str(project_id)))
+
+
+def set_corpus(project_id, text: str):
+    settings.REDIS_BINARY.set(str(project_id), encode(text))
+
+
+def delete_corpus(project_id):
+    settings.REDIS_BINARY.delete(str(project_id))
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from functools import lru_cache
+import math
+import zlib
+import numpy as np
+from .bm25 import tokenize
+
+
+def hashing_embed(texts: list, dim: int = None) -> np.ndarray:
+    """
+    Deterministic, network-free embedding: unigrams and bigrams are hashed into
+    `dim` signed buckets with sublinear tf weighting, then L2 normalised.
+    """
+    dim = dim or settings.RAG_EMBEDDING_DIM
+    rows, cols, values = [], [], []
+
+    for row, text in enumerate(texts):
+        tokens = tokenize(text)
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        counts = {}
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+
+        for feature, count in counts.items():
+            h = zlib.crc32(feature.encode())
+            rows.append(row)
+            cols.append(h % dim)
+            values.append((1.0 + math.log(count)) * (1.0 if h & 0x80000000 else -1.0))
+
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(matrix, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), values)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+@lru_cache(maxsize=None)
+def get_embedder():
+    """The configured embedding callable: list[str] -> float32 array of shape (n, dim)."""
+    return import_string(settings.RAG_EMBEDDING_FUNCTION)
+
+
+def embed(texts: list) -> np.ndarray:
+    return np.ascontiguousarray(get_embedder()(texts), dtype=np.float32)
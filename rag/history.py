@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from asgiref.sync import sync_to_async
+from functools import lru_cache
+import json
+import re
+from .cache import digest, normalize
+from .context import count_model_tokens, model_spec
+from .redis_client import get_async_redis
+from .tokens import count_tokens
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s")
+SUMMARY_WORDS = 40  # per folded message
+
+SPEAKERS = {"user": "USER", "bot": "AI"}
+
+
+def format_messages(messages: list) -> str:
+    return "".join(f"{SPEAKERS[chat['role']]}: {chat['content']}\n" for chat in messages if chat['role'] in SPEAKERS)
+
+
+def render(summary: str, messages: list) -> str:
+    text = format_messages(messages)
+    if summary:
+        text = f"SUMMARY OF THE EARLIER CONVERSATION:\n{summary}\n\n" + text
+    return text
+
+
+def extractive_summary(summary: str, messages: list, max_tokens: int) -> str:
+    """
+    Default summarizer: one line per folded message with its opening
+    sentence, appended to the previous summary. The oldest lines go first
+    once the summary exceeds max_tokens.
+    """
+    lines = summary.splitlines() if summary else []
+    for chat in messages:
+        if chat['role'] not in SPEAKERS:
+            continue
+        sentences = SENTENCE_RE.split(normalize(chat['content']), 1)
+        words = sentences[0].split()
+        line = " ".join(words[:SUMMARY_WORDS])
+        if len(words) > SUMMARY_WORDS or len(sentences) > 1:
+            line += " ..."
+        lines.append(f"- {SPEAKERS[chat['role']]}: {line}")
+
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=None)
+def get_summarizer():
+    return import_string(settings.RAG_HISTORY_SUMMARIZER)
+
+
+def history_key(project_id, conversation: str) -> str:
+    return f"{project_id}:history:{conversation}"
+
+
+def conversation_of(messages: list) -> str:
+    # clients that send their own history have no conversation id, the opening message stands in for one
+    return digest([messages[0]['role'], normalize(messages[0]['content'])])
+
+
+def measure(summary: str, messages: list, model: str = None) -> int:
+    if all("tokens" in chat for chat in messages):
+        # stored conversations carry per-message counts, nothing to re-tokenise
+        return count_model_tokens(summary, model) + int(sum(chat["tokens"] for chat in messages) * model_spec(model)["token_ratio"])
+    return count_model_tokens(render(summary, messages), model)
+
+
+def compact(messages: list, state: dict, model: str = None):
+    """
+    The history text for the prompt and the state to store, or None when the
+    stored state is still good. Messages already folded into the summary stay
+    folded; the summary is only recomputed when summary + verbatim messages
+    exceed RAG_HISTORY_MAX_TOKENS, and then everything but the last
+    RAG_HISTORY_TURNS messages is folded in.
+    """
+    summary, covered = "", 0
+    if state and state["covered"] <= len(messages) and state["digest"] == digest(messages[:state["covered"]]):
+        summary, covered = state["summary"], state["covered"]
+
+    if measure(summary, messages[covered:], model) <= settings.RAG_HISTORY_MAX_TOKENS:
+        return render(summary, messages[covered:]), None
+
+    folded = max(covered, len(messages) - settings.RAG_HISTORY_TURNS)
+    summary = get_summarizer()(summary, messages[covered:folded], settings.RAG_HISTORY_SUMMARY_TOKENS)
+    state = {"covered": folded, "digest": digest(messages[:folded]), "summary": summary}
+    return render(summary, messages[folded:]), state
+
+
+async def chat_history(project_id, messages: list, model: str = None, conversation_id=None) -> str:
+    """
+    The conversation so far as prompt text, holding roughly constant in size
+    however long the session runs: the last messages verbatim, older ones in
+    a rolling summary cached per conversation.
+    """
+    messages = [chat for chat in messages if chat['role'] in SPEAKERS]
+    if len(messages) <= settings.RAG_HISTORY_TURNS:
+        return format_messages(messages)
+
+    redis = get_async_redis()
+    key = history_key(project_id, conversation_id or conversation_of(messages))
+    stored = await redis.get(key)
+
+    text, state = await sync_to_async(compact, thread_sensitive=False)(
+        messages, json.loads(stored) if stored else None, model
+    )
+    if state is not None:
+        await redis.set(key, json.dumps(state), ex=settings.RAG_HISTORY_TTL)
+    elif stored:
+        await redis.expire(key, settings.RAG_HISTORY_TTL)
+    return text
@@ -0,0 +1,68 @@
+from django.conf import settings
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+import os
+import shutil
+import threading
+
+# re-entrant: indexing holds it while calling the retrieval helpers that take it too
+_locks = defaultdict(threading.RLock)
+_locks_guard = threading.Lock()
+
+
+def project_lock(project_id) -> threading.RLock:
+    """Serialises index writes per project within this worker."""
+    with _locks_guard:
+        return _locks[str(project_id)]
+
+
+def index_dir(project_id) -> Path:
+    return Path(settings.RAG_INDEX_ROOT) / str(project_id)
+
+
+def remove_index_dir(project_id):
+    shutil.rmtree(index_dir(project_id), ignore_errors=True)
+
+
+def atomic_save(path: Path, write):
+    """Write through a temp file and rename so readers never see a partial index."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class IndexCache:
+    """Small per-worker LRU of loaded indexes, invalidated by the file's mtime."""
+
+    def __init__(self, size: int = None):
+        self.size = size or settings.RAG_INDEX_CACHE_SIZE
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: Path, loader):
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.discard(path)
+            return None
+
+        with self.lock:
+            cached = self.items.get(path)
+            if cached and cached[0] == mtime:
+                self.items.move_to_end(path)
+                return cached[1]
+
+        index = loader(path)
+
+        with self.lock:
+            self.items[path] = (mtime, index)
+            self.items.move_to_end(path)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return index
+
+    def discard(self, path: Path):
+        with self.lock:
+            self.items.pop(path, None)
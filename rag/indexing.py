@@ -0,0 +1,187 @@
+from django.conf import settings
+from django.db.models import F, Sum
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from . import retrieval
+from .corpus import file_block, get_corpus, set_corpus, delete_corpus
+from .chunking import chunk_file
+from .indexes import project_lock
+from .tokens import count_tokens
+from .models import UploadedFile, Project
+
+logger = logging.getLogger(__name__)
+
+
+class FileReadError(Exception):
+    pass
+
+
+def read_file(file) -> str:
+    try:
+        with file.file.open(mode="r") as f:
+            return f.read()
+    except Exception as e:
+        logger.error(f"Reading {file.file.name} failed: {e}")
+        raise FileReadError(file.file.name) from e
+
+
+def file_name(file) -> str:
+    return file.file.name.split('/')[-1]
+
+
+def strip_file_block(corpus: str, filename: str) -> str:
+    """Remove a file's block from the corpus blob without reading the file."""
+    start = corpus.find(f"<FILE>FILENAME: {filename},\nCONTENT: ")
+    if start == -1:
+        return corpus
+    following = corpus.find("</FILE><FILE>FILENAME: ", start)
+    end = following + len("</FILE>") if following != -1 else len(corpus)
+    return corpus[:start] + corpus[end:]
+
+
+def read_files(files: list):
+    """Yield (file, content) in the order given while up to RAG_READ_WORKERS
+    files are fetched from storage concurrently."""
+    pool = ThreadPoolExecutor(max_workers=settings.RAG_READ_WORKERS, thread_name_prefix="read")
+    try:
+        yield from zip(files, pool.map(read_file, files))
+    finally:
+        # a failed read abandons the reads still queued
+        pool.shutdown(cancel_futures=True)
+
+
+def rebuild_project(project_id, progress=None):
+    """Re-read every file of the project and rebuild its chunks and indexes.
+    `progress(processed, total)` is called as files are read.
+
+    Files are read without the project lock, so uploads and deletes are not
+    held up behind storage; the lock is taken only to swap the result in."""
+    project_id = str(project_id)
+    files = list(UploadedFile.objects.filter(project_id=project_id))
+
+    chunks = {}
+    for file, content in read_files(files):
+        chunks[file.unique_id] = prepare_file(file, content)
+        if progress:
+            progress(len(chunks), len(files))
+
+    with project_lock(project_id):
+        # files uploaded or deleted while the others were read
+        current = list(UploadedFile.objects.filter(project_id=project_id))
+        for file in current:
+            if file.unique_id not in chunks:
+                chunks[file.unique_id] = prepare_file(file, read_file(file))
+        current = [file.unique_id for file in current]
+
+        total_tokens = UploadedFile.objects.filter(project_id=project_id).aggregate(total=Sum("token_count"))["total"]
+        Project.objects.filter(unique_id=project_id).update(knowledge_tokens=total_tokens or 0)
+
+        retrieval.clear_chunks(project_id)
+        for file_id in current:
+            retrieval.save_file_chunks(project_id, file_id, chunks[file_id])
+        retrieval.build_index(project_id, [c for file_id in current for c in chunks[file_id]])
+        # once chunked, the project is answered from its chunks and the blob goes
+        delete_corpus(project_id)
+
+
+def prepare_file(file, content: str) -> list:
+    """Chunk a file's text and store its token count; needs no lock."""
+    file.token_count = count_tokens(file_block(file_name(file), content))
+    UploadedFile.objects.filter(pk=file.pk).update(token_count=file.token_count)
+    return chunk_file(file, content)
+
+
+def add_file(project_id, file, chunks: list):
+    """Store and index a prepared file. Called with the project lock held."""
+    retrieval.save_file_chunks(project_id, file.unique_id, chunks)
+    retrieval.add_to_index(project_id, chunks)
+    Project.objects.filter(unique_id=project_id).update(knowledge_tokens=F("knowledge_tokens") + file.token_count)
+
+
+def index_file(file, progress=None):
+    """Add one newly uploaded file to its project's chunks and indexes."""
+    project_id = str(file.project_id_id)
+    chunks = prepare_file(file, read_file(file))
+
+    with project_lock(project_id):
+        # checked under the lock: a concurrent job may be writing the first chunks
+        legacy = not settings.REDIS_CLOUD.exists(retrieval.chunks_key(project_id)) and settings.REDIS_CLOUD.strlen(project_id)
+        if not legacy and not retrieval.has_file_chunks(project_id, file.unique_id):
+            add_file(project_id, file, chunks)
+            if progress:
+                progress(1, 1)
+
+    if legacy:
+        # the corpus predates chunking, bring it up to date in one go
+        rebuild_project(project_id, progress)
+
+
+def sync_project(project_id, progress=None):
+    """
+    Bring chunks and indexes in line with the project's files: index
+    the files that have no chunks yet and drop the chunks of files that are
+    gone. Only a project that predates chunking is rebuilt in full.
+
+    As in rebuild_project, the new files are read without the project lock.
+    """
+    project_id = str(project_id)
+
+    with project_lock(project_id):
+        chunked = settings.REDIS_CLOUD.exists(retrieval.chunks_key(project_id))
+        if chunked:
+            files = {str(file.unique_id): file for file in UploadedFile.objects.filter(project_id=project_id)}
+            indexed = set(retrieval.chunked_files(project_id))
+            missing = [file for file_id, file in files.items() if file_id not in indexed]
+
+            for file_id in indexed - set(files):
+                retrieval.remove_file_chunks(project_id, file_id)
+                retrieval.remove_from_index(project_id, file_id)
+            # a blob written next to the chunks by earlier versions is never read
+            delete_corpus(project_id)
+
+    if not chunked:
+        rebuild_project(project_id, progress)
+        return
+
+    prepared = []
+    for file, content in read_files(missing):
+        prepared.append((file, prepare_file(file, content)))
+        if progress:
+            progress(len(prepared), len(missing))
+
+    with project_lock(project_id):
+        current = {str(file_id) for file_id in UploadedFile.objects.filter(project_id=project_id).values_list("unique_id", flat=True)}
+        for file, chunks in prepared:
+            # skip files deleted while reading, or indexed by a concurrent job
+            if str(file.unique_id) in current and not retrieval.has_file_chunks(project_id, file.unique_id):
+                add_file(project_id, file, chunks)
+
+        # deleted files' counts are gone with their rows
+        total = UploadedFile.objects.filter(project_id=project_id).aggregate(total=Sum("token_count"))["total"]
+        Project.objects.filter(unique_id=project_id).update(knowledge_tokens=total or 0)
+
+
+def unindex_file(project_id, file_id, filename: str, progress=None):
+    """Drop a deleted file from its project's corpus, chunks and indexes. Only
+    the file's name is needed, the stored file is not read."""
+    project_id = str(project_id)
+
+    with project_lock(project_id):
+        if retrieval.has_file_chunks(project_id, file_id):
+            retrieval.remove_file_chunks(project_id, file_id)
+            retrieval.remove_from_index(project_id, file_id)
+        elif not settings.REDIS_CLOUD.exists(retrieval.chunks_key(project_id)):
+            # unchunked projects still answer from the blob, so strip it there
+            corpus = get_corpus(project_id)
+            stripped = strip_file_block(corpus or "", filename)
+            if stripped != (corpus or ""):
+                set_corpus(project_id, stripped)
+                # answers and prompt prefixes are cached by corpus version
+                retrieval.bump_corpus_version(project_id)
+
+        # the file's row is gone by now, the remaining counts are the total
+        total = UploadedFile.objects.filter(project_id=project_id).aggregate(total=Sum("token_count"))["total"]
+        Project.objects.filter(unique_id=project_id).update(knowledge_tokens=total or 0)
+
+    if progress:
+        progress(1, 1)
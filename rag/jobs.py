@@ -0,0 +1,115 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from datetime import timedelta
+import logging
+import threading
+from . import indexing
+from .models import IngestionJob
+from .serializer import IngestionJobSerializer
+
+logger = logging.getLogger(__name__)
+
+# ingestion is file IO plus NumPy, threads keep it off daphne's event loop
+_executor = ThreadPoolExecutor(max_workers=settings.RAG_INGEST_WORKERS, thread_name_prefix="ingest")
+
+# jobs this process has handed to its executor and not finished; anything else
+# queued or running in the database may have been lost in a restart
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def group_name(project_id) -> str:
+    return f"ingest_{project_id}"
+
+
+def publish(job):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    try:
+        async_to_sync(layer.group_send)(
+            group_name(job.project_id_id), {"type": "ingest.progress", "job": IngestionJobSerializer(job).data}
+        )
+    except Exception as e:
+        logger.error(f"Publishing job {job.unique_id} failed: {e}")
+
+
+def update(job, **fields):
+    fields["updated_at"] = timezone.now()
+    for field, value in fields.items():
+        setattr(job, field, value)
+    IngestionJob.objects.filter(pk=job.pk).update(**fields)
+    publish(job)
+
+
+def expire_stale(project_id):
+    """Fail the project's queued/running jobs that nobody has advanced for
+    RAG_JOB_STALE_AFTER, i.e. the ones lost with a restarted worker."""
+    cutoff = timezone.now() - timedelta(seconds=settings.RAG_JOB_STALE_AFTER)
+    stale = IngestionJob.objects.filter(project_id=project_id, status__in=["queued", "running"], updated_at__lt=cutoff)
+    with _pending_lock:
+        stale = [job for job in stale if job.pk not in _pending]
+    for job in stale:
+        logger.error(f"Ingestion job {job.unique_id} was interrupted")
+        update(job, status="failed", error="Interrupted by a restart, run it again.")
+
+
+def dispatch(job):
+    with _pending_lock:
+        _pending.add(job.pk)
+    _executor.submit(run, job.pk)
+
+
+def submit(kind: str, project_id, file=None) -> IngestionJob:
+    """Queue an ingestion job; a rebuild or sync already waiting in this
+    process' executor for the project is reused."""
+    expire_stale(project_id)
+    if kind in ("rebuild", "sync"):
+        with _pending_lock:
+            pending = set(_pending)
+        queued = IngestionJob.objects.filter(project_id=project_id, kind=kind, status="queued", pk__in=pending).first()
+        if queued:
+            return queued
+
+    if kind == "unindex":
+        # the file's row is deleted before the job runs
+        job = IngestionJob.objects.create(project_id_id=project_id, kind=kind, total=1, removed={
+            "unique_id": str(file.unique_id), "name": indexing.file_name(file),
+        })
+    else:
+        job = IngestionJob.objects.create(project_id_id=project_id, file=file, kind=kind, total=1 if file else 0)
+    transaction.on_commit(lambda: dispatch(job))
+    publish(job)
+    return job
+
+
+def run(job_pk):
+    close_old_connections()
+    try:
+        job = IngestionJob.objects.select_related("file").get(pk=job_pk)
+        update(job, status="running")
+
+        def progress(processed, total):
+            update(job, processed=processed, total=total)
+
+        try:
+            if job.kind == "rebuild":
+                indexing.rebuild_project(job.project_id_id, progress)
+            elif job.kind == "sync":
+                indexing.sync_project(job.project_id_id, progress)
+            elif job.kind == "unindex":
+                indexing.unindex_file(job.project_id_id, job.removed["unique_id"], job.removed["name"], progress)
+            elif job.file is not None:  # None when the file was deleted while queued
+                indexing.index_file(job.file, progress)
+            update(job, status="done")
+        except Exception as e:
+            logger.error(f"Ingestion job {job.unique_id} failed: {e}")
+            update(job, status="failed", error=str(e))
+    finally:
+        with _pending_lock:
+            _pending.discard(job_pk)
+        close_old_connections()
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+import numpy as np
+from rag import vector_index
+from rag.ann import HNSWIndex, IVFFlatIndex, recall_report, synthetic_vectors
+
+
+class Command(BaseCommand):
+    help = "Recall-vs-latency of the HNSW and IVF-flat indexes against exact search."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", help="Use this project's stored embeddings instead of synthetic data.")
+        parser.add_argument("--size", type=int, default=20_000, help="Synthetic vectors to generate.")
+        parser.add_argument("--dim", type=int, default=256)
+        parser.add_argument("--queries", type=int, default=100)
+        parser.add_argument("--k", type=int, default=10)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+
+        if options["project"]:
+            manifest = vector_index.index_dir(options["project"]) / "vectors.json"
+            stored = vector_index.FlatIndex.load(manifest) if manifest.exists() else None
+            if stored is None or not len(stored):
+                raise CommandError("Project has no vector index, run set_redis first.")
+            vectors = np.asarray(stored.vectors)
+        else:
+            vectors = synthetic_vectors(options["size"], options["dim"], rng)
+
+        queries = vectors[rng.choice(len(vectors), options["queries"], replace=False)]
+        queries = queries + rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        file_ids = np.asarray(["synthetic"] * len(vectors), dtype="U36")
+        positions = np.arange(len(vectors), dtype=np.int32)
+
+        for cls in (HNSWIndex, IVFFlatIndex):
+            index = cls(vectors, file_ids, positions)
+            started = time.perf_counter()
+            index.link(np.arange(len(vectors)))
+            self.stdout.write(f"\n{cls.kind}: {len(vectors)} vectors, built in {time.perf_counter() - started:.1f}s")
+
+            for row in recall_report(index, queries, k=options["k"]):
+                knob, value = next(iter(row.items()))
+                self.stdout.write(
+                    f"  {knob}={value:<4} recall@{options['k']}={row['recall']:.3f} "
+                    f"mean={row['mean_ms']:.2f}ms p95={row['p95_ms']:.2f}ms exact={row['exact_ms']:.2f}ms"
+                )
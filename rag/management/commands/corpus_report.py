@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import statistics
+import time
+import uuid
+from rag import corpus, retrieval
+
+
+class Command(BaseCommand):
+    help = "Size and encode/decode/Redis round-trip time of the corpus storage codecs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", help="Measure this project's stored corpus instead of a synthetic one.")
+        parser.add_argument("--size", type=int, default=4_000_000, help="Synthetic corpus size in characters.")
+        parser.add_argument("--repeat", type=int, default=10)
+        parser.add_argument("--redis", action="store_true", help="Also time SET/GET round trips and MEMORY USAGE against Redis.")
+
+    def handle(self, *args, **options):
+        if options["project"]:
+            text = retrieval.corpus_text(options["project"])
+            if not text:
+                raise CommandError("Project has no corpus, run set_redis first.")
+        else:
+            text = self.synthetic(options["size"])
+
+        raw = len(text.encode())
+        self.stdout.write(f"corpus: {raw / 1e6:.2f} MB")
+
+        codecs = {"raw": corpus.RAW, "zlib": corpus.ZLIB}
+
+        for name, codec in codecs.items():
+            encoded = corpus.encode(text, codec)
+            encode_ms = self.timed(lambda: corpus.encode(text, codec), options["repeat"])
+            decode_ms = self.timed(lambda: corpus.decode(encoded), options["repeat"])
+            line = (f"  {name:<5} {len(encoded) / 1e6:8.2f} MB  ratio={raw / len(encoded):5.2f}x  "
+                    f"encode={encode_ms:7.1f}ms  decode={decode_ms:7.1f}ms")
+
+            if options["redis"]:
+                key = f"corpus_report:{uuid.uuid4().hex}"
+                try:
+                    settings.REDIS_BINARY.set(key, encoded)
+                    memory = settings.REDIS_BINARY.memory_usage(key)
+                    get_ms = self.timed(lambda: corpus.decode(settings.REDIS_BINARY.get(key)), options["repeat"])
+                finally:
+                    settings.REDIS_BINARY.delete(key)
+                line += f"  redis={memory / 1e6:.2f} MB  get+decode={get_ms:7.1f}ms"
+
+            self.stdout.write(line)
+
+    def timed(self, func, repeat: int) -> float:
+        """Median wall time of func in milliseconds."""
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
+
+    def synthetic(self, size: int) -> str:
+        # patent-like prose: a limited vocabulary with lots of repeated phrasing
+        import random
+
+        rng = random.Random(0)
+        words = ("said apparatus comprising a first second member configured to receive wherein the "
+                 "method according to claim substrate layer coupled signal processing unit plurality of "
+                 "embodiment device surface portion least one").split()
+        parts, length = [], 0
+        while length < size:
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(8, 30))).capitalize() + ". "
+            parts.append(sentence)
+            length += len(sentence)
+        return "".join(parts)[:size]
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from rag import providers
+
+# run in a fresh interpreter so imports are measured cold
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter() - started
+import rag.consumers
+consumer = time.perf_counter() - started - setup
+from rag import providers
+clients = {{name: 0.0 for name in {names!r}}}
+for name in clients:
+    started = time.perf_counter()
+    providers.get_client(name)
+    clients[name] = time.perf_counter() - started
+print(json.dumps({{"setup": setup, "consumer": consumer, "clients": clients}}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Worker startup cost and per-request connection setup of the LLM provider clients."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--provider", action="append", choices=sorted(providers.BUILDERS),
+                            help="Provider to measure, repeatable. Defaults to all.")
+        parser.add_argument("--requests", type=int, default=0,
+                            help="Also time this many API calls with a pooled vs a fresh client (needs API keys).")
+
+    def handle(self, *args, **options):
+        names = options["provider"] or sorted(providers.BUILDERS)
+
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT.format(names=names)],
+            capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+        if result.returncode:
+            raise CommandError(result.stderr.strip().splitlines()[-1])
+        startup = json.loads(result.stdout.strip().splitlines()[-1])
+
+        self.stdout.write(f"django.setup: {startup['setup'] * 1000:.0f}ms")
+        self.stdout.write(f"import rag.consumers: {startup['consumer'] * 1000:.0f}ms")
+        for name, seconds in startup["clients"].items():
+            self.stdout.write(f"  {name:<10} first use: {seconds * 1000:.0f}ms")
+
+        if options["requests"]:
+            for name in names:
+                if name == "gemini":
+                    self.stdout.write(f"\n{name}: grpc client, connection timing skipped")
+                    continue
+                pooled, fresh = asyncio.run(self.time_requests(name, options["requests"]))
+                self.stdout.write(
+                    f"\n{name}: pooled median={statistics.median(pooled) * 1000:.0f}ms "
+                    f"fresh median={statistics.median(fresh) * 1000:.0f}ms over {options['requests']} calls"
+                )
+
+    async def time_requests(self, name, count):
+        """Latency of a cheap authenticated call (listing models) through the
+        shared pool and through a client built for the single request."""
+        pooled, fresh = [], []
+        client = providers.BUILDERS[name]()
+
+        for _ in range(count):
+            started = time.perf_counter()
+            await client.models.list()
+            pooled.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            single = providers.BUILDERS[name]()
+            await single.models.list()
+            fresh.append(time.perf_counter() - started)
+            await single.close()
+
+        await client.close()
+        return pooled, fresh
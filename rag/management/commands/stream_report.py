@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from channels.testing import WebsocketCommunicator
+import asyncio
+import json
+import statistics
+import time
+from rag.consumers import ChatConsumer
+
+
+class BenchConsumer(ChatConsumer):
+    """Streams a synthetic answer through the real stream_response."""
+
+    channel_layer_alias = None  # no channel layer needed
+
+    async def connect(self):
+        await self.accept()
+        self.stop_streaming = False
+
+    async def receive(self, text_data=None, bytes_data=None):
+        options = json.loads(text_data)
+
+        async def chunks():
+            for _ in range(options["chunks"]):
+                if options["delay"]:
+                    await asyncio.sleep(options["delay"])
+                yield "x" * options["chunk_size"]
+
+        await self.send(json.dumps({"status": "ready", "message": "<SOS> "}))
+        await self.stream_response(chunks())
+
+
+class Command(BaseCommand):
+    help = "Frames and throughput of concurrent streamed answers, one frame per chunk vs batched frames."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--streams", type=int, default=200, help="Concurrent websocket streams.")
+        parser.add_argument("--chunks", type=int, default=400, help="Provider chunks per answer.")
+        parser.add_argument("--chunk-size", type=int, default=4, help="Characters per chunk.")
+        parser.add_argument("--delay", type=float, default=0.002, help="Seconds between a stream's chunks.")
+        parser.add_argument("--flush-ms", type=float, action="append",
+                            help="Flush interval to compare, repeatable. Defaults to 0 and RAG_STREAM_FLUSH_MS.")
+        parser.add_argument("--flush-bytes", type=int, default=settings.RAG_STREAM_FLUSH_BYTES)
+
+    def handle(self, *args, **options):
+        intervals = options["flush_ms"] or [0, settings.RAG_STREAM_FLUSH_MS]
+        self.stdout.write(
+            f"{options['streams']} streams x {options['chunks']} chunks of {options['chunk_size']} chars, "
+            f"{options['delay'] * 1000:.1f}ms apart"
+        )
+
+        for interval in intervals:
+            settings.RAG_STREAM_FLUSH_MS = interval
+            settings.RAG_STREAM_FLUSH_BYTES = options["flush_bytes"]
+            wall, frames, characters, first = asyncio.run(self.run(options))
+            self.stdout.write(
+                f"  flush={interval:g}ms/{options['flush_bytes']}B  frames={frames:7d}  "
+                f"frames/s={frames / wall:9.0f}  text={characters / wall / 1e6:6.2f} MB/s  "
+                f"wall={wall:6.2f}s  first frame p50={statistics.median(first) * 1000:6.1f}ms"
+            )
+
+    async def run(self, options):
+        message = json.dumps({key: options[key] for key in ("chunks", "chunk_size", "delay")})
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self.stream(message) for _ in range(options["streams"])))
+        wall = time.perf_counter() - started
+        return (
+            wall,
+            sum(frames for frames, _, _ in results),
+            sum(characters for _, characters, _ in results),
+            [first for _, _, first in results],
+        )
+
+    async def stream(self, message: str):
+        """Frames and characters received for one answer, and the time to its first text."""
+        communicator = WebsocketCommunicator(BenchConsumer.as_asgi(), "/ws/bench/")
+        await communicator.connect()
+        sent = time.perf_counter()
+        await communicator.send_to(text_data=message)
+
+        frames = characters = 0
+        first = None
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=60))
+            if frame["status"] == "streaming":
+                frames += 1
+                characters += len(frame["message"])
+                if first is None:
+                    first = time.perf_counter() - sent
+            elif frame["status"] == "completed":
+                break
+        await communicator.disconnect()
+        return frames, characters, first
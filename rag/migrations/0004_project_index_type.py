@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0003_alter_uploadedfile_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='index_type',
+            field=models.CharField(choices=[('flat', 'Exact'), ('hnsw', 'HNSW graph'), ('ivf', 'IVF-flat')], default='flat', max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0004_project_index_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='vector_storage',
+            field=models.CharField(choices=[('float32', 'float32'), ('int8', 'int8 scalar quantization'), ('pq', 'Product quantization')], default='float32', max_length=10),
+        ),
+    ]
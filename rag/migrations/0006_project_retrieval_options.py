@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0005_project_vector_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='rerank',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='retrieval_mode',
+            field=models.CharField(choices=[('bm25', 'Lexical (BM25)'), ('dense', 'Dense vectors'), ('hybrid', 'BM25 + dense, rank fusion')], default='hybrid', max_length=10),
+        ),
+    ]
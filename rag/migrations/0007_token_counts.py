@@ -0,0 +1,28 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0006_project_retrieval_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='instruction_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='knowledge_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:05
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0007_token_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unique_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('kind', models.CharField(choices=[('index', 'Index one file'), ('rebuild', 'Rebuild the project'), ('sync', 'Index new files, drop deleted ones'), ('unindex', 'Drop one deleted file')], max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('removed', models.JSONField(blank=True, null=True)),
+                ('file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='rag.uploadedfile', to_field='unique_id')),
+                ('project_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='rag.project', to_field='unique_id')),
+            ],
+        ),
+    ]
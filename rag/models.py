@@ -3,10 +3,34 @@ from django.db import models
 # from storages.backends.s3boto3 import S3Boto3Storage
 
 class Project(models.Model):
+    INDEX_TYPES = [
+        ("flat", "Exact"),
+        ("hnsw", "HNSW graph"),
+        ("ivf", "IVF-flat"),
+    ]
+
+    VECTOR_STORAGES = [
+        ("float32", "float32"),
+        ("int8", "int8 scalar quantization"),
+        ("pq", "Product quantization"),
+    ]
+
+    RETRIEVAL_MODES = [
+        ("bm25", "Lexical (BM25)"),
+        ("dense", "Dense vectors"),
+        ("hybrid", "BM25 + dense, rank fusion"),
+    ]
+
     project_name = models.CharField(max_length=100)
     unique_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     instruction = models.TextField(blank=True, null=True)
+    index_type = models.CharField(max_length=10, choices=INDEX_TYPES, default="flat")
+    vector_storage = models.CharField(max_length=10, choices=VECTOR_STORAGES, default="float32")
+    retrieval_mode = models.CharField(max_length=10, choices=RETRIEVAL_MODES, default="hybrid")
+    rerank = models.BooleanField(default=True)
+    instruction_tokens = models.PositiveIntegerField(default=0)
+    knowledge_tokens = models.PositiveBigIntegerField(default=0) # sum of the files' token_count
 
     def __str__(self):
         return self.project_name
@@ -17,6 +41,38 @@ class UploadedFile(models.Model):
     file = models.FileField(upload_to='media') # models.FileField(storage=S3Boto3Storage())
     uploaded_at = models.DateTimeField(auto_now_add=True)
     project_id = models.ForeignKey(Project, to_field='unique_id', related_name="project", on_delete=models.CASCADE)
+    token_count = models.PositiveIntegerField(default=0) # counted once at ingest
 
     def __str__(self):
         return self.file.name
+
+
+class IngestionJob(models.Model):
+    KINDS = [
+        ("index", "Index one file"),
+        ("rebuild", "Rebuild the project"),
+        ("sync", "Index new files, drop deleted ones"),
+        ("unindex", "Drop one deleted file"),
+    ]
+
+    STATUSES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    unique_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    project_id = models.ForeignKey(Project, to_field='unique_id', related_name="jobs", on_delete=models.CASCADE)
+    file = models.ForeignKey(UploadedFile, to_field='unique_id', related_name="jobs", null=True, blank=True, on_delete=models.SET_NULL)
+    removed = models.JSONField(null=True, blank=True) # unique_id and name of the deleted file an unindex job drops
+    kind = models.CharField(max_length=10, choices=KINDS)
+    status = models.CharField(max_length=10, choices=STATUSES, default="queued")
+    processed = models.PositiveIntegerField(default=0) # files done
+    total = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.unique_id} ({self.status})"
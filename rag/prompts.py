@@ -0,0 +1,107 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+import threading
+from . import retrieval
+from .cache import digest
+from .context import count_model_tokens, context_budget
+from .corpus import aget_corpus
+
+# rendered prefixes of projects answered from the whole corpus blob
+_prefixes = OrderedDict()
+_prefixes_lock = threading.Lock()
+
+
+class Prompt:
+    """
+    A chat turn's prompt, split into a prefix that repeats from turn to turn
+    (instruction and context) and a suffix that changes every turn (history
+    and query). Providers cache prompts by prefix, so nothing that varies per
+    turn may go before the split.
+    """
+
+    def __init__(self, prefix: str, suffix: str, prefix_tokens: dict = None):
+        self.prefix = prefix
+        self.suffix = suffix
+        # model -> token count of the prefix, shared with the prefix cache
+        self.prefix_tokens = {} if prefix_tokens is None else prefix_tokens
+
+    def __str__(self):
+        return self.prefix + self.suffix
+
+    def count_tokens(self, model: str = None) -> int:
+        if model not in self.prefix_tokens:
+            self.prefix_tokens[model] = count_model_tokens(self.prefix, model)
+        return self.prefix_tokens[model] + count_model_tokens(self.suffix, model)
+
+
+def render_prefix(instruction: str = "", context: str = "") -> str:
+    return f"""
+        {instruction or ""}
+
+        You can use the following context to answer the question if relevant:
+        {context or ""}
+        """
+
+
+def render_suffix(query: str, chat_history: str = "") -> str:
+    return f"""
+        {chat_history}
+        USER: {query}
+        """
+
+
+def prefix_key(project_id, version: int, instruction: str, model: str = None) -> tuple:
+    return str(project_id), version, digest(instruction or ""), model
+
+
+def cached_prefix(key: tuple):
+    with _prefixes_lock:
+        entry = _prefixes.get(key)
+        if entry is not None:
+            _prefixes.move_to_end(key)
+        return entry
+
+
+def cache_prefix(key: tuple, entry: tuple):
+    with _prefixes_lock:
+        _prefixes[key] = entry
+        while len(_prefixes) > settings.RAG_PREFIX_CACHE_SIZE:
+            _prefixes.popitem(last=False)
+
+
+async def build_prompt(project_id, version: int, query: str, model: str = None, instruction: str = "",
+                       chat_history: str = "") -> Prompt:
+    """
+    The prompt of a chat turn. Projects answered from the corpus blob get the
+    same prefix on every turn until the corpus version, the instruction or the
+    model changes, so it is rendered once per worker and reused, blob fetch
+    and token count included. Retrieved context depends on the query and is
+    rendered each turn.
+
+    The blob is cut to the room left with the history at RAG_HISTORY_MAX_TOKENS,
+    which is the same every turn; a turn with less room than that gets its own,
+    uncached cut.
+    """
+    suffix = render_suffix(query, chat_history)
+
+    key = prefix_key(project_id, version, instruction, model)
+    entry = cached_prefix(key)
+    if entry is None and await retrieval.ahas_chunks(project_id):
+        context = await retrieval.aranked_context(project_id, query, model, instruction, chat_history)
+        return Prompt(render_prefix(instruction, context), suffix)
+
+    budget = await sync_to_async(context_budget, thread_sensitive=False)(model, instruction, chat_history, query)
+    if entry is not None and entry[2] <= budget:
+        prefix, prefix_tokens, _ = entry
+        return Prompt(prefix, suffix, prefix_tokens)
+
+    shared = await sync_to_async(context_budget, thread_sensitive=False)(model, instruction)
+    shared = max(0, shared - settings.RAG_HISTORY_MAX_TOKENS)
+    blob = await sync_to_async(retrieval.blob_context, thread_sensitive=False)(
+        project_id, await aget_corpus(project_id), min(shared, budget), model
+    )
+    prompt = Prompt(render_prefix(instruction, blob), suffix)
+    if shared <= budget:
+        cache_prefix(key, (prompt.prefix, prompt.prefix_tokens, shared))
+    return prompt
@@ -0,0 +1,101 @@
+from django.conf import settings
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_lock = threading.Lock()
+
+# seconds each provider spent on SDK import + client construction in this worker
+timings = {}
+
+
+def http_client():
+    """
+    Keep-alive connection pool handed to an SDK client. One pool is shared by
+    every connection of the worker, so streams reuse warm TLS connections
+    instead of paying a handshake per message.
+    """
+    import httpx
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.RAG_PROVIDER_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.RAG_PROVIDER_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.RAG_PROVIDER_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.RAG_PROVIDER_TIMEOUT, connect=settings.RAG_PROVIDER_CONNECT_TIMEOUT),
+    )
+
+
+def openai_compatible(api_key, base_url=None):
+    import openai
+
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client())
+
+
+def build_together():
+    return openai_compatible(settings.TOGETHER_API_KEY, settings.TOGETHER_API_BASE_URL)
+
+
+def build_openai():
+    return openai_compatible(settings.OPENAI_API_KEY)
+
+
+def build_alibaba():
+    return openai_compatible(settings.ALIBABA_API_KEY, settings.ALIBABA_BASE_URL)
+
+
+def build_anthropic():
+    import anthropic
+
+    return anthropic.AsyncAnthropic(api_key=settings.CLAUDE_API_KEY, http_client=http_client())
+
+
+def build_gemini():
+    # gemini talks grpc, its channel is pooled by the SDK itself
+    import google.generativeai as genai
+
+    genai.configure(api_key=settings.GEMINI_API_KEY)
+    return genai.GenerativeModel(settings.GEMINI_RAG_MODEL_PRO)
+
+
+BUILDERS = {
+    "together": build_together,
+    "openai": build_openai,
+    "alibaba": build_alibaba,
+    "anthropic": build_anthropic,
+    "gemini": build_gemini,
+}
+
+
+def is_retryable(error) -> bool:
+    """Rate limits, server errors and dropped connections are worth another provider."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "ServiceUnavailable", "DeadlineExceeded")
+
+
+def get_client(name: str):
+    """The worker's client for a provider, imported and built on first use."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        if name not in _clients:
+            started = time.perf_counter()
+            _clients[name] = BUILDERS[name]()
+            timings[name] = time.perf_counter() - started
+            logger.info(f"Provider {name} initialised in {timings[name] * 1000:.0f}ms")
+        return _clients[name]
+
+
+def warm(names=None):
+    """Build clients up front, e.g. from AppConfig.ready, so the first
+    message does not pay for the SDK import."""
+    for name in settings.RAG_PROVIDERS_PRELOAD if names is None else names:
+        get_client(name)
@@ -0,0 +1,167 @@
+from django.conf import settings
+import math
+import numpy as np
+
+BLOCK_SIZE = 65_536
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Plain (euclidean) Lloyd's k-means, used to train the PQ codebooks."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=n_clusters)
+
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+
+    return centroids.astype(np.float32)
+
+
+def nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c
+    return np.argmin((centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T, axis=1)
+
+
+class Quantizer:
+    """
+    Codec for compressed vector storage. The codes are what a query scans;
+    the float32 vectors stay on disk and are only read back to re-score the
+    best candidates.
+    """
+    kind = None
+    kinds = {}
+    trained = 0  # rows the codec was fitted on
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Quantizer.kinds[cls.kind] = cls
+
+    def train(self, vectors: np.ndarray):
+        raise NotImplementedError
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def block_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Approximate inner products, computed in blocks so decoded floats never
+        materialise for the whole matrix at once."""
+        out = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), BLOCK_SIZE):
+            out[i:i + BLOCK_SIZE] = self.block_scores(np.asarray(codes[i:i + BLOCK_SIZE]), query)
+        return out
+
+    def params(self) -> dict:
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        return sum(value.nbytes for value in self.params().values())
+
+
+class ScalarQuantizer(Quantizer):
+    """int8 scalar quantization: each dimension is mapped linearly onto 0..255."""
+    kind = "int8"
+
+    def __init__(self, low=None, scale=None, trained=0):
+        self.low = low
+        self.scale = scale
+        self.trained = int(trained)
+
+    def train(self, vectors: np.ndarray):
+        self.trained = len(vectors)
+        self.low = vectors.min(axis=0).astype(np.float32)
+        self.scale = np.maximum((vectors.max(axis=0) - self.low) / 255.0, 1e-12).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def block_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # x ~= low + scale * code  =>  x.q ~= code.(scale * q) + low.q
+        return codes.astype(np.float32) @ (self.scale * query) + float(self.low @ query)
+
+    def params(self) -> dict:
+        return {"low": self.low, "scale": self.scale, "trained": np.int64(self.trained)}
+
+
+class ProductQuantizer(Quantizer):
+    """
+    Product quantization: vectors are split into `m` sub-vectors, each replaced
+    by the id of its nearest centroid in a 256-entry codebook (one byte per
+    sub-vector). Queries are scored by asymmetric distance: one lookup table
+    of query.centroid per sub-space, summed over the codes.
+    """
+    kind = "pq"
+
+    def __init__(self, codebooks=None, trained=0):
+        self.codebooks = codebooks  # (m, 256, dim // m)
+        self.trained = int(trained)
+
+    def train(self, vectors: np.ndarray, sample_size: int = 20_000):
+        self.trained = len(vectors)
+        m = math.gcd(vectors.shape[1], settings.RAG_PQ_SUBSPACES)
+        rng = np.random.default_rng(0)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))])
+        n_centroids = min(256, len(sample))
+
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(part), n_centroids)
+            for part in np.split(sample, m, axis=1)
+        ])
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        m = len(self.codebooks)
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for i in range(0, len(vectors), BLOCK_SIZE):
+            block = np.asarray(vectors[i:i + BLOCK_SIZE])
+            for j, part in enumerate(np.split(block, m, axis=1)):
+                codes[i:i + BLOCK_SIZE, j] = nearest(part, self.codebooks[j])
+        return codes
+
+    def block_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        m = len(self.codebooks)
+        tables = np.einsum("mkd,md->mk", self.codebooks, query.reshape(m, -1))
+        return tables[np.arange(m), codes].sum(axis=1)
+
+    def params(self) -> dict:
+        return {"codebooks": self.codebooks, "trained": np.int64(self.trained)}
+
+
+def storage_report(vectors: np.ndarray, queries: np.ndarray, k: int = 10, rerank: int = None) -> list:
+    """Memory footprint and recall@k of every storage option against exact
+    float32 search, with and without the exact re-scoring stage."""
+    from .vector_index import FlatIndex, top_k
+
+    rerank = rerank or settings.RAG_RERANK_CANDIDATES
+    file_ids = np.asarray([""] * len(vectors), dtype="U36")
+    positions = np.arange(len(vectors), dtype=np.int32)
+    exact = FlatIndex(vectors, file_ids, positions)
+    truth = [{pos for _, pos, _ in exact.search_vector(query, k)} for query in queries]
+
+    rows = [{"storage": "float32", "bytes": vectors.nbytes, "recall": 1.0, "recall_no_rerank": 1.0}]
+    for kind, cls in Quantizer.kinds.items():
+        quantizer = cls()
+        quantizer.train(vectors)
+        codes = quantizer.encode(vectors)
+        index = FlatIndex(vectors, file_ids, positions, quantizer=quantizer, codes=codes)
+
+        hits = hits_no_rerank = 0
+        for query, expected in zip(queries, truth):
+            hits += len(expected & {pos for _, pos, _ in index.search_vector(query, k, rerank=rerank)})
+            hits_no_rerank += len(expected & set(top_k(quantizer.scores(codes, query), k).tolist()))
+
+        rows.append({
+            "storage": kind,
+            "bytes": codes.nbytes + quantizer.nbytes,
+            "recall": hits / (len(queries) * k),
+            "recall_no_rerank": hits_no_rerank / (len(queries) * k),
+        })
+    return rows
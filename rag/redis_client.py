@@ -0,0 +1,45 @@
+from django.conf import settings
+import asyncio
+import logging
+import time
+import weakref
+import redis
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# asyncio connections belong to the loop that opened them, so each loop gets its own pools
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_redis(binary: bool = False) -> aioredis.Redis:
+    """
+    The running loop's async client for the websocket path. Commands wait at
+    most REDIS_POOL_TIMEOUT for a pooled connection and REDIS_SOCKET_TIMEOUT
+    for the reply, so a slow Redis fails the waiting requests instead of
+    stalling the worker. `binary` is the counterpart of settings.REDIS_BINARY.
+    """
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    if binary not in clients:
+        clients[binary] = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+            max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            decode_responses=not binary,
+            **settings.REDIS_OPTIONS,
+        ))
+    return clients[binary]
+
+
+def health() -> dict:
+    """PING round trip of the sync pools, in milliseconds, or the error."""
+    report = {}
+    for name in ("REDIS_CLOUD", "REDIS_BINARY"):
+        client = getattr(settings, name)
+        started = time.perf_counter()
+        try:
+            client.ping()
+            report[name] = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 2)}
+        except redis.RedisError as e:
+            logger.error(f"Redis health check failed for {name}: {e}")
+            report[name] = {"ok": False, "error": str(e)}
+    return report
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from functools import lru_cache
+from .bm25 import tokenize
+
+
+def overlap_rerank(query: str, chunks: list) -> list:
+    """
+    Lightweight local reranker: the share of distinct query terms a chunk
+    contains, plus a bonus for each query bigram it contains verbatim (claim
+    phrases, "claim 1", compound chemical names).
+    """
+    terms = tokenize(query)
+    distinct = set(terms)
+    bigrams = set(zip(terms, terms[1:]))
+    if not distinct:
+        return [0.0] * len(chunks)
+
+    scores = []
+    for chunk in chunks:
+        tokens = tokenize(chunk["text"])
+        present = distinct.intersection(tokens)
+        phrases = bigrams.intersection(zip(tokens, tokens[1:])) if bigrams else ()
+        scores.append(len(present) / len(distinct) + 0.5 * len(phrases) / max(len(bigrams), 1))
+    return scores
+
+
+@lru_cache(maxsize=None)
+def get_reranker():
+    """The configured reranker: callable(query, list[chunk]) -> list[float]."""
+    return import_string(settings.RAG_RERANKER)
+
+
+def rerank(query: str, chunks: list) -> list:
+    """Reorder chunks by reranker score; ties keep their retrieval order."""
+    scores = get_reranker()(query, chunks)
+    order = sorted(range(len(chunks)), key=lambda i: -scores[i])
+    return [chunks[i] for i in order]
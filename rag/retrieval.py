@@ -0,0 +1,287 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import time
+from . import bm25
+from . import vector_index
+from . import context
+from . import ann  # registers the hnsw/ivf index kinds
+from .indexes import remove_index_dir, project_lock
+from .chunking import join_chunks
+from .corpus import encode, decode, file_block, get_corpus
+from .redis_client import get_async_redis
+from .rerank import rerank
+from .models import Project
+
+logger = logging.getLogger(__name__)
+
+# BM25 and dense search run side by side; both spend their time in NumPy, which releases the GIL
+_executor = ThreadPoolExecutor(max_workers=settings.RAG_RETRIEVAL_THREADS, thread_name_prefix="retrieval")
+
+
+def chunks_key(project_id) -> str:
+    return f"{project_id}:chunks"
+
+
+def version_key(project_id) -> str:
+    return f"{project_id}:version"
+
+
+def corpus_version(project_id) -> int:
+    """Counter bumped on every change to the project's chunks; never reset, so
+    anything keyed on it goes stale when the corpus changes."""
+    return int(settings.REDIS_CLOUD.get(version_key(project_id)) or 0)
+
+
+async def acorpus_version(project_id) -> int:
+    return int(await get_async_redis().get(version_key(project_id)) or 0)
+
+
+def bump_corpus_version(project_id):
+    settings.REDIS_CLOUD.incr(version_key(project_id))
+
+
+def save_file_chunks(project_id, file_id, chunks: list):
+    settings.REDIS_BINARY.hset(chunks_key(project_id), str(file_id), encode(json.dumps(chunks)))
+    bump_corpus_version(project_id)
+
+
+def has_file_chunks(project_id, file_id) -> bool:
+    return bool(settings.REDIS_CLOUD.hexists(chunks_key(project_id), str(file_id)))
+
+
+def chunked_files(project_id) -> list:
+    return settings.REDIS_CLOUD.hkeys(chunks_key(project_id))
+
+
+def remove_file_chunks(project_id, file_id):
+    settings.REDIS_CLOUD.hdel(chunks_key(project_id), str(file_id))
+    bump_corpus_version(project_id)
+
+
+def clear_chunks(project_id):
+    with project_lock(project_id):
+        settings.REDIS_CLOUD.delete(chunks_key(project_id))
+        remove_index_dir(project_id)
+        bump_corpus_version(project_id)
+
+
+def load_chunks(project_id) -> list:
+    stored = {file_id.decode(): value for file_id, value in settings.REDIS_BINARY.hgetall(chunks_key(project_id)).items()}
+
+    chunks = []
+    for file_id in sorted(stored):
+        chunks.extend(json.loads(decode(stored[file_id])))
+    return chunks
+
+
+async def afetch_chunks(project_id, refs: list) -> list:
+    file_ids = list(dict.fromkeys(file_id for file_id, _ in refs))
+    if not file_ids:
+        return []
+
+    stored = dict(zip(file_ids, await get_async_redis(binary=True).hmget(chunks_key(project_id), file_ids)))
+    return resolve_refs(refs, stored)
+
+
+def resolve_refs(refs: list, stored: dict) -> list:
+    files = {file_id: json.loads(decode(value)) for file_id, value in stored.items() if value}
+    return [files[file_id][position] for file_id, position in refs if file_id in files]
+
+
+def project_options(project_id) -> dict:
+    """Per-project index and retrieval settings."""
+    options = Project.objects.filter(unique_id=project_id).values(
+        "index_type", "vector_storage", "retrieval_mode", "rerank",
+    ).first()
+    return options or {"index_type": "flat", "vector_storage": "float32", "retrieval_mode": "hybrid", "rerank": True}
+
+
+# index writers all hold indexes.project_lock, the same lock indexing takes around chunk changes
+
+def build_index(project_id, chunks: list = None):
+    with project_lock(project_id):
+        chunks = load_chunks(project_id) if chunks is None else chunks
+        bm25.BM25Index.build(chunks).save(project_id)
+
+        options = project_options(project_id)
+        vector_cls = vector_index.FlatIndex.kinds[options["index_type"]]
+        vector_cls.build(chunks, storage=options["vector_storage"]).save(project_id)
+
+
+def add_to_index(project_id, chunks: list):
+    """Index one file's chunks into the existing project indexes."""
+    with project_lock(project_id):
+        options = project_options(project_id)
+        lexical = bm25.load_index(project_id)
+        dense = vector_index.load_index(project_id, options["index_type"])
+
+        if lexical is None or dense is None:
+            # nothing to extend yet; the chunk store already holds the new file
+            build_index(project_id)
+            return
+
+        lexical.add(project_id, chunks)
+        dense.append(project_id, chunks, storage=options["vector_storage"])
+
+
+def remove_from_index(project_id, file_id):
+    with project_lock(project_id):
+        options = project_options(project_id)
+        lexical = bm25.load_index(project_id)
+        dense = vector_index.load_index(project_id, options["index_type"])
+
+        if lexical is not None:
+            lexical.remove(project_id, file_id)
+        if dense is not None:
+            dense.remove(project_id, file_id)
+
+
+def _load_index(project_id, mode: str, options: dict):
+    if mode == "dense":
+        return vector_index.load_index(project_id, options["index_type"])
+    return bm25.load_index(project_id)
+
+
+def load_index(project_id, mode: str, options: dict = None):
+    options = options or project_options(project_id)
+
+    index = _load_index(project_id, mode, options)
+    if index is None:
+        with project_lock(project_id):
+            index = _load_index(project_id, mode, options)
+            if index is None:
+                logger.info(f"Building missing indexes for project {project_id}")
+                build_index(project_id)
+                index = _load_index(project_id, mode, options)
+    return index
+
+
+def search(project_id, mode: str, query: str, k: int, options: dict) -> list:
+    return load_index(project_id, mode, options).search(query, k)
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = None) -> list:
+    """Fuse ranked (file_id, position, score) lists by sum of 1 / (k + rank)."""
+    k = k or settings.RAG_RRF_K
+    fused = {}
+    for ranking in rankings:
+        for rank, (file_id, position, _) in enumerate(ranking):
+            fused[(file_id, position)] = fused.get((file_id, position), 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused, key=lambda ref: -fused[ref])
+
+
+def rank(project_id, query: str, options: dict, depth: int = None) -> list:
+    """(file_id, position) refs of the best chunks, before reranking."""
+    mode = options["retrieval_mode"]
+    depth = max(depth or settings.RAG_RETRIEVAL_DEPTH, settings.RAG_RERANK_DEPTH if options["rerank"] else 0)
+
+    if mode == "hybrid":
+        lexical = _executor.submit(search, project_id, "bm25", query, depth, options)
+        dense = _executor.submit(search, project_id, "dense", query, depth, options)
+        return reciprocal_rank_fusion([lexical.result(), dense.result()])[:depth]
+    return [(file_id, position) for file_id, position, _ in search(project_id, mode, query, depth, options)]
+
+
+def rerank_chunks(query: str, ranked: list, options: dict) -> list:
+    if not options["rerank"] or not ranked:
+        return ranked
+    head = settings.RAG_RERANK_DEPTH
+    return rerank(query, ranked[:head]) + ranked[head:]
+
+
+def log_timings(project_id, mode: str, timings: dict):
+    logger.info(f"Retrieval {mode} for {project_id}: " + ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items()))
+
+
+async def aretrieve(project_id, query: str, depth: int = None) -> list:
+    """Candidate chunks for the query, best first. Searching and reranking run
+    in worker threads, the chunk fetch goes through the async Redis pool."""
+    options = await sync_to_async(project_options, thread_sensitive=False)(project_id)
+    timings = {}
+
+    started = time.perf_counter()
+    refs = await sync_to_async(rank, thread_sensitive=False)(project_id, query, options, depth)
+    timings["search"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ranked = await afetch_chunks(project_id, refs)
+    timings["fetch"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ranked = await sync_to_async(rerank_chunks, thread_sensitive=False)(query, ranked, options)
+    timings["rerank"] = time.perf_counter() - started
+
+    log_timings(project_id, options["retrieval_mode"], timings)
+    return ranked
+
+
+def format_context(chunks: list) -> str:
+    return "".join(
+        f"""<FILE>FILENAME: {chunk['filename']}, OFFSET: {chunk['start']}-{chunk['end']},\nCONTENT: {chunk['text']}</FILE>"""
+        for chunk in chunks
+    )
+
+
+# projects this worker has already queued for chunking
+_rebuilds_queued = set()
+
+
+def queue_rebuild(project_id):
+    """Queue the rebuild that chunks a project still answered from its corpus
+    blob, the first time this worker sees it."""
+    project_id = str(project_id)
+    if project_id in _rebuilds_queued:
+        return
+    _rebuilds_queued.add(project_id)
+
+    from . import jobs  # jobs imports indexing, which imports this module
+    try:
+        jobs.submit("rebuild", project_id)
+    except Exception as e:
+        _rebuilds_queued.discard(project_id)
+        logger.error(f"Queueing project {project_id} for chunking failed: {e}")
+
+
+def blob_context(project_id, corpus: str, budget: int, model: str = None) -> str:
+    """The legacy corpus blob cut to `budget` tokens, until the queued rebuild
+    has chunked the project."""
+    if corpus:
+        queue_rebuild(project_id)
+    return context.truncate(corpus, budget, model)
+
+
+def has_corpus(project_id) -> bool:
+    """Whether the project has chunks, or a blob from before chunking."""
+    return bool(settings.REDIS_CLOUD.exists(chunks_key(project_id), str(project_id)))
+
+
+def corpus_text(project_id) -> str:
+    """The project's text in the blob's format: the blob of an unchunked
+    project, else every file put back together from its chunks."""
+    if not settings.REDIS_CLOUD.exists(chunks_key(project_id)):
+        return get_corpus(project_id)
+
+    stored = {file_id.decode(): value for file_id, value in settings.REDIS_BINARY.hgetall(chunks_key(project_id)).items()}
+    blocks = []
+    for file_id in sorted(stored):
+        chunks = json.loads(decode(stored[file_id]))
+        if chunks:
+            blocks.append(file_block(chunks[0]["filename"], join_chunks(chunks)))
+    return "".join(blocks)
+
+
+async def ahas_chunks(project_id) -> bool:
+    return bool(await get_async_redis().exists(chunks_key(project_id)))
+
+
+async def aranked_context(project_id, query: str, model: str = None, instruction: str = "", chat_history: str = "") -> str:
+    ranked = await aretrieve(project_id, query)
+    return await sync_to_async(pack_context, thread_sensitive=False)(ranked, query, model, instruction, chat_history)
+
+
+def pack_context(ranked: list, query: str, model: str = None, instruction: str = "", chat_history: str = "") -> str:
+    budget = context.context_budget(model, instruction or "", chat_history, query)
+    return format_context(context.pack(ranked, budget, model))
@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     path('ws/chat/', consumers.ChatConsumer.as_asgi()),
+    path('ws/ingest/<str:project_id>/', consumers.IngestConsumer.as_asgi()),
 ]
@@ -0,0 +1,193 @@
+from django.conf import settings
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import time
+import uuid
+import weakref
+from .redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# futures belong to a loop, so each loop gets its own schedulers
+_schedulers = weakref.WeakKeyDictionary()
+
+# KEYS: leases zset, tokens-this-minute counter
+# ARGV: now, lease ttl, concurrency, lease id, tokens, tpm
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+local used = tonumber(redis.call('GET', KEYS[2]) or '0')
+if used > 0 and used + tonumber(ARGV[5]) > tonumber(ARGV[6]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('INCRBY', KEYS[2], ARGV[5])
+redis.call('EXPIRE', KEYS[2], 120)
+return 1
+"""
+
+
+class Waiter:
+    __slots__ = ("project_id", "tokens", "future")
+
+    def __init__(self, project_id, tokens, future):
+        self.project_id = project_id
+        self.tokens = tokens
+        self.future = future
+
+
+class Slot:
+    """A granted request. Set `used` to the tokens actually spent so the
+    unused part of the reservation goes back into the bucket."""
+
+    def __init__(self, cost):
+        self.cost = cost
+        self.used = None
+
+
+class ProviderScheduler:
+    """
+    Admission control for one provider: at most `concurrency` streams at once
+    and a token bucket refilled at `tpm` tokens per minute.
+
+    Requests that do not fit wait in one FIFO queue per project, and projects
+    are served round-robin, so one busy project cannot starve the others.
+    """
+
+    def __init__(self, name, concurrency, tpm):
+        self.name = name
+        self.concurrency = concurrency
+        self.tpm = tpm
+        self.active = 0
+        self.budget = float(tpm)
+        self.refilled = time.monotonic()
+        self.queues = OrderedDict()
+        self.timer = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.budget = min(self.tpm, self.budget + (now - self.refilled) * self.tpm / 60)
+        self.refilled = now
+
+    def position(self, waiter) -> int:
+        """1-based place in the round-robin service order."""
+        index = self.queues[waiter.project_id].index(waiter)
+        ahead, before = index, True
+        for project_id, queue in self.queues.items():
+            if project_id == waiter.project_id:
+                before = False
+            else:
+                # projects earlier in the rotation get one more turn before ours
+                ahead += min(len(queue), index + 1 if before else index)
+        return ahead + 1
+
+    def dispatch(self):
+        self.refill()
+        while self.queues and self.active < self.concurrency:
+            project_id, queue = next(iter(self.queues.items()))
+            waiter = queue[0]
+            # a request larger than the whole bucket runs once the bucket is full
+            cost = min(waiter.tokens, self.tpm)
+            if self.budget < cost:
+                self.wake_in((cost - self.budget) * 60 / self.tpm)
+                return
+
+            queue.popleft()
+            del self.queues[project_id]
+            if queue:
+                self.queues[project_id] = queue  # back of the rotation
+            self.active += 1
+            self.budget -= cost
+            waiter.future.set_result(cost)
+
+    def wake_in(self, delay: float):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(delay, self.wake)
+
+    def wake(self):
+        self.timer = None
+        self.dispatch()
+
+    def remove(self, waiter):
+        queue = self.queues.get(waiter.project_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.project_id]
+        self.dispatch()
+
+    def release(self, slot):
+        self.active -= 1
+        if slot.used is not None and slot.used < slot.cost:
+            self.budget = min(self.tpm, self.budget + slot.cost - slot.used)
+        self.dispatch()
+
+    async def acquire(self, project_id, tokens: int, on_queued=None) -> Slot:
+        waiter = Waiter(str(project_id), tokens, asyncio.get_running_loop().create_future())
+        self.queues.setdefault(waiter.project_id, deque()).append(waiter)
+        self.dispatch()
+
+        try:
+            position = None
+            while not waiter.future.done():
+                if on_queued and self.position(waiter) != position:
+                    position = self.position(waiter)
+                    await on_queued(position)
+                await asyncio.wait([waiter.future], timeout=settings.RAG_QUEUE_FRAME_INTERVAL)
+        except BaseException:
+            if waiter.future.done():
+                self.release(Slot(waiter.future.result()))
+            else:
+                waiter.future.cancel()
+                self.remove(waiter)
+            raise
+
+        return Slot(waiter.future.result())
+
+    @asynccontextmanager
+    async def slot(self, project_id, tokens: int, on_queued=None):
+        slot = await self.acquire(project_id, tokens, on_queued)
+        lease = None
+        try:
+            if settings.RAG_SCHEDULER_REDIS:
+                lease = await self.acquire_shared(slot.cost, on_queued)
+            yield slot
+        finally:
+            if lease:
+                await self.release_shared(lease)
+            self.release(slot)
+
+    async def acquire_shared(self, tokens: int, on_queued=None) -> str:
+        """Take a slot in the limits shared by every worker, polling until one frees up."""
+        redis = get_async_redis()
+        script = redis.register_script(ACQUIRE_SCRIPT)
+        lease = uuid.uuid4().hex
+        keys = [f"rag:scheduler:{self.name}:leases", f"rag:scheduler:{self.name}:tokens:{int(time.time() // 60)}"]
+
+        notified = False
+        while not await script(keys=keys, args=[time.time(), settings.RAG_SCHEDULER_LEASE, self.concurrency, lease, tokens, self.tpm]):
+            if on_queued and not notified:
+                await on_queued(1)
+                notified = True
+            await asyncio.sleep(settings.RAG_QUEUE_FRAME_INTERVAL)
+            keys[1] = f"rag:scheduler:{self.name}:tokens:{int(time.time() // 60)}"
+        return lease
+
+    async def release_shared(self, lease: str):
+        try:
+            await get_async_redis().zrem(f"rag:scheduler:{self.name}:leases", lease)
+        except Exception as e:
+            # the lease expires on its own after RAG_SCHEDULER_LEASE
+            logger.error(f"Releasing {self.name} lease failed: {e}")
+
+
+def get_scheduler(provider: str) -> ProviderScheduler:
+    schedulers = _schedulers.setdefault(asyncio.get_running_loop(), {})
+    if provider not in schedulers:
+        limits = settings.RAG_PROVIDER_LIMITS[provider]
+        schedulers[provider] = ProviderScheduler(provider, limits["concurrency"], limits["tpm"])
+    return schedulers[provider]
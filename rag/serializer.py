@@ -1,11 +1,12 @@
 from rest_framework import serializers
-from .models import UploadedFile, Project
+from .models import UploadedFile, Project, IngestionJob
 from django.core.exceptions import ObjectDoesNotExist
 
 class ProjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Project
-        fields = ['project_name', 'unique_id', 'created_at']
+        fields = ['project_name', 'unique_id', 'created_at', 'index_type', 'vector_storage',
+                  'retrieval_mode', 'rerank']
 
 
 class UploadedFileSerializer(serializers.ModelSerializer):
@@ -24,8 +25,20 @@ class UploadedFileSerializer(serializers.ModelSerializer):
 
 
 
+class IngestionJobSerializer(serializers.ModelSerializer):
+    project_id = serializers.CharField(source="project_id_id", read_only=True)
+    file = serializers.CharField(source="file_id", read_only=True)
+
+    class Meta:
+        model = IngestionJob
+        fields = ["unique_id", "project_id", "file", "kind", "status", "processed", "total", "error",
+                  "created_at", "updated_at"]
+
+
 class ChatConsumerSerializer(serializers.Serializer):
     unique_id = serializers.UUIDField()
+    # with a conversation_id the history is kept server-side and only user_prompt is needed
+    conversation_id = serializers.UUIDField(required=False)
     chat_history = serializers.ListSerializer(child=serializers.DictField(),  required=False)
     user_prompt = serializers.CharField(max_length=None,
                                         required=False,
@@ -34,6 +47,8 @@ class ChatConsumerSerializer(serializers.Serializer):
 
     def validate(self, data):
         """Ensure at least one of `chat_history` or `user_prompt` is provided."""
+        if data.get("conversation_id") and not data.get("user_prompt"):
+            raise serializers.ValidationError("user_prompt must be provided with a conversation_id.")
         if not data.get("chat_history") and not data.get("user_prompt"):
             raise serializers.ValidationError("Either chat_history or user_prompt must be provided.")
         return data
@@ -1,13 +1,35 @@
 import os
-from django.db.models.signals import post_delete, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from .models import UploadedFile
+from . import jobs
 import logging
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+@receiver(post_save, sender=UploadedFile)
+def index_uploaded_file(sender, instance, created, **kwargs):
+    if not created:
+        return
+    try:
+        # the upload returns right away, the job reports progress over the websocket
+        instance.ingestion_job = jobs.submit("index", instance.project_id_id, instance)
+    except Exception as e:
+        logger.error(f"Queueing {instance.unique_id} for indexing failed: {e}")
+
+
+# registered before remove_media_file, which clears the file's name the job needs
+@receiver(pre_delete, sender=UploadedFile)
+def unindex_uploaded_file(sender, instance, **kwargs):
+    try:
+        # a rebuild may hold the project lock for a while, the delete does not wait on it
+        jobs.submit("unindex", instance.project_id_id, instance)
+    except Exception as e:
+        logger.error(f"Queueing {instance.unique_id} for unindexing failed: {e}")
+
+
 @receiver(pre_delete, sender=UploadedFile)
 def remove_media_file(sender, instance, **kwargs):
      if instance.file:  
@@ -1,3 +1,677 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from asgiref.sync import sync_to_async
+from collections import deque
+import asyncio
+import itertools
+import json
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+from unittest import mock
+import fakeredis
+import numpy as np
+from . import answer_streams, cache, conversations, corpus, history, prompts, retrieval
+from .ann import HNSWIndex, IVFFlatIndex, nearest_neighbours, recall_report, synthetic_vectors
+from .bm25 import BM25Index, BM25Segment, merge_segments
+from .chunking import chunk_text, join_chunks
+from .consumers import ChatConsumer, FrameBatcher
+from .indexes import index_dir
+from .scheduler import ProviderScheduler, Waiter
+from .vector_index import FlatIndex, append_npy, save_npy
 
-# Create your tests here.
+
+def chunk(file_id, position, text):
+    return {"file_id": file_id, "position": position, "text": text}
+
+
+class TempIndexRoot(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        override = override_settings(RAG_INDEX_ROOT=Path(self.root))
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class BM25Tests(TempIndexRoot):
+    def test_merge_drops_documents_of_deleted_files(self):
+        first = BM25Segment.build([chunk("a", 0, "alpha sprocket"), chunk("b", 0, "beta widget")])
+        second = BM25Segment.build([chunk("c", 0, "gamma sprocket"), chunk("a", 1, "alpha gear")])
+
+        merged = BM25Segment.merge([first, second], {"a"})
+
+        self.assertEqual(merged.file_ids.tolist(), ["b", "c"])
+        self.assertEqual(len(merged.postings("alpha")[0]), 0)
+        docs, tfs = merged.postings("sprocket")
+        self.assertEqual(merged.file_ids[docs].tolist(), ["c"])
+        self.assertEqual(tfs.tolist(), [1.0])
+
+    @override_settings(RAG_BM25_MERGE_FACTOR=2)
+    def test_segments_of_one_tier_are_merged(self):
+        index = BM25Index.build([chunk("a", 0, "alpha")])
+        index = index.add("p", [chunk("b", 0, "beta")])
+
+        self.assertEqual(len(index.segments), 1)
+        self.assertEqual(sorted(index.segments[0].file_ids.tolist()), ["a", "b"])
+
+    @override_settings(RAG_INDEX_COMPACT_RATIO=0.5)
+    def test_remove_tombstones_then_compacts(self):
+        chunks = [chunk(file_id, 0, f"{file_id} shared") for file_id in ("a", "b", "c", "d")]
+        index = BM25Index.build(chunks)
+        index.save("p")
+
+        index = index.remove("p", "a")
+        self.assertEqual(index.deleted, {"a"})
+        self.assertEqual(len(index), 4)
+        self.assertNotIn("a", {file_id for file_id, _, _ in index.search("a shared", 10)})
+
+        # half the segment is dead: it is rewritten without them and the tombstones go
+        index = index.remove("p", "b")
+        self.assertEqual(index.deleted, set())
+        self.assertEqual(sorted(index.segments[0].file_ids.tolist()), ["c", "d"])
+
+        path = index_dir("p")
+        manifest = json.loads((path / "bm25.json").read_text())
+        self.assertEqual(manifest["deleted"], [])
+        self.assertEqual(sorted(p.name for p in path.glob("bm25-*.npz")), sorted(manifest["segments"]))
+
+    @override_settings(RAG_INDEX_COMPACT_RATIO=0.9)
+    def test_merge_segments_keeps_only_live_tombstones(self):
+        segment = BM25Segment.build([chunk("a", 0, "alpha"), chunk("b", 0, "beta")])
+        index = merge_segments([segment], {"b", "gone"})
+        self.assertEqual(index.deleted, {"b"})
+
+
+class AppendNpyTests(TempIndexRoot):
+    def test_append_in_place(self):
+        path = Path(self.root) / "rows.npy"
+        rows = np.arange(12, dtype=np.float32).reshape(6, 2)
+        save_npy(path, rows[:4])
+        size = path.stat().st_size
+
+        append_npy(path, rows[4:])
+
+        np.testing.assert_array_equal(np.load(path), rows)
+        self.assertEqual(path.stat().st_size, size + rows[4:].nbytes)
+
+    def test_header_without_room_is_rewritten(self):
+        path = Path(self.root) / "rows.npy"
+        rows = np.arange(20, dtype=np.float32).reshape(10, 2)
+
+        # a header padded to exactly the 64-byte boundary, as older numpy wrote
+        # them: one more digit in the shape no longer fits
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (9, 2), }"
+        header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+        with open(path, "wb") as f:
+            f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode() + rows[:9].tobytes())
+        np.testing.assert_array_equal(np.load(path), rows[:9])
+
+        append_npy(path, rows[9:])
+
+        np.testing.assert_array_equal(np.load(path), rows)
+
+
+class ANNTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = synthetic_vectors(3000, 64, rng)
+        queries = self.vectors[rng.choice(len(self.vectors), 50, replace=False)]
+        queries = queries + rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+        self.queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def index(self, cls, count=None, **structure):
+        count = count or len(self.vectors)
+        return cls(self.vectors[:count], np.asarray(["f"] * count, dtype="U36"), np.arange(count, dtype=np.int32),
+                   **structure)
+
+    def test_bulk_built_graph_reaches_the_exact_neighbours(self):
+        index = self.index(HNSWIndex)
+        index.link(np.arange(len(index)))
+
+        [row] = recall_report(index, self.queries, sweep=[64])
+        self.assertGreaterEqual(row["recall"], 0.95)
+        self.assertTrue((index.links0 >= 0).any(axis=1).all())
+
+    def test_appended_nodes_are_inserted_into_the_graph(self):
+        base = self.index(HNSWIndex, 2900)
+        base.link(np.arange(len(base)))
+        index = self.index(HNSWIndex, **base.structure())
+        with mock.patch.object(HNSWIndex, "build_graph") as build_graph:
+            index.link(np.arange(2900, 3000))
+        build_graph.assert_not_called()
+
+        found = [index.search_vector(self.vectors[node], 1)[0][1] for node in range(2900, 3000)]
+        self.assertGreaterEqual(np.mean(np.asarray(found) == np.arange(2900, 3000)), 0.95)
+
+    def test_cell_search_approximates_exact_neighbours(self):
+        members = np.arange(len(self.vectors), dtype=np.int32)
+        exact, _ = nearest_neighbours(self.vectors, members, 10)
+        approx, dists = nearest_neighbours(self.vectors, members, 10, exact_max=100)
+
+        self.assertTrue((np.diff(dists, axis=1) >= 0).all())
+        overlap = np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approx.tolist(), exact.tolist())])
+        self.assertGreaterEqual(overlap, 0.9)
+
+    def test_ivf_default_nprobe_reaches_the_exact_neighbours(self):
+        index = self.index(IVFFlatIndex)
+        index.link(np.arange(len(index)))
+
+        [row] = recall_report(index, self.queries, sweep=[None])
+        self.assertGreaterEqual(row["recall"], 0.95)
+
+
+class VectorStorageTests(TempIndexRoot):
+    def chunks(self, file_id, count):
+        return [{**chunk(file_id, i, f"{file_id} claim {i} sprocket {i % 7} gear {i % 11}"), "filename": file_id}
+                for i in range(count)]
+
+    def stored(self):
+        return FlatIndex.load(index_dir("p") / "vectors.json")
+
+    @override_settings(RAG_QUANTIZE_MIN_ROWS=64)
+    def test_append_re_encodes_a_switched_storage(self):
+        FlatIndex.build(self.chunks("a", 100), storage="int8").save("p")
+        self.assertEqual(self.stored().storage, "int8")
+
+        index = self.stored().append("p", self.chunks("b", 4), storage="float32")
+        self.assertEqual((index.storage, self.stored().storage), ("float32", "float32"))
+
+        index = self.stored().append("p", self.chunks("c", 4), storage="int8")
+        self.assertEqual((index.storage, self.stored().storage), ("int8", "int8"))
+        self.assertEqual(len(self.stored().codes), 108)
+        self.assertEqual(index.search("c claim 2 sprocket 2 gear 2", 1)[0][:2], ("c", 2))
+
+
+class FakeRedis(SimpleTestCase):
+    """Points settings.REDIS_CLOUD/REDIS_BINARY and the async clients of
+    `modules` at one in-memory server."""
+    modules = ("rag.cache", "rag.retrieval", "rag.conversations", "rag.answer_streams")
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        override = override_settings(REDIS_CLOUD=fakeredis.FakeRedis(server=server, decode_responses=True),
+                                     REDIS_BINARY=fakeredis.FakeRedis(server=server))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        def get_async_redis(binary=False):
+            return fakeredis.FakeAsyncRedis(server=server, decode_responses=not binary)
+
+        for module in self.modules:
+            patcher = mock.patch(f"{module}.get_async_redis", get_async_redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ResponseCacheTests(FakeRedis):
+    options = {"index_type": "flat", "vector_storage": "float32", "retrieval_mode": "hybrid", "rerank": True}
+
+    def key(self, version=0, prompt="What does claim 1 cover?", **options):
+        history = [{"role": "user", "content": "Hello  there"}]
+        return cache.response_key("p", version, "Be brief.", history, prompt, "o3-mini", {**self.options, **options})
+
+    def test_key_changes_with_the_corpus_version(self):
+        before = self.key(retrieval.corpus_version("p"))
+        retrieval.bump_corpus_version("p")
+
+        self.assertNotEqual(self.key(retrieval.corpus_version("p")), before)
+        self.assertEqual(self.key(retrieval.corpus_version("p")), self.key(1, prompt=" What does  claim 1 cover? "))
+
+    def test_key_changes_with_the_retrieval_options(self):
+        self.assertNotEqual(self.key(retrieval_mode="bm25"), self.key())
+        self.assertNotEqual(self.key(rerank=False), self.key())
+        self.assertNotEqual(self.key(index_type="hnsw"), self.key())
+
+    @override_settings(RAG_RESPONSE_CACHE_SIZE=2)
+    async def test_least_recently_used_answer_is_evicted(self):
+        with mock.patch("rag.cache.time.time", side_effect=itertools.count(1000)):
+            await cache.set_response("p", "a", "answer a")
+            await cache.set_response("p", "b", "answer b")
+            self.assertEqual(await cache.get_response("p", "a"), "answer a")
+            await cache.set_response("p", "c", "answer c")
+
+            self.assertIsNone(await cache.get_response("p", "b"))
+            self.assertEqual(await cache.get_response("p", "a"), "answer a")
+            self.assertEqual(await cache.get_response("p", "c"), "answer c")
+
+    async def test_hits_and_misses_are_counted(self):
+        self.assertIsNone(await cache.get_response("p", "a"))
+        await cache.set_response("p", "a", "answer")
+        self.assertEqual(await cache.get_response("p", "a"), "answer")
+
+        stats = await sync_to_async(cache.cache_stats)("p")
+        self.assertEqual(stats["exact"], {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+
+@override_settings(RAG_SEMANTIC_CACHE_THRESHOLD=0.9)
+class SemanticCacheTests(FakeRedis):
+    options = {"index_type": "flat", "vector_storage": "float32", "retrieval_mode": "hybrid", "rerank": True}
+    question = "Which claims of the patent cover the sprocket assembly?"
+
+    def scope(self, model="o3-mini", **options):
+        return cache.semantic_scope("Be brief.", [], self.question, model, {**self.options, **options})
+
+    def setUp(self):
+        super().setUp()
+        cache.set_similar_response("p", self.scope(), self.question, "claims 1-4")
+
+    def test_reworded_question_hits(self):
+        query = "Which claims of the patent cover the sprocket assembly"
+        self.assertEqual(cache.get_similar_response("p", self.scope(), query), "claims 1-4")
+        self.assertEqual(cache.cache_stats("p")["semantic"]["hits"], 1)
+
+    def test_unrelated_question_misses(self):
+        self.assertIsNone(cache.get_similar_response("p", self.scope(), "Who is the assignee of the patent?"))
+        self.assertEqual(cache.cache_stats("p")["semantic"]["misses"], 1)
+
+    def test_other_scope_misses(self):
+        self.assertIsNone(cache.get_similar_response("p", self.scope(model="qwen-plus"), self.question))
+        self.assertIsNone(cache.get_similar_response("p", self.scope(retrieval_mode="dense"), self.question))
+        self.assertIsNone(cache.get_similar_response("other", self.scope(), self.question))
+
+    def test_current_question_in_the_history_is_ignored(self):
+        history = [{"role": "user", "content": self.question}]
+        scope = cache.semantic_scope("Be brief.", history, self.question, "o3-mini", self.options)
+        self.assertEqual(scope, self.scope())
+
+    def test_entries_of_an_older_corpus_version_are_dropped(self):
+        retrieval.bump_corpus_version("p")
+
+        self.assertIsNone(cache.get_similar_response("p", self.scope(), self.question))
+        self.assertEqual(settings.REDIS_CLOUD.hlen(cache.semantic_answers_key("p")), 0)
+
+
+class CorpusCodecTests(SimpleTestCase):
+    text = "said apparatus comprising a first member configured to receive a signal. " * 200
+
+    def test_round_trip_compresses_large_values(self):
+        encoded = corpus.encode(self.text)
+        self.assertEqual(encoded[len(corpus.MAGIC) + 1], corpus.ZLIB)
+        self.assertLess(len(encoded), len(self.text) // 4)
+        self.assertEqual(corpus.decode(encoded), self.text)
+
+    def test_small_values_are_stored_raw(self):
+        encoded = corpus.encode("short")
+        self.assertEqual(encoded[len(corpus.MAGIC) + 1], corpus.RAW)
+        self.assertEqual(corpus.decode(encoded), "short")
+
+    def test_legacy_plain_text_values_decode(self):
+        self.assertEqual(corpus.decode("<FILE>plain</FILE>".encode()), "<FILE>plain</FILE>")
+        self.assertEqual(corpus.decode("<FILE>plain</FILE>"), "<FILE>plain</FILE>")
+        self.assertIsNone(corpus.decode(None))
+        self.assertEqual(corpus.encode(""), b"")
+
+    def test_unknown_format_is_refused(self):
+        with self.assertRaises(ValueError):
+            corpus.decode(corpus.MAGIC + bytes([99, corpus.RAW]) + b"text")
+
+
+class ChunkingTests(SimpleTestCase):
+    def test_chunks_join_back_to_the_text(self):
+        text = " ".join(f"claim {i} recites a sprocket" for i in range(200))
+        chunks = chunk_text(text, chunk_size=100, overlap=30)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(join_chunks(chunks), text)
+
+
+class RetryableError(Exception):
+    status_code = 503
+
+
+class FailoverTests(SimpleTestCase):
+    def consumer(self, streams: dict):
+        consumer = ChatConsumer()
+        consumer.closed_streams = []
+
+        async def open_stream(model, prompt):
+            try:
+                async for text in streams[model]():
+                    yield text
+            finally:
+                consumer.closed_streams.append(model)
+
+        consumer.open_stream = open_stream
+        return consumer
+
+    @staticmethod
+    async def answers(text, delay=0):
+        await asyncio.sleep(delay)
+        yield text
+
+    @staticmethod
+    async def fails():
+        raise RetryableError("unavailable")
+        yield
+
+    @override_settings(RAG_BACKUP_MODELS={"o3-mini": "qwen-plus"})
+    async def test_retryable_error_fails_over_to_the_backup(self):
+        consumer = self.consumer({"o3-mini": self.fails, "qwen-plus": lambda: self.answers("backup")})
+        model, first, stream = await consumer.first_chunk("o3-mini", None)
+        await stream.aclose()
+        self.assertEqual((model, first), ("qwen-plus", "backup"))
+
+    @override_settings(RAG_BACKUP_MODELS={})
+    async def test_without_a_backup_the_error_is_raised(self):
+        consumer = self.consumer({"o3-mini": self.fails})
+        with self.assertRaises(RetryableError):
+            await consumer.first_chunk("o3-mini", None)
+
+    @override_settings(RAG_BACKUP_MODELS={"o3-mini": "qwen-plus"}, RAG_HEDGE_AFTER=0.05)
+    async def test_slow_first_token_is_hedged_and_the_loser_closed(self):
+        consumer = self.consumer({"o3-mini": lambda: self.answers("primary", 5), "qwen-plus": lambda: self.answers("backup")})
+        model, first, stream = await consumer.first_chunk("o3-mini", None)
+        await stream.aclose()
+
+        self.assertEqual((model, first), ("qwen-plus", "backup"))
+        self.assertIn("o3-mini", consumer.closed_streams)
+
+    @override_settings(RAG_BACKUP_MODELS={"o3-mini": "qwen-plus"}, RAG_HEDGE_AFTER=1)
+    async def test_fast_primary_is_not_hedged(self):
+        consumer = self.consumer({"o3-mini": lambda: self.answers("primary"), "qwen-plus": lambda: self.answers("backup")})
+        model, first, stream = await consumer.first_chunk("o3-mini", None)
+        await stream.aclose()
+
+        self.assertEqual((model, first), ("o3-mini", "primary"))
+        self.assertNotIn("qwen-plus", consumer.closed_streams)
+
+
+class ProviderSchedulerTests(SimpleTestCase):
+    def queue(self, scheduler, *project_ids):
+        waiters = []
+        for project_id in project_ids:
+            waiter = Waiter(project_id, 1, None)
+            scheduler.queues.setdefault(project_id, deque()).append(waiter)
+            waiters.append(waiter)
+        return waiters
+
+    def test_position_follows_the_rotation(self):
+        scheduler = ProviderScheduler("test", concurrency=1, tpm=1000)
+        a1, a2, a3, b1, c1 = self.queue(scheduler, "a", "a", "a", "b", "c")
+
+        # service order: a1 b1 c1 a2 a3
+        self.assertEqual([scheduler.position(w) for w in (a1, b1, c1, a2, a3)], [1, 2, 3, 4, 5])
+
+    @override_settings(RAG_SCHEDULER_REDIS=False, RAG_QUEUE_FRAME_INTERVAL=0.01)
+    async def test_dispatch_serves_projects_round_robin(self):
+        scheduler = ProviderScheduler("test", concurrency=1, tpm=10**6)
+        order = []
+
+        async def request(project_id, name):
+            async with scheduler.slot(project_id, 1):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        busy = asyncio.create_task(request("x", "x1"))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(request(project_id, f"{project_id}{i}"))
+                 for project_id, i in (("a", 1), ("a", 2), ("a", 3), ("b", 1))]
+        await asyncio.gather(busy, *tasks)
+
+        self.assertEqual(order, ["x1", "a1", "b1", "a2", "a3"])
+
+    @override_settings(RAG_SCHEDULER_REDIS=False, RAG_QUEUE_FRAME_INTERVAL=0.01)
+    async def test_dispatch_waits_for_the_token_bucket(self):
+        scheduler = ProviderScheduler("test", concurrency=4, tpm=600)
+        first = await scheduler.acquire("a", 600)
+        second = asyncio.create_task(scheduler.acquire("b", 10))
+
+        # the bucket refills 10 tokens a second
+        await asyncio.sleep(0.5)
+        self.assertFalse(second.done())
+        await asyncio.wait_for(second, 2)
+        self.assertEqual(first.cost, 600)
+
+    @override_settings(RAG_SCHEDULER_REDIS=False, RAG_QUEUE_FRAME_INTERVAL=0.01)
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        scheduler = ProviderScheduler("test", concurrency=1, tpm=10**6)
+        held = await scheduler.acquire("a", 1)
+        waiting = asyncio.create_task(scheduler.acquire("b", 1))
+        await asyncio.sleep(0.02)
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        scheduler.release(held)
+
+        self.assertEqual(scheduler.queues, {})
+        self.assertEqual(scheduler.active, 0)
+
+
+class UsageFrameTests(SimpleTestCase):
+    @override_settings(RAG_STREAM_FLUSH_MS=1000, RAG_BACKUP_MODELS={})
+    @mock.patch("rag.consumers.cache.record_usage", mock.AsyncMock())
+    @mock.patch("rag.prompts.count_model_tokens", lambda text, model=None: len(text.split()))
+    async def test_usage_follows_the_last_streamed_text(self):
+        consumer = ChatConsumer()
+        consumer.project_id = "p"
+        frames = []
+
+        async def send(text_data=None, **kwargs):
+            frames.append(json.loads(text_data))
+
+        async def service(prompt, usage):
+            for text in ("a", "b", "c"):
+                yield text
+            usage.update({"prompt_tokens": 3, "cached_tokens": 2, "output_tokens": 1})
+
+        consumer.send = send
+        consumer.openai_service = service
+        await consumer.run_model("o3-mini", prompts.Prompt("prefix", "suffix"))
+
+        self.assertEqual([frame["status"] for frame in frames], ["streaming", "streaming", "usage", "completed"])
+        self.assertEqual("".join(frame["message"] for frame in frames[:2]), "abc")
+        self.assertEqual(frames[2]["cached_tokens"], 2)
+
+
+def first_words_summary(summary, messages, max_tokens):
+    return " ".join(filter(None, [summary] + [chat["content"].split()[0] for chat in messages]))
+
+
+def word_count(text, model=None):
+    return len(text.split())
+
+
+@override_settings(RAG_HISTORY_TURNS=2, RAG_HISTORY_MAX_TOKENS=30,
+                   RAG_HISTORY_SUMMARIZER="rag.tests.first_words_summary")
+@mock.patch("rag.history.count_model_tokens", word_count)
+class HistoryCompactionTests(SimpleTestCase):
+    def setUp(self):
+        history.get_summarizer.cache_clear()
+        self.addCleanup(history.get_summarizer.cache_clear)
+
+    def messages(self, n):
+        return [{"role": "user" if i % 2 == 0 else "bot", "content": f"m{i} " + "word " * 4} for i in range(n)]
+
+    def test_short_history_is_kept_verbatim(self):
+        text, state = history.compact(self.messages(3), None)
+        self.assertIsNone(state)
+        self.assertEqual(text, history.format_messages(self.messages(3)))
+
+    def test_long_history_folds_all_but_the_last_turns(self):
+        messages = self.messages(6)
+        text, state = history.compact(messages, None)
+
+        self.assertEqual(state["covered"], 4)
+        self.assertEqual(state["summary"], "m0 m1 m2 m3")
+        self.assertTrue(text.endswith(history.format_messages(messages[4:])))
+
+    def test_stored_summary_is_reused_while_it_fits(self):
+        messages = self.messages(6)
+        _, state = history.compact(messages, None)
+
+        text, updated = history.compact(messages + self.messages(7)[6:], state)
+        self.assertIsNone(updated)
+        self.assertIn("m0 m1 m2 m3", text)
+
+    def test_stored_summary_of_another_history_is_ignored(self):
+        _, state = history.compact(self.messages(6), None)
+        other = [{**chat, "content": "other " + chat["content"]} for chat in self.messages(6)]
+
+        _, updated = history.compact(other, state)
+        self.assertEqual(updated["summary"], "other other other other")
+
+
+@mock.patch("rag.conversations.count_tokens_batch", lambda texts: [word_count(text) for text in texts])
+class ConversationTests(FakeRedis):
+    async def test_append_and_load(self):
+        first = await conversations.append("p", "c", [{"role": "user", "content": "what is claimed"}])
+        total = await conversations.append("p", "c", [{"role": "bot", "content": "a sprocket"},
+                                                       {"role": "user", "content": "and claim 2"}])
+
+        self.assertEqual((first, total), (4, 11))
+        messages = await conversations.load("p", "c")
+        self.assertEqual([(chat["role"], chat["content"], chat["tokens"]) for chat in messages], [
+            ("user", "what is claimed", 4), ("bot", "a sprocket", 3), ("user", "and claim 2", 4),
+        ])
+        self.assertEqual(await sync_to_async(conversations.token_total)("p", "c"), 11)
+        self.assertEqual(await conversations.load("p", "other"), [])
+
+    async def test_conversations_expire(self):
+        await conversations.append("p", "c", [{"role": "user", "content": "hello"}])
+        ttl = await sync_to_async(settings.REDIS_CLOUD.ttl)(conversations.messages_key("p", "c"))
+        self.assertTrue(0 < ttl <= settings.RAG_CONVERSATION_TTL)
+
+    async def test_delete(self):
+        await conversations.append("p", "c", [{"role": "user", "content": "hello"}])
+        await sync_to_async(conversations.delete)("p", "c")
+
+        self.assertEqual(await conversations.load("p", "c"), [])
+        self.assertEqual(await sync_to_async(conversations.token_total)("p", "c"), 0)
+
+
+class FrameBatcherTests(SimpleTestCase):
+    def batcher(self, interval_ms, max_bytes):
+        self.frames = []
+
+        async def send(frame):
+            self.frames.append(json.loads(frame)["message"])
+
+        return FrameBatcher(send, interval_ms, max_bytes)
+
+    async def test_first_chunk_is_not_held_back(self):
+        batcher = self.batcher(1000, 1024)
+        await batcher.add("first")
+        self.assertEqual(self.frames, ["first"])
+        await batcher.close()
+
+    async def test_flushes_at_max_bytes(self):
+        batcher = self.batcher(1000, 7)
+        for text in ("a", "bbb", "cccc", "dd"):
+            await batcher.add(text)
+
+        self.assertEqual(self.frames, ["a", "bbbcccc"])
+        await batcher.close()
+        self.assertEqual(self.frames, ["a", "bbbcccc", "dd"])
+
+    async def test_flushes_after_interval(self):
+        batcher = self.batcher(20, 1024)
+        await batcher.add("a")
+        await batcher.add("b")
+        await batcher.add("c")
+        self.assertEqual(self.frames, ["a"])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.frames, ["a", "bc"])
+        await batcher.close()
+        self.assertEqual(self.frames, ["a", "bc"])
+
+    async def test_zero_interval_sends_every_chunk(self):
+        batcher = self.batcher(0, 1024)
+        for text in ("a", "b", "c"):
+            await batcher.add(text)
+        await batcher.close()
+        self.assertEqual(self.frames, ["a", "b", "c"])
+
+
+class FakeGeminiStream:
+    """Stands in for the SDK response: streams until its iterator is closed."""
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        try:
+            while True:
+                yield mock.Mock(text="word ", usage_metadata=None)
+                await asyncio.sleep(0.01)
+        finally:
+            self.closed = True
+
+
+class GeminiCancellationTests(SimpleTestCase):
+    def setUp(self):
+        self.upstream = FakeGeminiStream()
+        self.client = mock.Mock(generate_content_async=mock.AsyncMock(return_value=self.upstream))
+        patcher = mock.patch("rag.consumers.providers.get_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_closing_the_answer_closes_the_upstream_stream(self):
+        stream = ChatConsumer().gemini_service_pro("prompt", {})
+        self.assertEqual(await anext(stream), "word ")
+
+        await stream.aclose()
+        self.assertTrue(self.upstream.closed)
+        self.assertIn("timeout", self.client.generate_content_async.call_args.kwargs["request_options"])
+
+    async def test_stop_closes_the_upstream_stream(self):
+        consumer = ChatConsumer()
+        started = asyncio.Event()
+
+        async def turn():
+            async for _ in consumer.gemini_service_pro("prompt", {}):
+                started.set()
+
+        consumer.turns.add(asyncio.create_task(turn()))
+        await started.wait()
+        await consumer.stop()
+        self.assertTrue(self.upstream.closed)
+
+
+@override_settings(RAG_RESUME_BLOCK_MS=10, RAG_PROVIDER_TIMEOUT=1)
+class AnswerStreamTests(FakeRedis):
+    async def record(self, frames):
+        await answer_streams.start("p", "s")
+        return [await answer_streams.append("p", "s", frame) for frame in frames]
+
+    async def read(self, offset="0"):
+        return [frame async for _, frame in answer_streams.read("p", "s", offset)]
+
+    async def test_resume_reads_the_frames_after_the_offset(self):
+        offsets = await self.record(["a", "b", "c"])
+        await answer_streams.finish("p", "s")
+
+        self.assertEqual(await self.read(), ["a", "b", "c"])
+        self.assertEqual(await self.read(offsets[0]), ["b", "c"])
+        self.assertEqual(await self.read(offsets[-1]), [])
+
+    async def test_reader_follows_a_running_generation(self):
+        await self.record(["a"])
+        reading = asyncio.create_task(self.read())
+        await asyncio.sleep(0.05)
+
+        await answer_streams.append("p", "s", "b")
+        await answer_streams.finish("p", "s")
+        self.assertEqual(await asyncio.wait_for(reading, 2), ["a", "b"])
+
+    async def test_active_streams_until_finished(self):
+        await self.record(["a"])
+        active = await sync_to_async(answer_streams.active_streams)("p")
+        self.assertEqual([entry["stream"] for entry in active], ["s"])
+
+        await answer_streams.finish("p", "s")
+        self.assertEqual(await sync_to_async(answer_streams.active_streams)("p"), [])
+
+    async def test_expired_stream_ends_the_read(self):
+        self.assertFalse(await answer_streams.exists("p", "gone"))
+        self.assertEqual([frame async for _, frame in answer_streams.read("p", "gone")], [])
+
+    async def test_readers_keep_a_generation_alive(self):
+        await self.record(["a"])
+        self.assertFalse(await answer_streams.has_readers("p", "s"))
+
+        await answer_streams.touch_reader("p", "s", "tab")
+        self.assertTrue(await answer_streams.has_readers("p", "s"))
+        await answer_streams.drop_reader("p", "s", "tab")
+        self.assertFalse(await answer_streams.has_readers("p", "s"))
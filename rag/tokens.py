@@ -0,0 +1,29 @@
+from django.conf import settings
+from functools import lru_cache
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = None):
+    return tiktoken.get_encoding(name or settings.RAG_TOKEN_ENCODING)
+
+
+def count_tokens(text: str, encoding: str = None) -> int:
+    if not text:
+        return 0
+    return len(get_encoding(encoding).encode_ordinary(text))
+
+
+def count_tokens_batch(texts: list, encoding: str = None) -> list:
+    """Token counts for many texts; tiktoken encodes the batch on its own threads."""
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_encoding(encoding).encode_ordinary_batch(texts)]
+
+
+def truncate_tokens(text: str, limit: int, encoding: str = None) -> str:
+    """The longest leading part of `text` that is at most `limit` tokens."""
+    tokens = get_encoding(encoding).encode_ordinary(text or "")
+    if len(tokens) <= limit:
+        return text or ""
+    return get_encoding(encoding).decode(tokens[:limit])
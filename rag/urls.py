@@ -22,6 +22,13 @@ urlpatterns = [
     path('api/knowledge-capacity/<str:project_id>/', views.get_knowledge_capacity),
     path('api/total-tokens/', views.get_total_tokens),
     path('api/instruction-tokens/<str:project_id>/', views.get_instruction_count),
+    path('api/cache-stats/<str:project_id>/', views.get_cache_stats),
+    path('api/conversation/<str:project_id>/<str:conversation_id>/', views.conversation),
+    path('api/answer-streams/<str:project_id>/', views.get_answer_streams),
+
+    path('api/health/', views.health),
+    path('api/jobs/<str:project_id>/', views.get_jobs),
+    path('api/job/<str:job_id>/', views.get_job),
 
     path('api/get-projects/', views.get_projects),
     path('api/add-project/', views.add_project),
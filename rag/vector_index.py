@@ -0,0 +1,310 @@
+from django.conf import settings
+import io
+import json
+import numpy as np
+from .indexes import index_dir, atomic_save, IndexCache
+from .embeddings import embed
+from .quantization import Quantizer
+
+_cache = IndexCache()
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first."""
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def embed_chunks(chunks: list, batch_size: int = 512) -> np.ndarray:
+    vectors = np.zeros((len(chunks), settings.RAG_EMBEDDING_DIM), dtype=np.float32)
+    for i in range(0, len(chunks), batch_size):
+        vectors[i:i + batch_size] = embed([chunk["text"] for chunk in chunks[i:i + batch_size]])
+    return vectors
+
+
+def save_npy(path, array: np.ndarray):
+    atomic_save(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+
+
+def append_npy(path, rows: np.ndarray):
+    """Append rows to a .npy file in place, rewriting only its header."""
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        header_len = f.tell()
+
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype),
+                              "fortran_order": fortran_order,
+                              "shape": (shape[0] + len(rows),) + tuple(shape[1:])})
+
+        if len(header.getvalue()) == header_len:
+            # rows first: until the new shape is written, readers mapping the
+            # file see the old shape and never run past its end
+            f.seek(0, io.SEEK_END)
+            f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            f.flush()
+            return
+
+    # the padded header ran out of room, fall back to a full rewrite
+    save_npy(path, np.concatenate([np.load(path, mmap_mode="r"), rows.astype(dtype)]))
+
+
+class FlatIndex:
+    """
+    Exact cosine search over a project's chunk embeddings.
+
+    Vectors live in a contiguous float32 `vectors.npy` opened with
+    `mmap_mode='r'`, so an idle project costs no RAM and the OS page cache
+    decides what stays resident. Subclasses add an access structure on top of
+    the same vector file.
+
+    With a quantizer, queries scan the compact codes instead and only the best
+    `rerank` candidates are re-scored against the float32 rows.
+
+    The row arrays are append-only. `vectors.json` records how many rows are
+    committed and which files are deleted; it is written last and is what the
+    per-worker cache watches.
+    """
+    kind = "flat"
+    kinds = {}
+    quantizable = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        FlatIndex.kinds[cls.kind] = cls
+
+    def __init__(self, vectors, file_ids, positions, quantizer=None, codes=None, deleted=None):
+        self.vectors = vectors
+        self.file_ids = file_ids
+        self.positions = positions
+        self.quantizer = quantizer
+        self.codes = codes
+        self.deleted = set(deleted or ())
+        self.alive = ~np.isin(file_ids, list(self.deleted)) if self.deleted else None
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def storage(self) -> str:
+        return self.quantizer.kind if self.quantizer else "float32"
+
+    @property
+    def dead(self) -> int:
+        return 0 if self.alive is None else int((~self.alive).sum())
+
+    @classmethod
+    def quantize(cls, vectors: np.ndarray, storage: str):
+        """Fit `storage`'s quantizer on the vectors and encode them, or (None, None)
+        while there are too few rows to fit it on."""
+        if storage not in Quantizer.kinds or not cls.quantizable or len(vectors) < settings.RAG_QUANTIZE_MIN_ROWS:
+            return None, None
+        quantizer = Quantizer.kinds[storage]()
+        quantizer.train(vectors)
+        return quantizer, quantizer.encode(vectors)
+
+    @classmethod
+    def build(cls, chunks: list, storage: str = "float32", **params):
+        vectors = embed_chunks(chunks)
+        quantizer, codes = cls.quantize(vectors, storage)
+
+        index = cls(
+            vectors=vectors,
+            file_ids=np.asarray([chunk["file_id"] for chunk in chunks], dtype="U36"),
+            positions=np.asarray([chunk["position"] for chunk in chunks], dtype=np.int32),
+            quantizer=quantizer,
+            codes=codes,
+            **params,
+        )
+        index.link(np.arange(len(chunks)))
+        return index
+
+    def link(self, ids: np.ndarray):
+        """Hook for subclasses to index newly added vectors."""
+
+    def structure(self) -> dict:
+        """Constructor arguments of the subclass' access structure."""
+        return {}
+
+    def append(self, project_id, chunks: list, storage: str = None):
+        """Embed and add chunks without rebuilding: rows are appended to the
+        existing files and only the new ids are linked into the structure.
+
+        The quantizer is refitted on every row, and all codes re-encoded, once
+        the index has grown RAG_QUANTIZE_RETRAIN_GROWTH times past what it was
+        fitted on, or when the project switched to another `storage`; below
+        RAG_QUANTIZE_MIN_ROWS the index stays float32."""
+        storage = storage or self.storage
+        path = index_dir(project_id)
+        start = len(self)
+        if np.load(path / "vectors.npy", mmap_mode="r").shape[0] != start:
+            # drop rows left behind by an interrupted append
+            self.save(project_id)
+
+        vectors = embed_chunks(chunks)
+        file_ids = np.asarray([chunk["file_id"] for chunk in chunks], dtype="U36")
+        positions = np.asarray([chunk["position"] for chunk in chunks], dtype=np.int32)
+
+        append_npy(path / "vectors.npy", vectors)
+        append_npy(path / "file_ids.npy", file_ids)
+        append_npy(path / "positions.npy", positions)
+
+        quantizer = self.quantizer
+        count = start + len(chunks)
+        fitted = quantizer.trained if quantizer else 0
+        switched = quantizer is not None and quantizer.kind != storage
+        if switched or storage in Quantizer.kinds and (fitted < settings.RAG_QUANTIZE_MIN_ROWS
+                                                       or count >= settings.RAG_QUANTIZE_RETRAIN_GROWTH * fitted):
+            # the float32 rows are all kept, so a new storage is just a re-encode
+            quantizer, codes = self.quantize(np.load(path / "vectors.npy", mmap_mode="r"), storage)
+            if quantizer:
+                save_npy(path / "codes.npy", codes)
+                self.save_quantizer(path, quantizer)
+        elif quantizer:
+            append_npy(path / "codes.npy", quantizer.encode(vectors))
+
+        updated = type(self)(
+            vectors=np.load(path / "vectors.npy", mmap_mode="r"),
+            file_ids=np.load(path / "file_ids.npy", mmap_mode="r"),
+            positions=np.load(path / "positions.npy", mmap_mode="r"),
+            quantizer=quantizer,
+            codes=np.load(path / "codes.npy", mmap_mode="r") if quantizer else None,
+            deleted=self.deleted,
+            **self.structure(),
+        )
+        updated.link(np.arange(start, len(updated)))
+        updated.save_structure(path, start)
+        updated.save_manifest(path)
+        return updated
+
+    def remove(self, project_id, file_id):
+        """Tombstone a file's rows; compacts once too much of the index is dead."""
+        updated = type(self)(self.vectors, self.file_ids, self.positions, self.quantizer, self.codes,
+                             self.deleted | {str(file_id)}, **self.structure())
+
+        if updated.dead >= settings.RAG_INDEX_COMPACT_RATIO * max(len(updated), 1):
+            updated = updated.compact()
+            updated.save(project_id)
+        else:
+            updated.save_manifest(index_dir(project_id))
+        return updated
+
+    def compact(self):
+        keep = np.flatnonzero(self.alive)
+        index = type(self)(
+            vectors=np.asarray(self.vectors[keep]),
+            file_ids=np.asarray(self.file_ids[keep]),
+            positions=np.asarray(self.positions[keep]),
+            quantizer=self.quantizer,
+            codes=np.asarray(self.codes[keep]) if self.quantizer else None,
+        )
+        index.link(np.arange(len(index)))
+        return index
+
+    def refs(self, ids, scores) -> list:
+        return [(str(self.file_ids[i]), int(self.positions[i]), float(s)) for i, s in zip(ids, scores)]
+
+    def rescore(self, candidates: np.ndarray, query: np.ndarray, k: int, rerank: int = None) -> list:
+        """Exact top-k among candidates; with a quantizer, the codes pre-select
+        `rerank` of them first so only those float32 rows are read."""
+        if self.alive is not None:
+            candidates = candidates[self.alive[candidates]]
+
+        if self.quantizer:
+            rerank = max(rerank or settings.RAG_RERANK_CANDIDATES, k)
+            approx = self.quantizer.scores(self.codes[candidates], query)
+            candidates = np.sort(candidates[top_k(approx, rerank)])
+
+        scores = self.vectors[candidates] @ query
+        best = top_k(scores, k)
+        return self.refs(candidates[best], scores[best])
+
+    def search_vector(self, query: np.ndarray, k: int, rerank: int = None, **params) -> list:
+        if not len(self):
+            return []
+
+        if self.quantizer:
+            rerank = max(rerank or settings.RAG_RERANK_CANDIDATES, k)
+            approx = self.quantizer.scores(self.codes, query)
+            if self.alive is not None:
+                approx[~self.alive] = -np.inf
+            candidates = np.sort(top_k(approx, rerank))
+            return self.rescore(candidates, query, k, rerank=len(candidates))
+
+        scores = self.vectors @ query
+        if self.alive is not None:
+            scores[~self.alive] = -np.inf
+        best = top_k(scores, min(k, len(self) - self.dead))
+        return self.refs(best, scores[best])
+
+    def search(self, query: str, k: int, **params) -> list:
+        """Return up to k (file_id, position, score) tuples, best first."""
+        return self.search_vector(embed([query])[0], k, **params)
+
+    def save_manifest(self, path):
+        manifest = {"kind": self.kind, "storage": self.storage, "count": len(self), "deleted": sorted(self.deleted)}
+        atomic_save(path / "vectors.json", lambda f: f.write(json.dumps(manifest).encode()))
+
+    @staticmethod
+    def save_quantizer(path, quantizer):
+        atomic_save(path / "quantizer.npz", lambda f: np.savez(f, **quantizer.params()))
+
+    def save_structure(self, path, start: int = 0):
+        """Persist the access structure; `start` is the first row added since the last save."""
+
+    def save(self, project_id):
+        path = index_dir(project_id)
+        save_npy(path / "vectors.npy", np.asarray(self.vectors, dtype=np.float32))
+        save_npy(path / "file_ids.npy", self.file_ids)
+        save_npy(path / "positions.npy", self.positions)
+        if self.quantizer:
+            save_npy(path / "codes.npy", self.codes)
+            self.save_quantizer(path, self.quantizer)
+        self.save_structure(path)
+        self.save_manifest(path)
+
+    @classmethod
+    def load_structure(cls, path, count: int) -> dict:
+        return {}
+
+    @staticmethod
+    def load(path):
+        path = path.parent
+        manifest = json.loads((path / "vectors.json").read_text())
+        cls = FlatIndex.kinds.get(manifest["kind"], FlatIndex)
+        count = manifest["count"]
+
+        quantizer = codes = None
+        if manifest["storage"] in Quantizer.kinds:
+            with np.load(path / "quantizer.npz") as params:
+                quantizer = Quantizer.kinds[manifest["storage"]](**dict(params))
+            codes = np.load(path / "codes.npy", mmap_mode="r")[:count]
+
+        # an interrupted append may leave rows past the committed count
+        return cls(
+            vectors=np.load(path / "vectors.npy", mmap_mode="r")[:count],
+            file_ids=np.load(path / "file_ids.npy", mmap_mode="r")[:count],
+            positions=np.load(path / "positions.npy", mmap_mode="r")[:count],
+            quantizer=quantizer,
+            codes=codes,
+            deleted=manifest["deleted"],
+            **cls.load_structure(path, count),
+        )
+
+
+FlatIndex.kinds[FlatIndex.kind] = FlatIndex
+
+
+def load_index(project_id, kind: str = FlatIndex.kind):
+    """The project's vector index, or None when missing or built as another kind."""
+    index = _cache.get(index_dir(project_id) / "vectors.json", FlatIndex.load)
+    return index if index is not None and index.kind == kind else None
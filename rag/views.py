@@ -9,9 +9,17 @@ from rest_framework.decorators import parser_classes
 from django.core.files.storage import default_storage
 # from .redis_client import redis_cloud
 from . import serializer
-from .models import UploadedFile, Project
+from . import retrieval
+from . import cache
+from . import jobs
+from . import conversations
+from . import answer_streams
+from . import redis_client
+from .context import model_spec
+from .corpus import get_corpus, delete_corpus
+from .tokens import count_tokens, count_tokens_batch
+from .models import UploadedFile, Project, IngestionJob
 import logging
-import tiktoken
 import json
 import boto3
 # from .backup import AWSBackup
@@ -25,8 +33,27 @@ def estimate_token_count(text) -> int:
     if text is None:
         return 0
 
-    encoding = tiktoken.get_encoding("cl100k_base")  # Change model name if needed
-    return len(encoding.encode(text))
+    return count_tokens(text)
+
+
+def knowledge_tokens(project) -> int:
+    """Stored token count of the project's corpus, backfilled once for
+    projects indexed before the counts were persisted."""
+    if project.knowledge_tokens:
+        return project.knowledge_tokens
+
+    corpus = get_corpus(project.unique_id)
+    if corpus:
+        project.knowledge_tokens = estimate_token_count(corpus)
+        Project.objects.filter(pk=project.pk).update(knowledge_tokens=project.knowledge_tokens)
+    return project.knowledge_tokens
+
+
+def instruction_tokens(project) -> int:
+    if project.instruction and not project.instruction_tokens:
+        project.instruction_tokens = estimate_token_count(project.instruction)
+        Project.objects.filter(pk=project.pk).update(instruction_tokens=project.instruction_tokens)
+    return project.instruction_tokens
 
 
 def home(request):
@@ -46,8 +73,10 @@ def add_document(request):
         file_serializer = serializer.UploadedFileSerializer(data=request.data)
 
         if file_serializer.is_valid():
-            file_serializer.save()
-            return Response({'message': 'Document added successfully'}, status=status.HTTP_200_OK)
+            uploaded = file_serializer.save()
+            job = getattr(uploaded, 'ingestion_job', None)
+            return Response({'message': 'Document added successfully',
+                             'job': str(job.unique_id) if job else None}, status=status.HTTP_200_OK)
 
         if 'file' in file_serializer.errors:
             logger.error(file_serializer.errors.get('file')[0])
@@ -93,8 +122,11 @@ def get_documents(request, project_id=None):
 def remove_all_documents(request):
     try:
         data = json.loads(request.body)
+        # clear first so the per-file delete signals have nothing left to unindex
+        delete_corpus(data['project_id'])
+        retrieval.clear_chunks(data['project_id'])
+        Project.objects.filter(unique_id=data['project_id']).update(knowledge_tokens=0)
         UploadedFile.objects.filter(project_id=data['project_id']).delete()
-        settings.REDIS_CLOUD.set(data['project_id'], "")
         return Response({'message': 'All documents removed successfully'}, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -104,22 +136,10 @@ def set_redis(request):
     try:
         chat_serializer = serializer.UniqueIdSerializer(data=request.data)
         if chat_serializer.is_valid():
-            files = UploadedFile.objects.filter(project_id=chat_serializer.data['unique_id'])
-
-            corpus = ""
-
-            for file in files:
-                print(f"Reading: {file.file.name}")  # This should print the S3 key
-                try:
-                    with file.file.open(mode="r") as f:
-                        corpus += f"""<FILE>FILENAME: {file.file.name.split('/')[-1]},\nCONTENT: {f.read()}</FILE>"""
-                except Exception as e:
-                    print(f"Error reading {file.file.name}: {e}")
-                    return Response({'error': 'CAnnot read file!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-            settings.REDIS_CLOUD.set(chat_serializer.data['unique_id'], corpus)
-
-            return Response({'message': 'Data saved to redis!'}, status=status.HTTP_200_OK)
+            # uploads and deletes are indexed as they happen; this only catches up on
+            # files that were missed and rebuilds projects that predate chunking
+            job = jobs.submit("sync", chat_serializer.data['unique_id'])
+            return Response({'message': 'Indexing started!', 'job': str(job.unique_id)}, status=status.HTTP_200_OK)
         else:
             return Response({'error': chat_serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -143,7 +163,7 @@ def set_redis(request):
 @api_view(['GET'])
 def get_redis(request, project_id):
     try:
-        corpus = settings.REDIS_CLOUD.get(project_id)
+        corpus = retrieval.corpus_text(project_id)
         return Response({'message': corpus}, status=status.HTTP_200_OK)
     except ValidationError as ve:
         logger.error(str(ve))
@@ -156,12 +176,12 @@ def get_redis(request, project_id):
 @api_view(['DELETE'])
 def reset_redis(request, project_id):
     try:
-        corpus = settings.REDIS_CLOUD.get(project_id)
-
-        if corpus is None:
+        if not retrieval.has_corpus(project_id):
             return Response({'message': 'No data found'}, status=status.HTTP_200_OK)
 
-        settings.REDIS_CLOUD.set(project_id, "")
+        delete_corpus(project_id)
+        retrieval.clear_chunks(project_id)
+        Project.objects.filter(unique_id=project_id).update(knowledge_tokens=0)
         return Response({'message': f'redis reset for project {project_id}'}, status=status.HTTP_200_OK)
     except ValidationError as ve:
         logger.error(str(ve))
@@ -207,6 +227,7 @@ def set_instruction(request):
         instruction = request.data['instruction']
         project = Project.objects.get(unique_id=project_id)
         project.instruction = instruction
+        project.instruction_tokens = estimate_token_count(instruction)
         project.save()
         return Response({'message': 'Instruction saved successfully'}, status=status.HTTP_200_OK)
     except Exception as e:
@@ -218,7 +239,7 @@ def set_instruction(request):
 def get_instruction(request, project_id):
     try:
         project = Project.objects.get(unique_id=project_id)
-        instruction_count = estimate_token_count(project.instruction)
+        instruction_count = instruction_tokens(project)
         return Response({'message': project.instruction, 'token': instruction_count}, status=status.HTTP_200_OK)
     except Exception as e:
         logger.error(str(e))
@@ -228,7 +249,7 @@ def get_instruction(request, project_id):
 def get_instruction_count(request, project_id):
     try:
         project = Project.objects.get(unique_id=project_id)
-        instruction_count = estimate_token_count(project.instruction)
+        instruction_count = instruction_tokens(project)
         return Response({'message': instruction_count}, status=status.HTTP_200_OK)
     except Exception as e:
         logger.error(str(e))
@@ -238,15 +259,18 @@ def get_instruction_count(request, project_id):
 def get_knowledge_capacity(request, project_id):
 
     try:
-        total_size = 128_000 # tokens
-        corpus = settings.REDIS_CLOUD.get(project_id)
-        project = Project.objects.get(unique_id=project_id)
-
-        if corpus is None:
+        model = request.GET.get('model')
+        if model in settings.RAG_MODELS:
+            total_size = model_spec(model)["window"] # tokens
+        else:
+            # the page asks without a model: measure against the smallest window, as before
+            total_size = min(spec["window"] for spec in settings.RAG_MODELS.values())
+        if not retrieval.has_corpus(project_id):
             return Response({'message': 0.0}, status=status.HTTP_200_OK)
 
-        used_tokens = estimate_token_count(corpus)
-        instruction_count = estimate_token_count(project.instruction)
+        project = Project.objects.get(unique_id=project_id)
+        used_tokens = knowledge_tokens(project)
+        instruction_count = instruction_tokens(project)
         capacity_used = (used_tokens / total_size) * 100
         total = instruction_count + used_tokens
 
@@ -263,26 +287,84 @@ def get_knowledge_capacity(request, project_id):
 def get_total_tokens(request):
     try:
         data = json.loads(request.body)
-        total_size = 128_000 # tokens
-        print("PROJECT ID: ", data['project_id'])
-        corpus = settings.REDIS_CLOUD.get(data['project_id'])
-
-        if corpus is None:
+        if not retrieval.has_corpus(data['project_id']):
             return Response({'message': 0.0}, status=status.HTTP_200_OK)
 
         project = Project.objects.get(unique_id=data['project_id'])
 
-        chat = " ".join([f"{chat['role']}: {chat['content']}\n" for chat in data['chats']])
-        print(chat, end="\n\n")
-
-        instruction_tokens = estimate_token_count(project.instruction)  
-        print("INST: ", instruction_tokens)  
-        chat_history_tokens = estimate_token_count(chat)
-        print("CHT: ", chat_history_tokens)
-        used_tokens = estimate_token_count(corpus)
-        print("USED TOK: ", used_tokens)
-        total = instruction_tokens + chat_history_tokens + used_tokens
+        if data.get('conversation_id'):
+            # server-side conversations keep a running total
+            chat_history_tokens = conversations.token_total(data['project_id'], data['conversation_id'])
+        else:
+            # messages are counted as a batch; only the history varies between calls
+            chat_history_tokens = sum(count_tokens_batch([conversations.message_text(chat) for chat in data['chats']]))
+        total = instruction_tokens(project) + chat_history_tokens + knowledge_tokens(project)
         return Response({'message': total}, status=status.HTTP_200_OK)
     except Exception as e:
         logger.error(str(e))
         return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def get_cache_stats(request, project_id):
+    try:
+        return Response({'message': cache.cache_stats(project_id)}, status=status.HTTP_200_OK)
+    except Exception as e:
+        logger.error(str(e))
+        return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def get_job(request, job_id):
+    try:
+        job = IngestionJob.objects.get(unique_id=job_id)
+        return Response({'message': serializer.IngestionJobSerializer(job).data}, status=status.HTTP_200_OK)
+    except ObjectDoesNotExist:
+        return Response({'error': 'No such job!'}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        logger.error(str(e))
+        return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def get_jobs(request, project_id):
+    try:
+        jobs.expire_stale(project_id)
+        active = IngestionJob.objects.filter(project_id=project_id, status__in=["queued", "running"]).order_by('created_at')
+        return Response({'message': serializer.IngestionJobSerializer(active, many=True).data}, status=status.HTTP_200_OK)
+    except Exception as e:
+        logger.error(str(e))
+        return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET', 'DELETE'])
+def conversation(request, project_id, conversation_id):
+    try:
+        if request.method == 'DELETE':
+            conversations.delete(project_id, conversation_id)
+            return Response({'message': 'Conversation deleted'}, status=status.HTTP_200_OK)
+
+        return Response({
+            'message': conversations.get_messages(project_id, conversation_id),
+            'tokens': conversations.token_total(project_id, conversation_id),
+        }, status=status.HTTP_200_OK)
+    except Exception as e:
+        logger.error(str(e))
+        return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def get_answer_streams(request, project_id):
+    try:
+        # other tabs resume one with {"type": "resume", "unique_id", "stream"} on the chat socket
+        return Response({'message': answer_streams.active_streams(project_id)}, status=status.HTTP_200_OK)
+    except Exception as e:
+        logger.error(str(e))
+        return Response({'error': 'Something went wrong!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def health(request):
+    report = redis_client.health()
+    healthy = all(check['ok'] for check in report.values())
+    return Response({'message': report}, status=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE)